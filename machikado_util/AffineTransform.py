@@ -0,0 +1,94 @@
+import numpy as np
+import cv2
+
+from fvcore.transforms.transform import Transform
+
+from .ShearTransform import crop_polygons
+
+
+def translation_matrix(tx: float, ty: float) -> np.ndarray:
+    return np.array([[1, 0, tx],
+                     [0, 1, ty],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def scale_matrix(sx: float, sy: float) -> np.ndarray:
+    return np.array([[sx, 0, 0],
+                     [0, sy, 0],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def to_3x3(mat: np.ndarray) -> np.ndarray:
+    """2x3 のアフィン行列を 3x3 にする"""
+    return np.vstack([np.asarray(mat, dtype=np.float64)[:2], [0, 0, 1]])
+
+
+class AffineTransform(Transform):
+    """
+    回転・せん断・移動・切り出し・リサイズなどを1つのアフィン行列にまとめて、1回のワープで変形するカスタムトランスフォーム
+    """
+    def __init__(self, h: int, w: int, mat: np.ndarray, out_h: int, out_w: int, interp: int = cv2.INTER_LINEAR):
+        """
+        h, w: 入力画像サイズ
+        mat: 3x3 のアフィン行列 (座標系は画素の左上端を 0 とする連続座標で、apply_coords と同じ)
+        out_h, out_w: 出力画像サイズ
+        """
+        super().__init__()
+        self._set_attributes(locals())
+
+    def _warp(self, img: np.ndarray, interp: int) -> np.ndarray:
+        mat = self.mat
+
+        # 大きく縮小する場合は、先に INTER_AREA で縮小しておく (ワープの線形補間だけだとエイリアスが出る)
+        scale = np.sqrt(abs(np.linalg.det(mat[:2, :2])))
+        if scale < 0.5 and interp != cv2.INTER_NEAREST:
+            pre_w, pre_h = max(1, int(round(self.w * scale))), max(1, int(round(self.h * scale)))
+            img = cv2.resize(img, (pre_w, pre_h), interpolation=cv2.INTER_AREA)
+            mat = np.dot(mat, scale_matrix(self.w / pre_w, self.h / pre_h))
+
+        # 連続座標の行列を、画素中心 (i + 0.5) 基準の行列に直す
+        mat = translation_matrix(-0.5, -0.5).dot(mat).dot(translation_matrix(0.5, 0.5))
+
+        return cv2.warpAffine(img, mat[:2], (self.out_w, self.out_h), flags=interp,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def apply_image(self, img: np.ndarray) -> np.ndarray:
+        """イメージの変形を行う
+
+        Arguments:
+            img {np.ndarray} -- 元イメージ
+
+        Returns:
+            np.ndarray -- 変形されたイメージ
+        """
+        h, w = img.shape[:2]
+        assert (self.h == h and self.w == w), '画像サイズ不整合 h:w {}:{} -> {}:{}'.format(self.h, self.w, h, w)
+
+        return self._warp(img, self.interp)
+
+    def apply_segmentation(self, segmentation: np.ndarray) -> np.ndarray:
+        return self._warp(segmentation, cv2.INTER_NEAREST)
+
+    def apply_coords(self, coords: np.ndarray) -> np.ndarray:
+        """領域座標変換
+
+        Arguments:
+            coords {np.ndarray} -- 変換した座標
+
+        Returns:
+            np.ndarray -- 変換された座標
+        """
+        coords = np.asarray(coords, dtype=np.float64)
+
+        return np.dot(coords, self.mat[:2, :2].T) + self.mat[:2, 2]
+
+    def apply_polygons(self, polygons: list) -> list:
+        """ポリゴン（領域データの変換）
+
+        Arguments:
+            polygons {list} -- ポリゴン [np.ndarray (N, 2), ...]
+
+        Returns:
+            list -- 変換して出力画像の範囲でクリッピングしたポリゴン
+        """
+        return crop_polygons([self.apply_coords(p) for p in polygons], self.out_w, self.out_h)
@@ -1,35 +1,119 @@
 import numpy as np
 import cv2
 
-import shapely.geometry as geometry
 from fvcore.transforms.transform import Transform
 from detectron2.data import transforms as T
 
+from .sample_rng import as_generator
+
 
 class CutoutTransform(Transform):
     def __init__(self, h, w, centers, radii, colors):
         """
-        centers: 中心のリスト
-        radii: 半径のリスト
-        colors: 色のリスト
+        centers: 中心の配列 [N, 2] (x, y)
+        radii: 半径の配列 [N]
+        colors: 色の配列 [N, 3]
         """
         super().__init__()
         self._set_attributes(locals())
-        
+
+        self.centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+        self.radii = np.asarray(radii, dtype=np.int64).reshape(-1)
+        self.colors = np.asarray(colors).reshape(-1, 3)
+        assert len(self.centers) == len(self.radii) == len(self.colors), '引数の不整合'
+
+        self._labels = None
+
+    @property
+    def labels(self):
+        """
+        画素ごとに、一番上に描かれた穴の番号 + 1 を持つラベル画像 [h, w] (穴がない画素は 0)
+        マスクが必要になったとき (apply_segmentation, get_occluded_ratios) に1回だけ作る
+        """
+        if self._labels is None:
+            dtype = np.uint8 if len(self.radii) < 255 else np.uint16
+            labels = np.zeros((self.h, self.w), dtype=dtype)
+
+            for i, (pt, r) in enumerate(zip(self.centers, self.radii)):
+                cv2.circle(labels, (int(pt[0]), int(pt[1])), int(r), color=i + 1, thickness=-1)
+
+            self._labels = labels
+
+        return self._labels
+
+    @property
+    def mask(self):
+        """
+        穴で隠される画素の bool 配列 [h, w]
+        """
+        return self.labels > 0
+
     def apply_image(self, img: np.ndarray):
         assert len(img.shape) == 3, '3ch のカラー画像のみを対象とする'
         h, w = img.shape[:2]
         assert (self.h == h and self.w == w), '画像サイズ不整合 h:w {}:{} -> {}:{}'.format(self.h, self.w, h, w)
-        
-        assert len(self.centers) == len(self.radii) == len(self.colors), '引数の不整合'
-        for pt, r, c in zip(self.centers, self.radii, self.colors):
-            img = cv2.circle(img, pt, r, color=c, thickness=-1)
-        
+
+        if len(self.radii) == 0:
+            return img
+
+        if not img.flags.writeable:
+            img = img.copy()
+
+        # 穴の画素だけを塗る (ラベル画像から画像全体に合成するより速い)
+        for pt, r, c in zip(self.centers.tolist(), self.radii.tolist(), self.colors.tolist()):
+            cv2.circle(img, tuple(pt), r, color=c, thickness=-1)
+
         return img
-        
+
+    def apply_segmentation(self, segmentation: np.ndarray):
+        """
+        穴で隠された画素を 0 (背景) にする
+        """
+        if len(self.radii) == 0:
+            return segmentation
+
+        segmentation = segmentation.copy()
+        segmentation[self.mask] = 0
+
+        return segmentation
+
     def apply_coords(self, coords: np.ndarray):
         return coords
 
+    def get_occluded_ratios(self, segmentations):
+        """
+        インスタンスごとに、面積のうち穴で隠される割合を求める
+
+        segmentations: インスタンスごとのポリゴンのリスト [[[x0, y0, x1, y1, ...], ...], ...]
+        ※画像全体ではなく、インスタンスを囲む領域だけで計算する
+        """
+        ratios = np.zeros(len(segmentations), dtype=np.float64)
+
+        if len(self.radii) == 0:
+            return ratios
+
+        labels = self.labels
+
+        for i, polygons in enumerate(segmentations):
+            pts = [np.asarray(p, dtype=np.float64).reshape(-1, 2).astype(np.int32) for p in polygons]
+            if len(pts) == 0:
+                continue
+
+            all_pts = np.concatenate(pts)
+            x0, y0 = np.maximum(all_pts.min(axis=0), 0)
+            x1, y1 = np.minimum(all_pts.max(axis=0) + 1, (self.w, self.h))
+            if x1 <= x0 or y1 <= y0:
+                continue
+
+            crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            crop = cv2.fillPoly(crop, [p - (x0, y0) for p in pts], 1).astype(bool)
+
+            area = np.count_nonzero(crop)
+            if area > 0:
+                ratios[i] = np.count_nonzero(crop & (labels[y0:y1, x0:x1] > 0)) / area
+
+        return ratios
+
 
 class RandomCutout(T.TransformGen):
     def __init__(self, num_hole_range, radius_range, color_ranges):
@@ -41,21 +125,44 @@ class RandomCutout(T.TransformGen):
         super().__init__()
         self._init(locals())
 
-    def get_transform(self, img):
+    def get_transform(self, img, rng=None):
+        """
+        rng: 乱数生成器 (np.random.Generator)。None ならグローバルの乱数から作る
+        """
+        return self.make_transform(img, *self.sample_holes(1, rng)[0])
+
+    def sample_holes(self, num, rng=None):
+        """
+        num 回分の穴のパラメータを引く (画像サイズによらない値なので、画像を読む前にまとめて引いておける)
+
+        Returns:
+            (中心 [穴数, 2] (画像の幅・高さに対する割合), 半径 [穴数] (短辺に対する割合), 色 [穴数, 3]) のリスト
+        """
+        rng = as_generator(rng)
+
+        num_holes = rng.integers(self.num_hole_range[0], self.num_hole_range[1], num)
+        total = int(num_holes.sum())
+
+        # 穴のパラメータは全サンプル分まとめて引いて分ける
+        centers = rng.uniform(0, 1, (total, 2))
+        radii = rng.uniform(self.radius_range[0], self.radius_range[1], total)
+        color_ranges = np.asarray(self.color_ranges, dtype=np.float64)
+        colors = rng.uniform(color_ranges[:, 0], color_ranges[:, 1], (total, 3))
+
+        splits = np.cumsum(num_holes)[:-1]
+
+        return list(zip(np.split(centers, splits), np.split(radii, splits), np.split(colors, splits)))
+
+    def make_transform(self, img, centers, radii, colors):
+        """
+        sample_holes で引いたパラメータから img に対するトランスフォームを作る
+        """
         h, w = img.shape[:2]
-        
+
         short_len = h if h < w else w
-        
-        num_hole = np.random.randint(self.num_hole_range[0], self.num_hole_range[1])
-        centers, radii, colors = [], [], []
-        
-        for _ in range(num_hole):
-            centers += [(int(np.random.uniform(0, h)), int(np.random.uniform(0, w)))]
-            radii += [int(short_len * np.random.uniform(self.radius_range[0], self.radius_range[1]))]
-
-            b = np.random.uniform(self.color_ranges[0][0], self.color_ranges[0][1])
-            g = np.random.uniform(self.color_ranges[1][0], self.color_ranges[1][1])
-            r = np.random.uniform(self.color_ranges[2][0], self.color_ranges[2][1])
-            colors += [(int(b), int(g), int(r))]
-       
-        return CutoutTransform(h, w, centers, radii, colors)
\ No newline at end of file
+
+        centers = (np.asarray(centers) * (w, h)).astype(np.int64)
+        radii = (short_len * np.asarray(radii)).astype(np.int64)
+        colors = np.asarray(colors).astype(np.int64)
+
+        return CutoutTransform(h, w, centers, radii, colors)
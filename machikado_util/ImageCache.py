@@ -0,0 +1,146 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import cv2
+
+from detectron2.data import detection_utils as utils
+
+# 削除するときは max_bytes のこの割合まで減らす (上限ぎりぎりで毎回ディレクトリを調べ直さないように)
+EVICT_RATIO = 0.9
+
+
+class ImageCache:
+    """
+    デコード済み画像のキャッシュ
+
+    画像ごとに uint8 の .npy ファイルを cache_dir に書き出し、読み込みはメモリマップで行う。
+    ディレクトリを共有するので、DataLoader のワーカープロセス間でも JPEG のデコードは画像ごとに1回で済む
+    (cache_dir を /dev/shm の下にすれば共有メモリになる)
+
+    * 合計サイズが max_bytes を超えたら、最後に使われた時刻 (ファイルの mtime) が古いものから削除する
+      合計サイズはプロセスごとに見積もっておき (作成時に1回だけディレクトリを調べ、以降は書き込んだ分を足す)、
+      見積もりが max_bytes を超えたときだけディレクトリを調べ直して、max_bytes * EVICT_RATIO まで減らす
+      (他のプロセスが書き込んだ分は、調べ直すまで見積もりに入らない)
+    * max_size を指定すると、長辺が max_size 以下になるように縮小してから保存する
+    * 返す画像は読み込み専用のメモリマップなので、その場で書き換える変換はコピーしてから行うこと
+    """
+    def __init__(self, cache_dir, max_bytes=2 << 30, max_size=0):
+        """
+        cache_dir: キャッシュを置くディレクトリ
+        max_bytes: キャッシュの合計サイズの上限
+        max_size: 長辺の最大サイズ (0 なら縮小しない)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._scan())  # 合計サイズの見積もり
+
+    def _cache_filename(self, file_name, format):
+        # 画像が差し替えられたら別のキーになるように、更新時刻とサイズも含める
+        st = os.stat(file_name)
+        key = '{}|{}|{}|{}|{}'.format(os.path.abspath(file_name), st.st_mtime_ns, st.st_size, format, self.max_size)
+
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def get_resized_size(self, h, w):
+        """
+        (h, w) の画像がキャッシュされるときのサイズ (new_h, new_w)
+        """
+        if self.max_size <= 0 or max(h, w) <= self.max_size:
+            return h, w
+
+        scale = self.max_size / max(h, w)
+        return max(1, int(round(h * scale))), max(1, int(round(w * scale)))
+
+    def _resize(self, image):
+        h, w = image.shape[:2]
+        new_h, new_w = self.get_resized_size(h, w)
+
+        if (new_h, new_w) == (h, w):
+            return image
+
+        return cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    def _write(self, cache_filename, image):
+        """
+        画像を書き出して、書き出したファイルのサイズを返す
+        """
+        # 書きかけのファイルを他のプロセスが読まないように、一時ファイルに書いてから置き換える
+        fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(image))
+                size = f.tell()
+            os.replace(tmp_filename, cache_filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        return size
+
+    def _scan(self):
+        """
+        キャッシュのファイルの (更新時刻, サイズ, パス) のリスト
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:  # 他のプロセスが削除した
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+        return entries
+
+    def _evict(self):
+        """
+        ディレクトリを調べ直して、合計サイズが max_bytes * EVICT_RATIO 以下になるまで、使われていないものから削除する
+        """
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_RATIO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        self._total_bytes = total
+
+    def read_image(self, file_name, format=None):
+        """
+        utils.read_image の代わりに使う (max_size を指定した場合は縮小された画像になる)
+        """
+        cache_filename = self._cache_filename(file_name, format)
+
+        try:
+            image = np.load(cache_filename, mmap_mode='r')
+            os.utime(cache_filename)  # 最後に使われた時刻を更新する
+            return image
+        except (FileNotFoundError, ValueError):  # 未作成・他のプロセスが削除した
+            pass
+
+        image = self._resize(utils.read_image(file_name, format=format))
+
+        if image.nbytes <= self.max_bytes:
+            self._total_bytes += self._write(cache_filename, image)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+        return image
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy') or entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+
+        self._total_bytes = 0
@@ -0,0 +1,213 @@
+import numpy as np
+
+from .calc_iou import calc_iou_matrix
+from .calc_ap import match_image, make_df_dict, calc_AP, make_AP_table, INFO_COLUMNS, AP_THRESHOLDS
+
+
+class IncrementalEvaluator:
+    """
+    画像の追加・更新・削除に合わせて AP を更新する評価器
+
+        evaluator = IncrementalEvaluator(classes=list(CAT_ID2NAME.keys()), ths=[0.5])
+        evaluator.add_images(true_dicts, pred_dicts)
+        evaluator.update_true(file_name, true_dict)  # アノテーションを直した画像だけ照合し直す
+        evaluator.calc_AP(cat_names, th=0.5)
+
+    * 画像ごとに IoU と照合結果 (match_image) を保持し、変更された画像だけ照合し直す
+    * pre, rec と DataFrame は、変更の影響を受けたクラスだけ作り直す
+    * 結果は、教師データと予想の両方がそろった画像を追加順に並べて make_info_dicts_stream を実行した場合と同じになる
+      (画像を削除・途中に挿入すると、それより後の画像の file_i がずれるので、後ろの画像を含むクラスも作り直す)
+    """
+    def __init__(self, classes, ths=AP_THRESHOLDS, iou_method='matmul'):
+        """
+        classes: 評価するクラスのリスト
+        ths: IoU のしきい値のリスト
+        iou_method: IoU の計算方法 (calc_iou.calc_iou_matrix を参照)
+        """
+        self.classes = list(classes)
+        self.ths = list(ths)
+        self.iou_method = iou_method
+
+        self._keys = {}     # 追加された画像のキー (追加順の順序付き集合として使う)
+        self._trues = {}    # キー -> true_dict
+        self._preds = {}    # キー -> pred_dict
+        self._matches = {}  # キー -> {しきい値: match_image の結果} (両方そろった画像のみ)
+        self._order = None  # 両方そろった画像のキー -> file_i (None なら作り直す)
+
+        self._num_true = {_cls: 0 for _cls in self.classes}
+        self._df_dicts = {th: {} for th in self.ths}
+        self._dirty = set(self.classes)
+
+    def __len__(self):
+        return len(self._matches)
+
+    def _get_order(self):
+        if self._order is None:
+            self._order = {key: file_i for file_i, key in enumerate(key for key in self._keys if key in self._matches)}
+
+        return self._order
+
+    def _match_classes(self, key):
+        return set(self._matches[key][self.ths[0]].keys())
+
+    def _match(self, key):
+        """
+        教師データと予想を照合する (評価しないクラスは数えない)
+        """
+        true_dict, pred_dict = self._trues[key], self._preds[key]
+        iou_list = calc_iou_matrix(pred_dict['masks'], true_dict['masks'], method=self.iou_method)
+
+        return {th: {u_cls: record for u_cls, record in match_image(true_dict, pred_dict, th, iou_list=iou_list).items()
+                     if u_cls in self._num_true}
+                for th in self.ths}
+
+    def _count(self, key, sign):
+        for u_cls, (num_true, _) in self._matches[key][self.ths[0]].items():
+            self._num_true[u_cls] += sign * num_true
+
+    def _reorder(self, key, added):
+        """
+        両方そろった画像が増減したときに file_i を付け直す (self._matches を更新してから呼ぶ)
+        末尾以外の増減では、file_i がずれる後ろの画像のクラスも作り直す
+        """
+        order = self._order
+
+        if order is not None and added and key == next(reversed(self._keys)):
+            order[key] = len(order)
+            return
+        if order is not None and not added and order[key] == len(order) - 1:
+            del order[key]
+            return
+
+        if order is None:
+            self._dirty |= set(self.classes)
+            return
+
+        file_i = order[key] if not added else None
+        self._order = None
+        order = self._get_order()
+        if added:
+            file_i = order[key]
+
+        for other, other_i in order.items():
+            if other_i >= file_i:
+                self._dirty |= self._match_classes(other)
+
+    def _update(self, key, true_dict=None, pred_dict=None):
+        self._keys.setdefault(key, None)
+        if true_dict is not None:
+            self._trues[key] = true_dict
+        if pred_dict is not None:
+            self._preds[key] = pred_dict
+
+        was_matched = key in self._matches
+        if was_matched:
+            self._dirty |= self._match_classes(key)
+            self._count(key, -1)
+
+        if key in self._trues and key in self._preds:
+            self._matches[key] = self._match(key)
+            self._dirty |= self._match_classes(key)
+            self._count(key, 1)
+
+            if not was_matched:
+                self._reorder(key, added=True)
+
+    def update_true(self, key, true_dict):
+        """
+        画像の教師データを追加・更新する (key は file_name など画像を識別できるもの)
+        """
+        self._update(key, true_dict=true_dict)
+
+    def update_pred(self, key, pred_dict):
+        """
+        画像の予想を追加・更新する
+        """
+        self._update(key, pred_dict=pred_dict)
+
+    def update_image(self, key, true_dict=None, pred_dict=None):
+        """
+        画像の教師データ・予想を追加・更新する (None の方は変えない)
+        """
+        self._update(key, true_dict=true_dict, pred_dict=pred_dict)
+
+    def add_images(self, true_dicts, pred_dicts, keys=None):
+        """
+        複数の画像をまとめて追加する (keys が None なら true_dict の file_name をキーにする)
+        """
+        assert len(true_dicts) == len(pred_dicts), '要素数は等しいはず'
+
+        if keys is None:
+            keys = [true_dict['file_name'] for true_dict in true_dicts]
+
+        for key, true_dict, pred_dict in zip(keys, true_dicts, pred_dicts):
+            self._update(key, true_dict=true_dict, pred_dict=pred_dict)
+
+    def remove_image(self, key):
+        """
+        画像を教師データ・予想ごと取り除く
+        """
+        if key in self._matches:
+            self._dirty |= self._match_classes(key)
+            self._count(key, -1)
+            del self._matches[key]
+            self._reorder(key, added=False)
+
+        self._keys.pop(key, None)
+        self._trues.pop(key, None)
+        self._preds.pop(key, None)
+
+    def _build_class(self, u_cls, keys, order):
+        """
+        1クラス分の df を全しきい値について作り直す
+        """
+        keys = [key for key in keys if u_cls in self._matches[key][self.ths[0]]]
+
+        for th in self.ths:
+            tmp_dict = {col: [] for col in INFO_COLUMNS}
+
+            for key in keys:
+                record = self._matches[key][th][u_cls][1]
+                num_pred = len(record['score'])
+
+                tmp_dict['file_i'].append(np.full(num_pred, order[key], dtype=np.int64))
+                tmp_dict['pred_i'].append(np.arange(num_pred))
+                tmp_dict['score'].append(record['score'])
+                tmp_dict['correct'].append(record['correct'])
+                tmp_dict['iou'].append(record['iou'])
+
+            self._df_dicts[th][u_cls] = make_df_dict({u_cls: tmp_dict}, self._num_true)[u_cls]
+
+    def get_df_dicts(self):
+        """
+        しきい値ごとの df_dict (make_info_dicts_stream と同じ形式)
+        """
+        if len(self._dirty):
+            order = self._get_order()
+            keys = sorted(self._matches, key=order.get)
+
+            for u_cls in self.classes:
+                if u_cls in self._dirty:
+                    self._build_class(u_cls, keys, order)
+
+            self._dirty.clear()
+
+        return {th: {u_cls: self._df_dicts[th][u_cls] for u_cls in self.classes} for th in self.ths}
+
+    def get_df_dict(self, th):
+        """
+        しきい値 th の df_dict (make_info_dict と同じ形式)
+        """
+        return self.get_df_dicts()[th]
+
+    def calc_AP(self, cat_names, th, method='trapezoid'):
+        """
+        しきい値 th の AP (calc_ap.calc_AP と同じ)
+        """
+        return calc_AP(self.get_df_dict(th), cat_names=cat_names, method=method)
+
+    def calc_AP_table(self, cat_names, method='trapezoid'):
+        """
+        全しきい値の AP 表 (calc_ap.calc_AP_table と同じ)
+        """
+        return make_AP_table(self.get_df_dicts(), cat_names, method=method)
@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+from .MachikadoDatasetMapper import MachikadoDatasetMapper
+from .sample_rng import as_generator, get_sample_rng, seed_global_rng, seed_geometric_rng
+
+
+class MachikadoBatchMapper(MachikadoDatasetMapper):
+    """
+    ミニバッチ単位のカスタムデータマッパー (build_batch_train_loader の collate_fn として使う)
+
+    * 画像の読み込みと明るさ・コントラスト・彩度の変更は、スレッドプールで画像ごとに並列に行う
+      (重みは各サンプルの乱数で先に引いておき、変換はその場で上書きする)
+    * カットアウト・アフィン変換・アノテーションの変換は MachikadoDatasetMapper と同じ
+    * 変換後の画像サイズがそろっていれば、1つのテンソル [N, C, H, W] にまとめて、各レコードにはそのビューを入れる
+    * cfg.INPUT.SEED が 0 以上なら、カットアウト・アフィン変換は MachikadoDatasetMapper と同じになる
+      (明るさ・コントラスト・彩度が同じになるのは、MachikadoDatasetMapper でも FUSED.PHOTOMETRIC が有効なときだけ)
+    """
+    def __init__(self, cfg, is_train=True, num_workers=4):
+        """
+        num_workers: 画像の読み込みに使うスレッド数
+        """
+        super().__init__(cfg, is_train)
+
+        # バッチで重みをまとめて引くので、明るさ・コントラスト・彩度は常にまとめる
+        self.fused_photometric = self.photometric_gen is not None
+        if not self.fused_photometric:
+            self._fuse_photometric_gens(cfg)
+
+        self.num_workers = num_workers
+
+    def __call__(self, dataset_dicts):
+        rngs = [get_sample_rng(dataset_dict, self.seed) for dataset_dict in dataset_dicts]
+        weights = [self.photometric_gen.sample_weights(1, self._get_photometric_rng(d, rng))[0] if self.photometric_gen is not None else None
+                   for d, rng in zip(dataset_dicts, rngs)]
+
+        if self.num_workers > 1 and len(dataset_dicts) > 1:
+            with ThreadPoolExecutor(min(self.num_workers, len(dataset_dicts))) as executor:
+                records = list(executor.map(self._read_photometric, dataset_dicts, weights))
+        else:
+            records = [self._read_photometric(d, w) for d, w in zip(dataset_dicts, weights)]
+
+        # 乱数を使う変換は、メインスレッドで順番に行う
+        # (detectron2 のジェネレータが使うグローバルの乱数は、サンプルごとに初期化し直す)
+        dataset_dicts, images, transforms = [], [], []
+        for (dataset_dict, image), rng in zip(records, rngs):
+            image = self._apply_cutout(image, dataset_dict, rng)
+            seed_geometric_rng(dataset_dict, self.seed)
+            image, tfms = self._apply_geometric(image, dataset_dict, rng)
+
+            dataset_dicts.append(dataset_dict)
+            images.append(image)
+            transforms.append(tfms)
+
+        # テストの場合はアノテーションがいらないので削除して終了
+        if not self.is_train:
+            for dataset_dict in dataset_dicts:
+                dataset_dict.pop('annotations', None)
+                dataset_dict.pop('sem_seg_file_name', None)
+                self.timer.step()
+            return dataset_dicts
+
+        with self.timer('to_tensor'):
+            image_tensors = self._to_tensors(images)
+
+        for dataset_dict, image_tensor, image, tfms in zip(dataset_dicts, image_tensors, images, transforms):
+            dataset_dict['image'] = image_tensor
+            dataset_dict['instances'] = self._get_instances(dataset_dict.pop('annotations'), tfms, image.shape[:2])
+            self.timer.step()
+
+        return dataset_dicts
+
+    def _get_photometric_rng(self, dataset_dict, rng):
+        """
+        明るさ・コントラスト・彩度の重みを引く乱数
+        設定でまとめていなければ、MachikadoDatasetMapper の RandomContrast などと同じくグローバルの乱数の系列から引き、
+        サンプルの乱数 rng (カットアウト・アフィン変換) は消費しない
+        """
+        if self.fused_photometric:
+            return rng
+
+        seed_global_rng(dataset_dict, self.seed)
+        return as_generator(None)
+
+    def _read_photometric(self, dataset_dict, weights):
+        """
+        画像を読み込んで明るさ・コントラスト・彩度を変更する (スレッドプールから呼ばれる)
+        """
+        with self.timer('read'):
+            dataset_dict, image = self._read(dataset_dict)
+
+        if weights is not None:
+            with self.timer('photometric'):
+                if not image.flags.writeable:
+                    image = image.copy()
+
+                tfm = self.photometric_gen.make_transform(image, *weights)
+                image = tfm.apply_image(image, out=image)
+
+        return dataset_dict, image
+
+    @staticmethod
+    def _to_tensors(images):
+        """
+        画像のリストを [C, H, W] のテンソルのリストにする
+        サイズがそろっていれば1回の確保でまとめて変換する
+        """
+        if len(set((image.shape, image.dtype) for image in images)) == 1:
+            h, w, c = images[0].shape
+            batch = np.empty((len(images), c, h, w), dtype=images[0].dtype)
+            for i, image in enumerate(images):
+                batch[i] = image.transpose(2, 0, 1)
+
+            return list(torch.from_numpy(batch))
+
+        return [torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1))) for image in images]
@@ -1,17 +1,50 @@
-import copy
 import logging
 import numpy as np
 import torch
 
 from detectron2.data import transforms as T
 from detectron2.data import detection_utils as utils
+from detectron2.structures import BoxMode
 
 from .ShearTransform import ShearTransform, RandomShear
 from .CutoutTransform import CutoutTransform, RandomCutout
+from .PhotometricTransform import PhotometricTransform, RandomPhotometric
+from .ImageCache import ImageCache
+from .machikado_shard import read_shard_image
+from .stage_timer import StageTimer
+from .sample_rng import get_sample_rng, seed_global_rng, seed_geometric_rng
+from .AffineTransform import AffineTransform, translation_matrix, scale_matrix, to_3x3
+
+def copy_dataset_dict(dataset_dict):
+    """
+    データセットのレコードを、マッパーが書き換える部分だけ複製する (copy.deepcopy の代わり)
+
+    * レコードとアノテーションの dict は浅いコピー (transform_instance_annotations は値を置き換えるだけ)
+    * np.ndarray のポリゴンは複製する (CropTransform などの apply_coords は座標をその場で書き換えるため)
+      リストのポリゴンは変換時に np.asarray で新しい配列になるので複製しない
+    """
+    dataset_dict = dict(dataset_dict)
+
+    annos = []
+    for obj in dataset_dict['annotations']:
+        obj = dict(obj)
+
+        if 'segmentation' in obj:
+            obj['segmentation'] = [np.array(p) if isinstance(p, np.ndarray) else p for p in obj['segmentation']]
+
+        annos.append(obj)
+
+    dataset_dict['annotations'] = annos
+
+    return dataset_dict
+
 
 class MachikadoDatasetMapper:
     """
     カスタムデータマッパー
+
+    cfg.INPUT.SEED が 0 以上で、レコードに 'sample_id' (epoch, index) があれば (build_loader の SeededTrainingSampler)、
+    水増しの乱数は (SEED, epoch, index) から決まる (同じ 'sample_id' を付けて呼べば同じ水増しを再現できる)
     """
     def __init__(self, cfg, is_train=True):
         assert cfg.MODEL.MASK_ON, '今回はセグメンテーションのみを対象にする'
@@ -21,6 +54,7 @@ class MachikadoDatasetMapper:
         self.cont_gen = None
         self.bright_gen = None
         self.sat_gen = None
+        self.photometric_gen = None
         self.cutout_gen = None
         self.extent_gen = None
         self.crop_gen = None
@@ -37,8 +71,11 @@ class MachikadoDatasetMapper:
             if cfg.INPUT.SATURATION.ENABLED:
                 self.sat_gen = T.RandomSaturation(cfg.INPUT.SATURATION.RANGE[0], cfg.INPUT.SATURATION.RANGE[1])
                 logging.getLogger(__name__).info('SatGen used in training.')
+            if cfg.INPUT.FUSED.PHOTOMETRIC:
+                self._fuse_photometric_gens(cfg)
             if cfg.INPUT.CUTOUT.ENABLED:
                 self.cutout_gen = RandomCutout(cfg.INPUT.CUTOUT.NUM_HOLE_RANGE, cfg.INPUT.CUTOUT.RADIUS_RANGE, cfg.INPUT.CUTOUT.COLOR_RANGE)
+                self.max_occluded_ratio = cfg.INPUT.CUTOUT.MAX_OCCLUDED_RATIO
                 logging.getLogger(__name__).info('CutoutGen used in training.')
             if cfg.INPUT.EXTENT.ENABLED:
                 self.extent_gen = T.RandomExtent(scale_range=(1, 1), shift_range=cfg.INPUT.EXTENT.SHIFT_RANGE)
@@ -54,50 +91,267 @@ class MachikadoDatasetMapper:
                 logging.getLogger(__name__).info('ShearGen used in training.')
 
         self.tfm_gens = utils.build_transform_gen(cfg, is_train)
+
+        # 回転・せん断・移動・切り出し・リサイズを1回のワープにまとめる
+        self.fused_affine = is_train and cfg.INPUT.FUSED.AFFINE
+        if self.fused_affine:
+            self.resize_gen = [gen for gen in self.tfm_gens if isinstance(gen, T.ResizeShortestEdge)]
+            self.resize_gen = self.resize_gen[0] if len(self.resize_gen) else None
+            self.tfm_gens = [gen for gen in self.tfm_gens if gen is not self.resize_gen]
+            logging.getLogger(__name__).info('FusedAffine used in training.')
         
+        # デコード済み画像のキャッシュ
+        self.image_cache = None
+        if cfg.INPUT.IMAGE_CACHE.ENABLED:
+            self.image_cache = ImageCache(cfg.INPUT.IMAGE_CACHE.DIR, cfg.INPUT.IMAGE_CACHE.MAX_BYTES, cfg.INPUT.IMAGE_CACHE.MAX_SIZE)
+            logging.getLogger(__name__).info('ImageCache used: ' + cfg.INPUT.IMAGE_CACHE.DIR)
+
+        # 処理段階ごとの時間計測 (無効のときはほとんどコストがかからない)
+        self.timer = StageTimer(cfg.INPUT.PROFILE.ENABLED, cfg.INPUT.PROFILE.DIR or None, cfg.INPUT.PROFILE.DUMP_EVERY)
+
+        self.seed = cfg.INPUT.SEED
         self.img_format = cfg.INPUT.FORMAT
         self.mask_format = cfg.INPUT.MASK_FORMAT
         self.is_train = is_train
 
+    def _fuse_photometric_gens(self, cfg):
+        """
+        コントラスト・明るさ・彩度を1回の画素演算 (RandomPhotometric) にまとめる
+        """
+        if all(gen is None for gen in [self.cont_gen, self.bright_gen, self.sat_gen]):
+            return
+
+        self.photometric_gen = RandomPhotometric(
+            cfg.INPUT.CONTRAST.RANGE if self.cont_gen is not None else None,
+            cfg.INPUT.BRIGHTNESS.RANGE if self.bright_gen is not None else None,
+            cfg.INPUT.SATURATION.RANGE if self.sat_gen is not None else None)
+        self.cont_gen = self.bright_gen = self.sat_gen = None
+        logging.getLogger(__name__).info('FusedPhotometric used in training.')
+
     def __call__(self, dataset_dict):
+        rng = get_sample_rng(dataset_dict, self.seed)
+        seed_global_rng(dataset_dict, self.seed)
+
+        with self.timer('read'):
+            dataset_dict, image = self._read(dataset_dict)
+
+        image = self._apply_photometric(image, rng)
+        image = self._apply_cutout(image, dataset_dict, rng)
+        seed_geometric_rng(dataset_dict, self.seed)
+        image, transforms = self._apply_geometric(image, dataset_dict, rng)
+
+        # テストの場合はアノテーションがいらないので削除して終了
+        if not self.is_train:
+            dataset_dict.pop('annotations', None)
+            dataset_dict.pop('sem_seg_file_name', None)
+            self.timer.step()
+            return dataset_dict
+
+        with self.timer('to_tensor'):
+            dataset_dict['image'] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        dataset_dict['instances'] = self._get_instances(dataset_dict.pop('annotations'), transforms, image.shape[:2])
+
+        self.timer.step()
+
+        return dataset_dict
+
+    def _read(self, dataset_dict):
+        """
+        レコードを複製して画像を読み込む
+        """
         assert 'annotations' in dataset_dict, '今回はセグメンテーションのみを対象にする'
         assert not 'sem_seg_file_name' in dataset_dict, 'パノプティックセグメンテーションは行わない'
         
-        dataset_dict = copy.deepcopy(dataset_dict)
-        
-        image = utils.read_image(dataset_dict['file_name'], format=self.img_format)
-        utils.check_image_size(dataset_dict, image)
-        
-        # 明るさ・コントラスト・彩度・カットアウト
+        dataset_dict = copy_dataset_dict(dataset_dict)  # 元のデータセットは書き換えない
+
+        # シャードのレコードは、縮小済みの画像をメモリマップからコピーせずに読む (読み込み専用)
+        if 'shard_image' in dataset_dict:
+            image = read_shard_image(dataset_dict, format=self.img_format)
+            _, new_h, new_w, _ = dataset_dict['shard_image']
+
+        elif self.image_cache is None:
+            image = utils.read_image(dataset_dict['file_name'], format=self.img_format)
+            utils.check_image_size(dataset_dict, image)
+            return dataset_dict, image
+
+        else:
+            # キャッシュの画像は読み込み専用 (メモリマップ) なので、以降の変換はコピーを返すものに限る
+            image = self.image_cache.read_image(dataset_dict['file_name'], format=self.img_format)
+            new_h, new_w = self.image_cache.get_resized_size(dataset_dict['height'], dataset_dict['width'])
+
+        assert image.shape[:2] == (new_h, new_w), '画像サイズ不整合 h:w {}:{} -> {}:{}'.format(new_h, new_w, *image.shape[:2])
+
+        # 縮小して保存されている場合は、アノテーションも縮小しておく (レコードの height, width は元の画像のもの)
+        h, w = dataset_dict['height'], dataset_dict['width']
+        if (new_h, new_w) != (h, w):
+            resize_tfm = T.ResizeTransform(h, w, new_h, new_w)
+            dataset_dict['annotations'] = [utils.transform_instance_annotations(obj, resize_tfm, (new_h, new_w))
+                                           for obj in dataset_dict['annotations']]
+
+        return dataset_dict, image
+
+    def _apply_photometric(self, image, rng):
+        """
+        明るさ・コントラスト・彩度
+        """
         if self.cont_gen is not None:
-            tfm = self.cont_gen.get_transform(image)
-            image = tfm.apply_image(image)
+            with self.timer('contrast'):
+                tfm = self.cont_gen.get_transform(image)
+                image = tfm.apply_image(image)
         if self.bright_gen is not None:
-            tfm = self.bright_gen.get_transform(image)
-            image = tfm.apply_image(image)
+            with self.timer('brightness'):
+                tfm = self.bright_gen.get_transform(image)
+                image = tfm.apply_image(image)
         if self.sat_gen is not None:
-            tfm = self.sat_gen.get_transform(image)
-            image = tfm.apply_image(image)
+            with self.timer('saturation'):
+                tfm = self.sat_gen.get_transform(image)
+                image = tfm.apply_image(image)
+        if self.photometric_gen is not None:
+            with self.timer('photometric'):
+                tfm = self.photometric_gen.get_transform(image, rng)
+                image = tfm.apply_image(image)
+
+        return image
+
+    def _apply_cutout(self, image, dataset_dict, rng):
+        """
+        カットアウト
+        """
         if self.cutout_gen is not None:
-            tfm = self.cutout_gen.get_transform(image)
-            image = tfm.apply_image(image)
-            
-        # アフィン
+            with self.timer('cutout'):
+                tfm = self.cutout_gen.get_transform(image, rng)
+                image = tfm.apply_image(image)
+
+            # 穴でほとんど隠れたインスタンスは学習に使わない
+            # (切り出しの基準には使えるように、アノテーションは消さずに iscrowd にして instances から除外する)
+            if self.max_occluded_ratio < 1:
+                with self.timer('cutout_occlusion'):
+                    annos = [obj for obj in dataset_dict['annotations'] if 'segmentation' in obj]
+                    ratios = tfm.get_occluded_ratios([obj['segmentation'] for obj in annos])
+                    for obj, ratio in zip(annos, ratios):
+                        if ratio > self.max_occluded_ratio:
+                            obj['iscrowd'] = 1
+
+        return image
+
+    def _apply_geometric(self, image, dataset_dict, rng):
+        """
+        回転・せん断・移動・切り出しと、リサイズ・反転 (tfm_gens)
+        """
+        if self.fused_affine:
+            with self.timer('affine'):
+                affine_tfm = self._get_fused_affine(image, dataset_dict, rng)
+                image = affine_tfm.apply_image(image)
+
+            with self.timer('resize_flip'):
+                image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+            transforms = affine_tfm + transforms
+        else:
+            image, transforms = self._apply_affine(image, dataset_dict, rng)
+
+        return image, transforms
+
+    def _get_instances(self, annotations, transforms, image_shape):
+        """
+        アノテーションを変換して Instances にする
+        """
+        with self.timer('transform_annotations'):
+            annos = [utils.transform_instance_annotations(obj, transforms, image_shape, keypoint_hflip_indices=None)
+                     for obj in annotations
+                     if obj.get("iscrowd", 0) == 0]
+
+        with self.timer('annotations_to_instances'):
+            instances = utils.annotations_to_instances(annos, image_shape, mask_format=self.mask_format)
+
+            # マスクからバウンディングボックスを作成
+            if (self.crop_gen or self.fused_affine) and instances.has("gt_masks"):
+                instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+
+            return utils.filter_empty_instances(instances)
+
+    def _get_fused_affine(self, image, dataset_dict, rng):
+        """
+        回転・せん断・移動・切り出し・リサイズをそれぞれのジェネレータでサンプリングして、1つの AffineTransform にまとめる
+        """
+        h, w = image.shape[:2]
+        mat = np.eye(3)
+        frame_h, frame_w = h, w  # 各段階の出力画像サイズ
+
+        def frame():
+            return np.empty((frame_h, frame_w, 0), dtype=np.uint8)  # ジェネレータはサイズしか見ないので中身のない画像を渡す
+
+        if self.rotate_gen is not None:
+            mat = to_3x3(self.rotate_gen.get_transform(frame()).rm_coords).dot(mat)
+        if self.shear_gen is not None:
+            mat = to_3x3(self.shear_gen.get_transform(frame(), rng).mat).dot(mat)
+        if self.extent_gen is not None:
+            extent_tfm = self.extent_gen.get_transform(frame())
+            x0, y0, x1, y1 = extent_tfm.src_rect
+            frame_h, frame_w = extent_tfm.output_size
+            mat = scale_matrix(frame_w / (x1 - x0), frame_h / (y1 - y0)).dot(translation_matrix(-x0, -y0)).dot(mat)
+        if self.crop_gen is not None:
+            # 切り出しに含めるインスタンスは、ここまでの変形後の位置で選ぶ
+            # (変形で枠の外に出たインスタンスを選ぶと gen_crop_transform_with_instance が失敗するので、
+            #  枠内にクリップして見えているものだけから選ぶ。1つもなければ普通にランダムに切り出す)
+            bboxes = self._get_visible_bboxes(dataset_dict['annotations'], mat, frame_h, frame_w)
+            if len(bboxes):
+                crop_tfm = utils.gen_crop_transform_with_instance(
+                    self.crop_gen.get_crop_size((frame_h, frame_w)), (frame_h, frame_w),
+                    {'bbox': bboxes[rng.integers(len(bboxes))], 'bbox_mode': BoxMode.XYXY_ABS})
+            else:
+                crop_tfm = self.crop_gen.get_transform(frame())
+            frame_h, frame_w = crop_tfm.h, crop_tfm.w
+            mat = translation_matrix(-crop_tfm.x0, -crop_tfm.y0).dot(mat)
+        if self.resize_gen is not None:
+            resize_tfm = self.resize_gen.get_transform(frame())
+            mat = scale_matrix(resize_tfm.new_w / frame_w, resize_tfm.new_h / frame_h).dot(mat)
+            frame_h, frame_w = resize_tfm.new_h, resize_tfm.new_w
+
+        return AffineTransform(h, w, mat, frame_h, frame_w)
+
+    @staticmethod
+    def _get_visible_bboxes(annotations, mat, frame_h, frame_w):
+        """
+        アノテーションのバウンディングボックスを mat で変形して、(frame_h, frame_w) の枠内にクリップする
+        枠内に面積が残るものだけを返す [n, 4] (XYXY_ABS)
+        """
+        bboxes = np.zeros((0, 4))
+        if len(annotations):
+            bboxes = np.array([BoxMode.convert(obj['bbox'], obj['bbox_mode'], BoxMode.XYXY_ABS) for obj in annotations], dtype=np.float64)
+
+        corners = bboxes[:, [0, 1, 2, 1, 0, 3, 2, 3]].reshape(-1, 4, 2)
+        corners = np.dot(corners, mat[:2, :2].T) + mat[:2, 2]
+
+        bboxes = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+        bboxes = np.clip(bboxes, 0, [frame_w, frame_h, frame_w, frame_h])
+
+        return bboxes[(bboxes[:, 2] > bboxes[:, 0]) & (bboxes[:, 3] > bboxes[:, 1])]
+
+    def _apply_affine(self, image, dataset_dict, rng):
+        """
+        アフィン変換を1つずつ順番に行う
+        """
         if self.rotate_gen is not None:
-            rotate_tfm = self.rotate_gen.get_transform(image)
-            image = rotate_tfm.apply_image(image)
+            with self.timer('rotate'):
+                rotate_tfm = self.rotate_gen.get_transform(image)
+                image = rotate_tfm.apply_image(image)
         if self.shear_gen is not None:
-            shear_tfm = self.shear_gen.get_transform(image)
-            image = shear_tfm.apply_image(image)
+            with self.timer('shear'):
+                shear_tfm = self.shear_gen.get_transform(image, rng)
+                image = shear_tfm.apply_image(image)
         if self.extent_gen is not None:
-            extent_tfm = self.extent_gen.get_transform(image)
-            image = extent_tfm.apply_image(image)
+            with self.timer('extent'):
+                extent_tfm = self.extent_gen.get_transform(image)
+                image = extent_tfm.apply_image(image)
         if self.crop_gen is not None:
-            crop_tfm = utils.gen_crop_transform_with_instance(
-                self.crop_gen.get_crop_size(image.shape[:2]), image.shape[:2], np.random.choice(dataset_dict['annotations']))
-            image = crop_tfm.apply_image(image)
+            with self.timer('crop'):
+                crop_tfm = utils.gen_crop_transform_with_instance(
+                    self.crop_gen.get_crop_size(image.shape[:2]), image.shape[:2],
+                    dataset_dict['annotations'][rng.integers(len(dataset_dict['annotations']))])
+                image = crop_tfm.apply_image(image)
         
-        image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+        with self.timer('resize_flip'):
+            image, transforms = T.apply_transform_gens(self.tfm_gens, image)
         
         if self.crop_gen is not None:
             transforms = crop_tfm + transforms
@@ -108,25 +362,4 @@ class MachikadoDatasetMapper:
         if self.rotate_gen is not None:
             transforms = rotate_tfm + transforms
 
-        # テストの場合はアノテーションがいらないので削除して終了
-        if not self.is_train:
-            dataset_dict.pop('annotations', None)
-            dataset_dict.pop('sem_seg_file_name', None)
-            return dataset_dict
-
-        image_shape = image.shape[:2]  # h, w
-        dataset_dict['image'] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
-
-        annos = [utils.transform_instance_annotations(obj, transforms, image_shape, keypoint_hflip_indices=None)
-                 for obj in dataset_dict.pop('annotations')
-                 if obj.get("iscrowd", 0) == 0]
-
-        instances = utils.annotations_to_instances(annos, image_shape, mask_format=self.mask_format)
-
-        # マスクからバウンディングボックスを作成
-        if self.crop_gen and instances.has("gt_masks"):
-            instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
-
-        dataset_dict["instances"] = utils.filter_empty_instances(instances)
-
-        return dataset_dict
\ No newline at end of file
+        return image, transforms
\ No newline at end of file
@@ -0,0 +1,118 @@
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import torch
+
+from detectron2.engine import DefaultPredictor
+
+from .Machikado_vott import _read_image_size
+
+
+class MachikadoPredictor(DefaultPredictor):
+    """
+    複数の画像をまとめて推論する Predictor
+
+        predictor = MachikadoPredictor(cfg, batch_size=4)
+        outputs = predictor([cv2.imread(file_name) for file_name in file_names])  # ファイル名のリストでもよい
+
+    * リサイズ後の縦横比が近い画像同士をバッチにまとめる (バッチ内で最大の画像に合わせるパディングを減らす)
+    * 画像の読み込み・前処理 (BGR -> RGB, ResizeShortestEdge, float32) はスレッドプールで行い、モデルの推論と重ねる
+    * 結果は入力の順番で返す (instances は GPU のメモリを使い続けないように CPU に移す)
+    """
+    def __init__(self, cfg, batch_size=2, num_workers=4, prefetch=2, bucketing=True):
+        """
+        batch_size: 1回の推論にまとめる画像数
+        num_workers: 前処理に使うスレッド数
+        prefetch: 推論中に前処理を進めておくバッチ数
+        bucketing: リサイズ後の縦横比でバッチを組む (False なら入力の順番のまま)
+        """
+        super().__init__(cfg)
+
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.bucketing = bucketing
+
+    def get_resized_size(self, h, w):
+        """
+        (h, w) の画像が前処理でリサイズされるサイズ (new_h, new_w)
+        """
+        tfm = self.transform_gen.get_transform(np.empty((h, w, 0), dtype=np.uint8))  # サイズしか見ないので中身のない画像を渡す
+
+        return tfm.new_h, tfm.new_w
+
+    def make_batches(self, sizes):
+        """
+        元画像のサイズ (h, w) のリストから、バッチごとの入力の番号のリストを作る
+        """
+        order = list(range(len(sizes)))
+
+        if self.bucketing:
+            resized = [self.get_resized_size(h, w) for h, w in sizes]
+            order.sort(key=lambda i: (resized[i][1] / resized[i][0], resized[i]))
+
+        return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+    @staticmethod
+    def _get_size(image):
+        if isinstance(image, np.ndarray):
+            return image.shape[:2]
+
+        w, h = _read_image_size(image)  # ヘッダを読むだけ (EXIF の回転は考慮しないので、バッチの組み方にだけ使う)
+        return h, w
+
+    def _preprocess(self, image):
+        """
+        1枚分の前処理 (スレッドプールから呼ばれる)
+        image: BGR の画像 (cv2.imread の結果) またはファイル名
+        """
+        if not isinstance(image, np.ndarray):
+            file_name = image
+            image = cv2.imread(file_name)
+            assert image is not None, '画像を読み込めない: {}'.format(file_name)
+
+        height, width = image.shape[:2]
+
+        if self.input_format == 'RGB':
+            image = image[:, :, ::-1]
+
+        image = self.transform_gen.get_transform(image).apply_image(image)  # ResizeShortestEdge
+        image = torch.as_tensor(image.astype('float32').transpose(2, 0, 1))
+
+        return {'image': image, 'height': height, 'width': width}
+
+    def __call__(self, org_images):
+        """
+        org_images: BGR の画像 [h, w, ch] またはファイル名のリスト (画像ごとにサイズが違ってよい)
+        """
+        batches = self.make_batches([self._get_size(image) for image in org_images])
+        predictions = [None] * len(org_images)
+
+        with torch.no_grad(), ThreadPoolExecutor(max(1, self.num_workers)) as executor:
+            pending = collections.deque()
+
+            def submit(batch):
+                pending.append((batch, [executor.submit(self._preprocess, org_images[i]) for i in batch]))
+
+            # prefetch バッチ分先まで前処理を投げておき、1バッチ推論するごとに1バッチ追加する
+            batch_iter = iter(batches)
+            for batch in itertools.islice(batch_iter, self.prefetch + 1):
+                submit(batch)
+
+            while pending:
+                batch, futures = pending.popleft()
+                inputs = [future.result() for future in futures]
+
+                next_batch = next(batch_iter, None)
+                if next_batch is not None:
+                    submit(next_batch)
+
+                outputs = self.model(inputs)
+
+                for i, output in zip(batch, outputs):
+                    output['instances'] = output['instances'].to('cpu')  # ずーっと GPU においてはダメ！
+                    predictions[i] = output
+
+        return predictions
@@ -2,99 +2,443 @@ import numpy as np
 import os
 import json
 import random
+import pickle
+import hashlib
+import itertools
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+from logging import getLogger, StreamHandler, INFO
+logger = getLogger(__name__)
+handler = StreamHandler()
+handler.setLevel(INFO)
+logger.setLevel(INFO)
+logger.addHandler(handler)
+logger.propagate = False
+
 from detectron2.structures import BoxMode
 
+try:
+    import ijson  # 大きなエクスポートファイルを少しずつ読む場合に使う (任意)
+except ImportError:
+    ijson = None
+
+# キャッシュファイルの形式が変わったら上げる
+CACHE_VERSION = 3
+
 # #############################################################################
-# エクスポートファイルからカテゴリ名を調べる
-def get_cat_names(export_filename):
-    with open(export_filename, 'r') as f:
-        json_data = json.load(f)
-        
+# タグ情報からカテゴリ名・色を作る
+def _parse_tags(tags):
     cat_name2id = OrderedDict()
     cat_id2name = OrderedDict()
+    cat_ids = []
+    cat_colors = []
 
-    for i, node in enumerate(json_data['tags']):
+    for i, node in enumerate(tags):
         cat_name2id[node['name']] = i
         cat_id2name[i] = node['name']
-    
+        cat_ids.append(node['name'])
+
+        c = node['color']
+        cat_colors.append([int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16)])
+
+    return cat_name2id, cat_id2name, cat_ids, np.asarray(cat_colors).astype(np.float)
+
+# エクスポートファイルからカテゴリ名を調べる
+def get_cat_names(export_filename, cache_filename=None):
+    tags = _load_cached_tags(export_filename, cache_filename)
+
+    if tags is None:
+        with open(export_filename, 'r') as f:
+            tags = json.load(f)['tags']
+
+    cat_name2id, cat_id2name, _, _ = _parse_tags(tags)
+
     return cat_name2id, cat_id2name
 
 # VoTT のタグ色を読み込む
-def get_cat_color(export_filename):
-    with open(export_filename, 'r') as f:
-        json_data = json.load(f)
-        
-    cat_ids = []
-    cat_colors = []
+def get_cat_color(export_filename, cache_filename=None):
+    tags = _load_cached_tags(export_filename, cache_filename)
 
-    for i, node in enumerate(json_data['tags']):
-        cat_ids.append(node['name'])
+    if tags is None:
+        with open(export_filename, 'r') as f:
+            tags = json.load(f)['tags']
 
-        c = node['color']
-        cat_colors.append([int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16)])
-    
-    return cat_ids, np.asarray(cat_colors).astype(np.float)
+    _, _, cat_ids, cat_colors = _parse_tags(tags)
+
+    return cat_ids, cat_colors
 
 # #############################################################################
-# machikado用にアレンジした読み込み関数
-def get_machikado_dicts(export_filename, image_dirname, cat_name2id):
-    with open(export_filename, 'r') as f:
-        json_data = json.load(f, object_pairs_hook=OrderedDict) # データ順を固定しておく
-    
-    assets = json_data['assets']
+# 画像サイズを取得する (ヘッダを読むだけでデコードはしない)
+def _read_image_size(file_name):
+    with Image.open(file_name) as im:
+        return im.size
 
-    dataset_dicts = []
-    for item in assets.values():
-        asset = item['asset']
-        regions = item['regions']
-
-        if len(regions) == 0:
-            print('警告: name: {} - 領域データが空だったのでスキップ'.format(asset['name']))
-            continue
-            
-        # 画像サイズを取得し確認する
-        # （VoTT でアノテーション中画像を差し替えると画像のサイズが古い画像のままになるので修正する）
-        file_name = os.path.join(image_dirname, asset['name'])
-        im = Image.open(file_name)
-        w, h = im.size
-        
-        if asset['size']['height'] != h or asset['size']['width'] != w:
-            print('警告: name: {} - 画像サイズが不一致であるためスキップ image_size:({}, {}), {}: ({}, {})'.format(
-                asset['name'], asset['size']['width'], asset['size']['height'], export_filename, w, h))
-            continue
-        
-        record = {}
-        record['file_name'] = file_name
-        record['height'] = h
-        record['width'] = w
-
-        objs = []
-        for region in regions:
-            points = region['points']
-            assert len(points), '座標データが無い！'
-
-            if len(region['tags']) > 1:
-                print('警告: name: {} - 複数のタグを確認！ tags: {}'.format(asset['name'], region['tags']))
+# 複数のファイルに func をスレッドで並行して適用する (結果は file_names の順番)
+def _map_files(func, file_names, num_workers):
+    if num_workers <= 1 or len(file_names) <= 1:
+        return [func(file_name) for file_name in file_names]
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        return list(executor.map(func, file_names))
+
+# 複数の画像サイズをスレッドで並行して取得する (結果は file_names の順番)
+def _read_image_sizes(file_names, num_workers):
+    return _map_files(_read_image_size, file_names, num_workers)
+
+# 画像サイズを確認して、スキップする場合はその情報を返す
+# （VoTT でアノテーション中画像を差し替えると画像のサイズが古い画像のままになるので修正する）
+def _check_asset(asset, regions, image_size):
+    if len(regions) == 0:
+        return {'name': asset['name'], 'reason': 'empty', 'vott_size': None, 'image_size': None}
 
+    w, h = image_size
+
+    if asset['size']['height'] != h or asset['size']['width'] != w:
+        return {'name': asset['name'], 'reason': 'size_mismatch',
+                'vott_size': (asset['size']['width'], asset['size']['height']), 'image_size': (w, h)}
+
+    return None
+
+def _warn_skipped(skipped, export_filename):
+    if skipped['reason'] == 'empty':
+        logger.warning('警告: name: {} - 領域データが空だったのでスキップ'.format(skipped['name']))
+    else:
+        logger.warning('警告: name: {} - 画像サイズが不一致であるためスキップ image_size:({}, {}), {}: ({}, {})'.format(
+            skipped['name'], *skipped['vott_size'], export_filename, *skipped['image_size']))
+
+# アセットから detectron2 のレコードを作る
+# polygon_format: 'array' ポリゴンとバウンディングボックスを float32 の np.ndarray にする
+#                          (バウンディングボックスは XYXY_ABS。BoxMode.convert は1次元配列の XYWH を変換できないため)
+#                 'list'  従来どおり float のリストにする
+def _make_record(asset, regions, file_name, image_size, cat_name2id, polygon_format='array'):
+    w, h = image_size
+
+    record = {}
+    record['file_name'] = file_name
+    record['height'] = h
+    record['width'] = w
+
+    objs = []
+    for region in regions:
+        points = region['points']
+        assert len(points), '座標データが無い！'
+
+        if len(region['tags']) > 1:
+            logger.warning('警告: name: {} - 複数のタグを確認！ tags: {}'.format(asset['name'], region['tags']))
+
+        bbox = region['boundingBox']
+
+        if polygon_format == 'array':
+            poly = np.array([[pt['x'], pt['y']] for pt in points], dtype=np.float32).reshape(-1)
+            obj = {
+                'bbox': np.array([bbox['left'], bbox['top'], bbox['left'] + bbox['width'], bbox['top'] + bbox['height']], dtype=np.float32),
+                'bbox_mode': BoxMode.XYXY_ABS,
+            }
+        elif polygon_format == 'list':
             poly = []
             for pt in points:
                 poly += [pt['x'], pt['y']]
 
-            bbox = region['boundingBox']
-
             obj = {
                 'bbox': [bbox['left'], bbox['top'], bbox['width'], bbox['height']],
                 'bbox_mode': BoxMode.XYWH_ABS, # XYWH_REL はまだサポートされていないらしい
-                'segmentation': [poly],
-                'category_id': cat_name2id[region['tags'][0]],
-                'iscrowd': 0
             }
-            objs.append(obj)
+        else:
+            raise ValueError('不明な polygon_format: {}'.format(polygon_format))
+
+        obj['segmentation'] = [poly]
+        obj['category_id'] = cat_name2id[region['tags'][0]]
+        obj['iscrowd'] = 0
+        objs.append(obj)
+
+    record['annotations'] = objs
+
+    return record
+
+# #############################################################################
+# キャッシュ
+def _file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+# 画像が変わったかどうかの判定に使う (更新時刻, ファイルサイズ)
+def _image_stamp(file_name):
+    st = os.stat(file_name)
+    return (st.st_mtime_ns, st.st_size)
+
+def _read_cache(cache_filename):
+    if cache_filename is None or not os.path.exists(cache_filename):
+        return None
+
+    try:
+        with open(cache_filename, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        logger.warning('警告: キャッシュが読めないので作り直す {}'.format(cache_filename))
+        return None
+
+    if cache.get('version') != CACHE_VERSION:
+        return None
+
+    return cache
+
+def _write_cache(cache_filename, cache):
+    tmp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, cache_filename)  # 書き込み途中のファイルを読まないように
+
+def _load_cached_tags(export_filename, cache_filename):
+    cache = _read_cache(cache_filename)
+
+    if cache is None or cache['export_hash'] != _file_hash(export_filename):
+        return None
+
+    return cache['tags']
+
+def load_machikado_export(export_filename, image_dirname, cache_filename=None, num_workers=8, cat_name2id=None,
+                          polygon_format='array'):
+    """
+    エクスポートファイルを読み込んで、カテゴリと detectron2 用のデータセットをまとめて返す
+
+    cache_filename を指定すると、読み込み結果をキャッシュする
+      * エクスポートファイルのハッシュが同じなら JSON は読まない
+      * 画像は (更新時刻, ファイルサイズ) を記録して、変わった画像だけサイズを確認しなおす
+    num_workers: 画像サイズの確認を並行して行うスレッド数 (1 なら逐次)
+    cat_name2id: カテゴリ ID の対応 (None ならエクスポートファイルのタグ順)
+    polygon_format: 'array' ポリゴン・バウンディングボックスを float32 の np.ndarray にする
+                    'list'  従来どおりのリスト形式 (バウンディングボックスは XYWH_ABS)
+
+    Returns:
+        dict -- cat_name2id, cat_id2name, cat_ids, cat_colors, dataset_dicts,
+                skipped (スキップしたアセットの情報 [{'name', 'reason', 'vott_size', 'image_size'}, ...])
+    """
+    export_hash = _file_hash(export_filename) if cache_filename is not None else None
+    cache = _read_cache(cache_filename)
+
+    old_assets = cache['assets'] if cache is not None and cache['image_dirname'] == image_dirname else {}
+
+    # エクスポートファイルが同じならレコードごと使い回す
+    # 変わった場合も、画像が同じならサイズの確認結果は使い回す
+    reuse_records = cache is not None and cache['export_hash'] == export_hash and len(old_assets) > 0
+    reuse_records = reuse_records and cache['polygon_format'] == polygon_format
+
+    if reuse_records:
+        tags = cache['tags']
+        items = [(entry['asset'], entry['regions']) for entry in old_assets.values()]
+    else:
+        with open(export_filename, 'r') as f:
+            json_data = json.load(f, object_pairs_hook=OrderedDict) # データ順を固定しておく
+
+        tags = json_data['tags']
+        items = [(item['asset'], item['regions']) for item in json_data['assets'].values()]
+
+    tag_name2id, cat_id2name, cat_ids, cat_colors = _parse_tags(tags)
+
+    if cat_name2id is None:
+        cat_name2id = tag_name2id
+    elif cat_name2id != tag_name2id:
+        reuse_records = False  # カテゴリ ID が違うのでレコードは作り直す
+        cache_filename = None
+
+    # 1. 使い回せないアセットを調べる
+    # (更新時刻はキャッシュとの比較にしか使わないので、キャッシュを使う場合だけスレッドで並行して調べる)
+    file_names = [os.path.join(image_dirname, asset['name']) for asset, _ in items]
+    stamps = [None] * len(items)
+    if cache_filename is not None:
+        stat_indices = [i for i, (_, regions) in enumerate(items) if len(regions)]
+        for i, stamp in zip(stat_indices, _map_files(_image_stamp, [file_names[i] for i in stat_indices], num_workers)):
+            stamps[i] = stamp
+    olds = [old_assets.get(asset['id']) for asset, _ in items]
+
+    reused = [reuse_records and old['stamp'] == stamp for old, stamp in zip(olds, stamps)]
+    image_sizes = [old['image_size'] if old is not None and old['stamp'] == stamp else None
+                   for old, stamp in zip(olds, stamps)]
+
+    # 2. サイズが分からない画像だけ、まとめて並行に確認する
+    probe_indices = [i for i, (_, regions) in enumerate(items) if not reused[i] and len(regions) and image_sizes[i] is None]
+    for i, image_size in zip(probe_indices, _read_image_sizes([file_names[i] for i in probe_indices], num_workers)):
+        image_sizes[i] = image_size
+
+    # 3. レコードを作る (順番はエクスポートファイルのまま)
+    assets = OrderedDict()
+    dataset_dicts = []
+    skipped = []
+    for i, (asset, regions) in enumerate(items):
+        if reused[i]:
+            entry = olds[i]
+        else:
+            # 新しいアセットか、画像かアノテーションが変わった
+            skip = _check_asset(asset, regions, image_sizes[i])
+            record = None if skip is not None else _make_record(asset, regions, file_names[i], image_sizes[i], cat_name2id,
+                                                                polygon_format=polygon_format)
+
+            entry = {'asset': asset, 'regions': regions, 'stamp': stamps[i], 'image_size': image_sizes[i],
+                     'record': record, 'skipped': skip}
+
+        assets[asset['id']] = entry
+
+        if entry['skipped'] is not None:
+            _warn_skipped(entry['skipped'], export_filename)
+            skipped.append(entry['skipped'])
+        else:
+            dataset_dicts.append(entry['record'])
+
+    if cache_filename is not None and not all(reused):
+        _write_cache(cache_filename, {'version': CACHE_VERSION, 'export_hash': export_hash, 'image_dirname': image_dirname,
+                                      'polygon_format': polygon_format, 'tags': tags, 'assets': assets})
+
+    return {'cat_name2id': cat_name2id, 'cat_id2name': cat_id2name, 'cat_ids': cat_ids, 'cat_colors': cat_colors,
+            'dataset_dicts': dataset_dicts, 'skipped': skipped}
+
+# #############################################################################
+# machikado用にアレンジした読み込み関数
+def get_machikado_dicts(export_filename, image_dirname, cat_name2id, cache_filename=None, num_workers=8, return_skipped=False,
+                        polygon_format='array'):
+    """
+    num_workers: 画像サイズの確認を並行して行うスレッド数
+    polygon_format: 'array' ポリゴン・バウンディングボックスを float32 の np.ndarray にする / 'list' 従来のリスト形式
+    return_skipped: True なら (dataset_dicts, スキップしたアセットの情報のリスト) を返す
+
+    export_filename にシャードファイル (.shard, machikado_shard で作成) を指定した場合は、シャードから読む
+    (image_dirname, cache_filename, num_workers, polygon_format は使わない。
+     カテゴリ ID はシャード作成時のものなので、cat_name2id と違う場合はエラーにする。None なら照合しない)
+    """
+    if export_filename.endswith('.shard'):
+        from .machikado_shard import get_shard_dicts, get_shard_cat_names
+
+        shard_name2id, _ = get_shard_cat_names(export_filename)
+        assert cat_name2id is None or dict(cat_name2id) == shard_name2id, \
+            'シャードのカテゴリ ID が cat_name2id と違う (シャードを作り直す): {} -> {}'.format(shard_name2id, dict(cat_name2id))
+
+        dataset_dicts = get_shard_dicts(export_filename)
+        return (dataset_dicts, []) if return_skipped else dataset_dicts
+
+    data = load_machikado_export(export_filename, image_dirname, cache_filename=cache_filename,
+                                 num_workers=num_workers, cat_name2id=cat_name2id, polygon_format=polygon_format)
+
+    if return_skipped:
+        return data['dataset_dicts'], data['skipped']
+
+    return data['dataset_dicts']
+
+# #############################################################################
+# エクスポートファイルを1回だけ読み込むローダー
+def _read_tags_stream(export_filename):
+    """
+    エクスポートファイルを ijson で先頭から読み、tags の配列が終わったところで読むのをやめる
+    (VoTT は tags を assets より前に書き出すので、assets はここでは読まない)
+    """
+    with open(export_filename, 'rb') as f:
+        builder = None
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == 'tags' and event == 'start_array':
+                builder = ijson.ObjectBuilder()
+
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == 'tags' and event == 'end_array':
+                    return builder.value
+
+    return []
+
+class MachikadoVott:
+    """
+    VoTT のエクスポートファイルを1回だけ読み込んで、カテゴリ名・色・データセットをまとめて提供する
+
+        vott = MachikadoVott(export_filename, image_dirname)
+        CAT_NAME2ID, CAT_ID2NAME = vott.cat_name2id, vott.cat_id2name
+        CAT_IDS, CAT_COLORS = vott.cat_ids, vott.cat_colors
+        dataset_dicts = vott.get_dicts()
+
+    streaming=True の場合は ijson で少しずつ読み、レコードは iter_dicts() で1件ずつ作る。
+    エクスポートファイル全体をメモリに持たないので、巨大なエクスポートファイルでもメモリが増えない
+    (作成時には先頭の tags だけを読み、assets を読むのは iter_dicts() のときの1回だけ)
+    """
+    def __init__(self, export_filename, image_dirname, cache_filename=None, num_workers=8, streaming=False,
+                 polygon_format='array'):
+        self.export_filename = export_filename
+        self.image_dirname = image_dirname
+        self.num_workers = num_workers
+        self.polygon_format = polygon_format
+        self.skipped = []
+
+        if streaming and ijson is None:
+            logger.warning('警告: ijson がインストールされていないので、通常の読み込みを行う')
+            streaming = False
+
+        assert not (streaming and cache_filename is not None), 'streaming とキャッシュは同時に使えない'
+        self.streaming = streaming
+
+        if streaming:
+            tags = _read_tags_stream(export_filename)
+
+            self.cat_name2id, self.cat_id2name, self.cat_ids, self.cat_colors = _parse_tags(tags)
+            self._dataset_dicts = None
+        else:
+            data = load_machikado_export(export_filename, image_dirname, cache_filename=cache_filename, num_workers=num_workers,
+                                         polygon_format=polygon_format)
+
+            self.cat_name2id, self.cat_id2name = data['cat_name2id'], data['cat_id2name']
+            self.cat_ids, self.cat_colors = data['cat_ids'], data['cat_colors']
+            self._dataset_dicts = data['dataset_dicts']
+            self.skipped = data['skipped']
+
+    def _iter_items(self):
+        with open(self.export_filename, 'rb') as f:
+            for _, item in ijson.kvitems(f, 'assets', use_float=True):
+                yield item['asset'], item['regions']
+
+    def _iter_stream(self, chunk_size):
+        self.skipped = []
+        items = self._iter_items()
+
+        # 画像サイズの確認を並行して行うため、chunk_size 件ずつまとめて処理する
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if len(chunk) == 0:
+                break
+
+            file_names = [os.path.join(self.image_dirname, asset['name']) for asset, _ in chunk]
+            probe_indices = [i for i, (_, regions) in enumerate(chunk) if len(regions)]
+            image_sizes = [None] * len(chunk)
+
+            for i, image_size in zip(probe_indices, _read_image_sizes([file_names[i] for i in probe_indices], self.num_workers)):
+                image_sizes[i] = image_size
+
+            for (asset, regions), file_name, image_size in zip(chunk, file_names, image_sizes):
+                skip = _check_asset(asset, regions, image_size)
+
+                if skip is not None:
+                    _warn_skipped(skip, self.export_filename)
+                    self.skipped.append(skip)
+                    continue
+
+                yield _make_record(asset, regions, file_name, image_size, self.cat_name2id, polygon_format=self.polygon_format)
+
+    def iter_dicts(self):
+        """
+        レコードを1件ずつ返す (streaming の場合は読みながら作る)
+        DatasetCatalog.register('test', vott.iter_dicts) のように、評価用の登録に使える
+        ※訓練 (build_detection_train_loader) にはリストが必要なので get_dicts() を使う
+        """
+        if self._dataset_dicts is not None:
+            return iter(self._dataset_dicts)
+
+        return self._iter_stream(chunk_size=max(1, self.num_workers) * 4)
+
+    def get_dicts(self):
+        """
+        レコードのリストを返す
+        """
+        if self._dataset_dicts is None:
+            return list(self.iter_dicts())
 
-        record['annotations'] = objs
-        dataset_dicts.append(record)
-        
-    return dataset_dicts
\ No newline at end of file
+        return self._dataset_dicts
@@ -0,0 +1,106 @@
+import numpy as np
+import cv2
+
+from fvcore.transforms.transform import Transform
+from detectron2.data import transforms as T
+
+from .sample_rng import as_generator
+
+
+# RandomSaturation と同じグレースケールの重み
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+class PhotometricTransform(Transform):
+    """
+    コントラスト・明るさ・彩度の変更を1回の画素演算にまとめたカスタムトランスフォーム
+
+        out = alpha * img + beta * gray(img) + offset
+
+    RandomContrast -> RandomBrightness -> RandomSaturation を順番にかけたものと同じ式になる
+    (途中で 0-255 にクリップしないので、白飛び・黒つぶれする画素だけ結果が少し異なる)
+    """
+    def __init__(self, alpha: float, beta: float, offset: float, gray_weights=GRAY_WEIGHTS):
+        """
+        alpha: 元画像の重み
+        beta: グレースケール画像の重み
+        offset: 全画素に加える値
+        gray_weights: グレースケールを求める各チャンネルの重み
+        """
+        super().__init__()
+        self._set_attributes(locals())
+
+        # 3x4 の色変換行列 (各出力チャンネル = alpha * 自チャンネル + beta * gray + offset)
+        self.mat = np.hstack([alpha * np.eye(3) + beta * np.tile(np.asarray(gray_weights, dtype=np.float64), (3, 1)),
+                              np.full((3, 1), offset)])
+
+    def apply_image(self, img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """イメージの変換を行う
+
+        Arguments:
+            img {np.ndarray} -- 元イメージ
+            out {np.ndarray} -- 出力先 (img と同じ形・型であれば img を指定して上書きしてもよい)
+
+        Returns:
+            np.ndarray -- 変換されたイメージ (uint8 の場合は 0-255 に丸められる)
+        """
+        assert len(img.shape) == 3 and img.shape[2] == 3, '3ch のカラー画像のみを対象とする'
+
+        if img.dtype == np.uint8:
+            return cv2.transform(img, self.mat, dst=out)  # uint8 のまま1パスで変換 (飽和演算)
+
+        return cv2.transform(img.astype(np.float32, copy=False), self.mat.astype(np.float32), dst=out)
+
+    def apply_coords(self, coords: np.ndarray) -> np.ndarray:
+        return coords
+
+    def apply_segmentation(self, segmentation: np.ndarray) -> np.ndarray:
+        return segmentation
+
+
+class RandomPhotometric(T.TransformGen):
+    """
+    コントラスト・明るさ・彩度をランダムに変更するジェネレータ
+    範囲を None にした変更は行わない
+    """
+    def __init__(self, contrast_range=None, brightness_range=None, saturation_range=None):
+        """
+        contrast_range: コントラストの重みの範囲(min, max) ※RandomContrast と同じ
+        brightness_range: 明るさの重みの範囲(min, max) ※RandomBrightness と同じ
+        saturation_range: 彩度の重みの範囲(min, max) ※RandomSaturation と同じ
+        """
+        super().__init__()
+        self._init(locals())
+
+    def get_transform(self, img, rng=None):
+        """
+        rng: 乱数生成器 (np.random.Generator)。None ならグローバルの乱数から作る
+        """
+        return self.make_transform(img, *self.sample_weights(1, rng)[0])
+
+    def sample_weights(self, num, rng=None):
+        """
+        num 枚分のコントラスト・明るさ・彩度の重みを配列でまとめて引く [num, 3]
+        ※個別のジェネレータと同じ順番で乱数を引く
+        """
+        rng = as_generator(rng)
+        weights = np.ones((num, 3))
+
+        for i, weight_range in enumerate([self.contrast_range, self.brightness_range, self.saturation_range]):
+            if weight_range is not None:
+                weights[:, i] = rng.uniform(weight_range[0], weight_range[1], num)
+
+        return weights
+
+    def make_transform(self, img, w_cont, w_bright, w_sat):
+        """
+        引いた重みから img に対するトランスフォームを作る (乱数は使わないのでスレッドから呼んでもよい)
+        """
+        # コントラストは画像全体の平均値に寄せる
+        mean = np.mean(cv2.mean(img)[:img.shape[2]]) if self.contrast_range is not None else 0
+
+        alpha = w_cont * w_bright * w_sat
+        beta = w_cont * w_bright * (1 - w_sat)
+        offset = w_bright * (1 - w_cont) * mean
+
+        return PhotometricTransform(alpha, beta, offset)
@@ -0,0 +1,257 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import torch
+
+from detectron2.structures import Boxes, Instances
+
+from .RLEMask import RLEMask
+from .Machikado_vott import _file_hash
+
+
+# 推論結果に影響しない設定 (キャッシュのキーに含めない)
+IGNORED_CFG_KEYS = ['MODEL.WEIGHTS', 'MODEL.DEVICE', 'MODEL.ROI_HEADS.SCORE_THRESH_TEST']
+
+
+class PredictionCache:
+    """
+    推論結果のキャッシュ
+
+        cache = PredictionCache('./output/pred_cache', cfg)
+        predictor = MachikadoPredictor(cache.inference_cfg())  # floor_score まで残す設定で推論する
+        pred_dicts = predict_datas_batch(predictor, 'test', cache=cache, score_thresh=0.7)
+
+    (重みファイルのハッシュ, 設定のハッシュ) ごとのディレクトリに、画像のハッシュごとの .npz を書き出す。
+    floor_score 以上の検出 (クラス・スコア・ボックス・ランレングスのマスク) を全て保存しておき、
+    読み出すときにスコアのしきい値で絞り込むので、しきい値を変えても推論し直さない (画像が変わったものだけ推論する)
+
+    ※ SCORE_THRESH_TEST より低い検出は NMS で高い検出を消さないので、しきい値以上の検出は推論し直した場合と同じになる
+      (TEST.DETECTIONS_PER_IMAGE の上限にかかる場合だけ、低いスコアの分で枠が埋まることがある)
+    ※ 推論した predictor の SCORE_THRESH_TEST が floor_score より高いと、それより低い検出は残っていないので、
+      画像ごとに実際に保存できた最低スコア (floor) も書き出しておき、それより低いしきい値の get はキャッシュにないものとして扱う
+      (推論し直して put で上書きする。get を通さずに to_pred_dict などに渡した場合はエラーにする)
+    """
+    def __init__(self, cache_dir, cfg, floor_score=0.05):
+        """
+        cache_dir: キャッシュを置くディレクトリ
+        cfg: 推論に使う設定 (MODEL.WEIGHTS の重みファイルもキーに含める)
+        floor_score: 保存する検出の最低スコア
+        """
+        self.cfg = cfg
+        self.floor_score = floor_score
+        self.score_thresh = cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST  # 読み出すときのデフォルトのしきい値
+
+        self.model_key = self._model_key(cfg, floor_score)
+        self.cache_dir = os.path.join(cache_dir, self.model_key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._file_keys = {}  # (ファイル名, 更新時刻, サイズ) -> 画像のハッシュ
+
+    @staticmethod
+    def _model_key(cfg, floor_score):
+        # 重みはファイルの中身、設定は推論に関係するものだけを見る
+        weights = cfg.MODEL.WEIGHTS
+        weights_key = _file_hash(weights) if os.path.isfile(weights) else weights
+
+        key_cfg = cfg.clone()
+        key_cfg.defrost()
+        for key in IGNORED_CFG_KEYS:
+            node, name = key_cfg, key.split('.')
+            for n in name[:-1]:
+                node = node[n]
+            node[name[-1]] = None
+
+        key = '{}|{}|{}|{}'.format(weights_key, key_cfg.MODEL.dump(), key_cfg.TEST.dump(), floor_score)
+        key += '|{}|{}|{}'.format(cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST, cfg.INPUT.FORMAT)
+
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def inference_cfg(self):
+        """
+        floor_score 以上の検出を全て残す推論用の設定 (predictor はこの設定で作る)
+        """
+        cfg = self.cfg.clone()
+        cfg.defrost()
+        cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = min(self.floor_score, cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST)
+
+        return cfg
+
+    def image_key(self, image):
+        """
+        画像のハッシュ
+        image: ファイル名 (ファイルの中身のハッシュ) または画像 (画素のハッシュ)
+        """
+        if isinstance(image, np.ndarray):
+            h = hashlib.sha1('{}|{}|'.format(image.shape, image.dtype).encode('utf-8'))
+            h.update(np.ascontiguousarray(image).data)
+            return 'a' + h.hexdigest()
+
+        st = os.stat(image)
+        stamp = (os.path.abspath(image), st.st_mtime_ns, st.st_size)
+
+        if stamp not in self._file_keys:
+            self._file_keys[stamp] = 'f' + _file_hash(image)
+
+        return self._file_keys[stamp]
+
+    def get_min_score(self, predictor):
+        """
+        predictor の出力に含まれる検出の最低スコア (put に渡す)
+        cfg を持たない predictor は、キャッシュを作った設定 (SCORE_THRESH_TEST) で推論したものとみなす
+        """
+        cfg = getattr(predictor, 'cfg', None)
+        score_thresh = cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST if cfg is not None else self.score_thresh
+
+        return max(self.floor_score, score_thresh)
+
+    def _cache_filename(self, image_key):
+        return os.path.join(self.cache_dir, image_key + '.npz')
+
+    def get(self, image_key, score_thresh=None):
+        """
+        キャッシュされた検出 (encode_output の形式)。なければ None
+        score_thresh: 読み出すときのしきい値 (None なら SCORE_THRESH_TEST)。これより低い検出が残っていない場合も None
+        """
+        try:
+            with np.load(self._cache_filename(image_key)) as data:
+                data = dict(data)
+        except (FileNotFoundError, ValueError, OSError):  # 未作成・書き込み途中で壊れた
+            return None
+
+        if 'floor' not in data:  # 最低スコアを記録していない古いファイルは、推論し直す
+            return None
+        if float(data['floor']) > self._get_score_thresh(score_thresh):  # しきい値より高いスコアで推論したものは使えない
+            return None
+
+        height, width = int(data['height']), int(data['width'])
+        offsets = np.r_[0, np.cumsum(data['num_runs'])]
+        masks = [RLEMask(height, width, data['starts'][s:e], data['lengths'][s:e]) for s, e in zip(offsets[:-1], offsets[1:])]
+
+        return {'classes': data['classes'], 'scores': data['scores'], 'boxes': data['boxes'], 'masks': masks,
+                'height': height, 'width': width, 'floor': float(data['floor'])}
+
+    def encode_output(self, output, min_score=None):
+        """
+        predictor の出力を、floor_score 以上の検出だけの保存形式にする (マスクはランレングス)
+        min_score: predictor の出力に含まれる検出の最低スコア (get_min_score。None なら floor_score)
+        """
+        instances = output['instances'].to('cpu')
+        keep = (instances.scores >= self.floor_score).numpy()
+        height, width = instances.image_size
+
+        return {
+            'classes': instances.pred_classes.numpy()[keep].astype(np.int64),
+            'scores': instances.scores.numpy()[keep].astype(np.float32),
+            'boxes': instances.pred_boxes.tensor.numpy()[keep].astype(np.float32).reshape(-1, 4),
+            'masks': [RLEMask.from_dense(mask) for mask in instances.pred_masks.numpy()[keep]],
+            'height': height,
+            'width': width,
+            'floor': max(self.floor_score, min_score if min_score is not None else self.floor_score),
+        }
+
+    def put(self, image_key, output, min_score=None):
+        """
+        predictor の出力を保存して、保存形式 (encode_output) を返す
+        min_score: predictor の出力に含まれる検出の最低スコア (get_min_score(predictor) を渡す)
+        """
+        record = self.encode_output(output, min_score)
+        masks = record['masks']
+
+        # 他のプロセスが書きかけのファイルを読まないように、一時ファイルに書いてから置き換える
+        fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, classes=record['classes'], scores=record['scores'], boxes=record['boxes'],
+                         num_runs=np.array([len(m.starts) for m in masks], dtype=np.int64),
+                         starts=np.concatenate([m.starts for m in masks] + [np.zeros(0, dtype=np.int32)]),
+                         lengths=np.concatenate([m.lengths for m in masks] + [np.zeros(0, dtype=np.int32)]),
+                         height=record['height'], width=record['width'], floor=record['floor'])
+            os.replace(tmp_filename, self._cache_filename(image_key))
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        return record
+
+    def _get_score_thresh(self, score_thresh):
+        return self.score_thresh if score_thresh is None else score_thresh
+
+    def _select(self, record, score_thresh):
+        score_thresh = self._get_score_thresh(score_thresh)
+        assert score_thresh >= record['floor'], \
+            'キャッシュには {} 以上の検出しかない (推論した predictor の SCORE_THRESH_TEST)。しきい値: {}'.format(record['floor'], score_thresh)
+
+        return np.flatnonzero(record['scores'] >= score_thresh)
+
+    def to_pred_dict(self, record, file_name, score_thresh=None, mask_format='rle'):
+        """
+        保存形式から score_thresh 以上の検出だけの評価用の pred_dict を作る (calc_ap の pred_dict と同じ形式)
+        """
+        keep = self._select(record, score_thresh)
+        masks = [record['masks'][i] for i in keep]
+
+        if mask_format == 'dense':
+            masks = np.asarray([m.decode() for m in masks], dtype=bool).reshape(len(keep), record['height'], record['width'])
+        elif mask_format != 'rle':
+            raise ValueError('不明な mask_format: {}'.format(mask_format))
+
+        return {'classes': record['classes'][keep], 'masks': masks, 'scores': record['scores'][keep],
+                'boxes': record['boxes'][keep], 'file_name': file_name}
+
+    def to_output(self, record, score_thresh=None):
+        """
+        保存形式から score_thresh 以上の検出だけの predictor の出力 ({'instances': Instances}) を作る
+        """
+        keep = self._select(record, score_thresh)
+        image_size = (record['height'], record['width'])
+
+        masks = np.asarray([record['masks'][i].decode() for i in keep], dtype=bool).reshape(len(keep), *image_size)
+
+        instances = Instances(image_size)
+        instances.pred_boxes = Boxes(torch.as_tensor(record['boxes'][keep]))
+        instances.scores = torch.as_tensor(record['scores'][keep])
+        instances.pred_classes = torch.as_tensor(record['classes'][keep])
+        instances.pred_masks = torch.as_tensor(masks)
+
+        return {'instances': instances}
+
+    def wrap(self, predictor, score_thresh=None):
+        """
+        キャッシュを通す predictor を作る (plot_predictor2 などにそのまま渡せる)
+        """
+        return CachedPredictor(self, predictor, score_thresh=score_thresh)
+
+
+class CachedPredictor:
+    """
+    PredictionCache を通して推論する predictor
+    キャッシュにない画像だけを predictor で推論する (画像のリストを受け取る predictor にはまとめて渡す)
+    """
+    def __init__(self, cache, predictor, score_thresh=None):
+        self.cache = cache
+        self.predictor = predictor
+        self.score_thresh = score_thresh
+
+    def __call__(self, images):
+        """
+        images: 画像 1枚 (DefaultPredictor と同じ) または画像のリスト (MachikadoPredictor と同じ)
+        """
+        if isinstance(images, np.ndarray):
+            key = self.cache.image_key(images)
+            record = self.cache.get(key, self.score_thresh)
+            if record is None:
+                record = self.cache.put(key, self.predictor(images), self.cache.get_min_score(self.predictor))
+            return self.cache.to_output(record, self.score_thresh)
+
+        keys = [self.cache.image_key(image) for image in images]
+        records = [self.cache.get(key, self.score_thresh) for key in keys]
+
+        misses = [i for i, record in enumerate(records) if record is None]
+        if len(misses):
+            outputs = self.predictor([images[i] for i in misses])
+            for i, output in zip(misses, outputs):
+                records[i] = self.cache.put(keys[i], output, self.cache.get_min_score(self.predictor))
+
+        return [self.cache.to_output(record, self.score_thresh) for record in records]
@@ -0,0 +1,163 @@
+import numpy as np
+import cv2
+
+
+class RLEMask:
+    """
+    ランレングスで表したマスク
+
+    COCO と同じく列優先 (x * height + y) で画素を並べ、前景のラン(開始位置と長さ)だけを保持する。
+    (H, W) の bool 配列の代わりに、ランの数に比例したメモリしか使わない
+    """
+    def __init__(self, height, width, starts, lengths):
+        """
+        height, width: 画像サイズ
+        starts: 前景ランの開始位置(昇順、隣接・重複なし)
+        lengths: 前景ランの長さ
+        """
+        self.height = height
+        self.width = width
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=np.int32)
+        self.area = int(self.lengths.sum())
+        self.bbox = self._calc_bbox()
+
+    def _calc_bbox(self):
+        """
+        バウンディングボックス (x0, y0, x1, y1) を求める ※x1, y1 は含まない
+        """
+        if len(self.starts) == 0:
+            return (0, 0, 0, 0)
+
+        ends = self.starts + self.lengths - 1  # ランの最後の画素
+        cols_s, cols_e = self.starts // self.height, ends // self.height
+
+        if (cols_s != cols_e).any():  # 列をまたぐランがあれば縦は全域
+            y0, y1 = 0, self.height
+        else:
+            y0, y1 = int((self.starts % self.height).min()), int((ends % self.height).max()) + 1
+
+        return (int(cols_s[0]), y0, int(cols_e[-1]) + 1, y1)
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.lengths.nbytes
+
+    @classmethod
+    def _from_crop(cls, crop, x0, y0, height, width):
+        """
+        画像の (x0, y0) に位置する切り出しマスクからランを作る
+        """
+        crop_h, crop_w = crop.shape
+
+        # 列ごとに上下を False で挟んでから列優先に並べると、ランが列をまたがない
+        padded = np.zeros((crop_w, crop_h + 2), dtype=np.int8)
+        padded[:, 1:-1] = crop.T
+        d = np.diff(padded.ravel())
+
+        pos_s = np.flatnonzero(d == 1) + 1
+        pos_e = np.flatnonzero(d == -1) + 1
+
+        # 切り出し内の位置を画像全体での位置に変換する
+        col, row = pos_s // (crop_h + 2), pos_s % (crop_h + 2) - 1
+        starts = (x0 + col) * height + (y0 + row)
+        ends = starts + (pos_e - pos_s)
+
+        # 縦方向に全域を覆う場合は列をまたいで連続するので結合する
+        if len(starts) > 1:
+            breaks = starts[1:] != ends[:-1]
+            starts = starts[np.r_[True, breaks]]
+            ends = ends[np.r_[breaks, True]]
+
+        return cls(height, width, starts, ends - starts)
+
+    @classmethod
+    def from_dense(cls, mask):
+        """
+        (H, W) の bool 配列から作る
+        """
+        mask = np.asarray(mask, dtype=bool)
+        height, width = mask.shape
+
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            return cls(height, width, [], [])
+
+        y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+        return cls._from_crop(mask[y0:y1, x0:x1], x0, y0, height, width)
+
+    @classmethod
+    def from_polygon(cls, segmentation, height, width):
+        """
+        segmentation (ポリゴン) から作る
+        画像全体ではなく、ポリゴンを囲む領域だけを塗りつぶす
+        """
+        assert len(segmentation)
+
+        p = np.asarray(segmentation[0])
+        pts = np.vstack([p[::2], p[1::2]]).T.astype(np.int32)
+
+        # 画像からはみ出した部分は fillPoly が切り捨てる
+        x0, y0 = np.maximum(pts.min(axis=0), 0)
+        x1, y1 = np.minimum(pts.max(axis=0) + 1, (width, height))
+
+        if x1 <= x0 or y1 <= y0:
+            return cls(height, width, [], [])
+
+        crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        crop = cv2.fillPoly(crop, [pts - (x0, y0)], 1)
+
+        return cls._from_crop(crop.astype(bool), x0, y0, height, width)
+
+    def decode(self):
+        """
+        (H, W) の bool 配列に戻す
+        """
+        flat = np.zeros(self.height * self.width + 1, dtype=np.int8)
+        np.add.at(flat, self.starts, 1)
+        np.add.at(flat, self.starts + self.lengths, -1)
+
+        return np.cumsum(flat[:-1]).astype(bool).reshape(self.width, self.height).T
+
+    def _coverage(self, x):
+        """
+        位置 x より前 ([0, x)) にある前景の画素数
+        """
+        x = np.asarray(x)
+        idx = np.searchsorted(self.starts, x, side='right') - 1
+
+        cum = np.r_[0, np.cumsum(self.lengths, dtype=np.int64)]
+        valid = idx >= 0
+        idx = np.maximum(idx, 0)
+
+        cov = cum[idx] + np.minimum(x - self.starts[idx], self.lengths[idx])
+
+        return np.where(valid, cov, 0)
+
+    def _bbox_overlaps(self, other):
+        ax0, ay0, ax1, ay1 = self.bbox
+        bx0, by0, bx1, by1 = other.bbox
+
+        return max(ax0, bx0) < min(ax1, bx1) and max(ay0, by0) < min(ay1, by1)
+
+    def intersection(self, other):
+        """
+        共通部分の画素数をランのまま求める
+        """
+        assert (self.height, self.width) == (other.height, other.width), 'マスクサイズ不整合'
+
+        if len(self.starts) == 0 or len(other.starts) == 0 or not self._bbox_overlaps(other):
+            return 0
+
+        # self のランごとに、範囲内にある other の画素数を数える
+        return int((other._coverage(self.starts + self.lengths) - other._coverage(self.starts)).sum())
+
+    def union(self, other):
+        return self.area + other.area - self.intersection(other)
+
+    def iou(self, other):
+        inter = self.intersection(other)
+        union = self.area + other.area - inter
+
+        return inter / union if union > 0 else 0
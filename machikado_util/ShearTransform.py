@@ -1,3 +1,4 @@
+import functools
 import numpy as np
 import cv2
 
@@ -5,6 +6,197 @@ import shapely.geometry as geometry
 from fvcore.transforms.transform import Transform
 from detectron2.data import transforms as T
 
+from .sample_rng import as_generator
+
+
+try:
+    from shapely import linearrings, is_simple  # shapely 2 のベクトル化 API
+except ImportError:
+    linearrings = is_simple = None
+
+
+@functools.lru_cache(maxsize=32)
+def _crop_box(w: int, h: int):
+    """画像範囲の shapely ポリゴン (サイズごとに1回だけ作る)"""
+    return geometry.box(0, 0, w, h).buffer(0)
+
+
+def _polygon_area(pts: np.ndarray) -> float:
+    """ポリゴンの面積 (靴ひも公式)"""
+    x, y = pts[:, 0], pts[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def _is_simple_polygons(polygons: list) -> np.ndarray:
+    """ポリゴンごとに自己交差していないかを判定する"""
+    if is_simple is not None:
+        coords = np.concatenate(polygons)
+        indices = np.repeat(np.arange(len(polygons)), [len(p) for p in polygons])
+        return is_simple(linearrings(coords, indices=indices))
+
+    return np.array([geometry.LinearRing(p).is_simple for p in polygons], dtype=bool)
+
+
+def _group_starts(ids: np.ndarray) -> np.ndarray:
+    """ポリゴンごとに連結した頂点配列で、各ポリゴンの先頭の位置"""
+    first = np.empty(len(ids), dtype=bool)
+    first[:1] = True
+    np.not_equal(ids[1:], ids[:-1], out=first[1:])
+
+    return np.flatnonzero(first)
+
+
+def _prev_index(starts: np.ndarray, n: int) -> np.ndarray:
+    """同じポリゴン内の1つ前の頂点の位置 (先頭は末尾につなげる)"""
+    prev = np.arange(-1, n - 1)
+    prev[starts] = np.append(starts[1:], n) - 1
+
+    return prev
+
+
+def _polygon_areas(pts: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """連結した頂点配列からポリゴンごとの面積を求める (靴ひも公式)"""
+    prev = pts[_prev_index(starts, len(pts))]
+
+    return 0.5 * np.abs(np.add.reduceat(prev[:, 0] * pts[:, 1] - pts[:, 0] * prev[:, 1], starts))
+
+
+def _clip_half_plane(pts: np.ndarray, ids: np.ndarray, axis: int, bound: float, keep_greater: bool):
+    """Sutherland–Hodgman の1辺分: 全ポリゴンの頂点をまとめて、pts[:, axis] が bound の内側になるように切り取る"""
+    inside = pts[:, axis] >= bound if keep_greater else pts[:, axis] <= bound
+    if inside.all():  # この辺では切り取るものがない
+        return pts, ids
+
+    prev_index = _prev_index(_group_starts(ids), len(ids))
+    prev = pts[prev_index]
+    cross = inside != inside[prev_index]  # 1つ前の頂点からの辺が境界をまたぐ
+
+    t = np.zeros(len(pts))
+    np.divide(bound - prev[:, axis], pts[:, axis] - prev[:, axis], out=t, where=cross)
+
+    # 頂点ごとに [交点, 頂点] のうち出力するものを順番に並べる
+    candidates = np.empty((len(pts), 2, 2))
+    candidates[:, 0] = prev + t[:, None] * (pts - prev)
+    candidates[:, 0, axis] = bound
+    candidates[:, 1] = pts
+
+    emit = np.empty((len(pts), 2), dtype=bool)
+    emit[:, 0] = cross
+    emit[:, 1] = inside
+
+    return candidates[emit], np.repeat(ids, emit.sum(axis=1))
+
+
+def _clip_polygons(polygons: list, w: int, h: int) -> list:
+    """自己交差のないポリゴンをまとめて画像範囲 (0, 0, w, h) で切り取る
+
+    凹ポリゴンが複数に分かれる場合も1つのポリゴンのまま (境界上の幅0の辺でつながる) 返す。面積は shapely と同じになる
+    戻り値は polygons と同じ長さのリストで、範囲外で無くなったものは None になる
+    """
+    lengths = np.array([len(p) for p in polygons])
+    pts = np.concatenate(polygons)
+    ids = np.repeat(np.arange(len(polygons)), lengths)
+    starts = np.append(0, np.cumsum(lengths)[:-1])
+
+    lo, hi = np.minimum.reduceat(pts, starts), np.maximum.reduceat(pts, starts)
+    inner = (lo[:, 0] >= 0) & (lo[:, 1] >= 0) & (hi[:, 0] <= w) & (hi[:, 1] <= h)  # 切り取り不要
+    outer = (hi[:, 0] <= 0) | (hi[:, 1] <= 0) | (lo[:, 0] >= w) | (lo[:, 1] >= h)  # 完全に範囲外
+    crossing = ~inner & ~outer
+
+    cropped_polygons = [None] * len(polygons)
+
+    areas = _polygon_areas(pts, starts)
+    for i in np.flatnonzero(inner & (areas > 0)):
+        cropped_polygons[i] = polygons[i]
+
+    if not crossing.any():
+        return cropped_polygons
+
+    clipped = crossing[ids]
+    pts, ids = pts[clipped], ids[clipped]
+
+    for axis, bound, keep_greater in [(0, 0, True), (0, w, False), (1, 0, True), (1, h, False)]:
+        pts, ids = _clip_half_plane(pts, ids, axis, bound, keep_greater)
+        if len(pts) == 0:
+            return cropped_polygons
+
+    # 境界上の頂点で重複した点を除く
+    keep = np.any(pts != pts[_prev_index(_group_starts(ids), len(ids))], axis=1)
+    pts, ids = pts[keep], ids[keep]
+    if len(pts) == 0:
+        return cropped_polygons
+
+    starts = _group_starts(ids)
+    areas = _polygon_areas(pts, starts)
+    counts = np.diff(np.append(starts, len(ids)))
+
+    for p, i, area, count in zip(np.split(pts, starts[1:]), ids[starts], areas, counts):
+        if count >= 3 and area > 0:
+            cropped_polygons[i] = p
+
+    return cropped_polygons
+
+
+def _crop_polygons_shapely(polygons: list, w: int, h: int) -> list:
+    """shapely で画像範囲 (0, 0, w, h) でポリゴンをクリッピングする (自己交差したポリゴンは修正される)"""
+    crop_box = _crop_box(w, h)
+    
+    cropped_polygons = []
+    
+    for polygon in polygons:
+        polygon = geometry.Polygon(polygon).buffer(0)
+        assert polygon.is_valid, '不正なポリゴン {}'.format(polygon)
+        
+        cropped = polygon.intersection(crop_box)
+        
+        if cropped.is_empty:
+            continue
+        
+        # 複数のポリゴンに分割される可能性があるのでその処理が必要 (shapely 2 ではマルチパートは .geoms で取り出す)
+        for poly in getattr(cropped, 'geoms', [cropped]):
+            if not isinstance(poly, geometry.Polygon) or not poly.is_valid:  # 不正なポリンゴンを無視する
+                continue
+            
+            coords = np.asarray(poly.exterior.coords)
+            cropped_polygons.append(coords[:-1])  # ポリゴンの終端が先端になっているので終端を削除
+    
+    return cropped_polygons
+
+
+def crop_polygons(polygons: list, w: int, h: int) -> list:
+    """画像範囲 (0, 0, w, h) でポリゴンをクリッピングする
+
+    自己交差のないポリゴンは NumPy の Sutherland–Hodgman で切り取り、自己交差したものだけ shapely で処理する
+    
+    Arguments:
+        polygons {list} -- ポリゴン [np.ndarray (N, 2), ...]
+        w {int} -- 画像の幅
+        h {int} -- 画像の高さ
+    
+    Returns:
+        list -- クリッピングされたポリゴン (shapely で分割された場合は増える、範囲外のものは無くなる)
+    """
+    polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polygons]
+    polygons = [p for p in polygons if len(p) >= 3]  # 面積のないものは除く
+
+    if len(polygons) == 0:
+        return []
+
+    simple = _is_simple_polygons(polygons)
+    clipped = iter(_clip_polygons([p for p, s in zip(polygons, simple) if s], w, h)) if simple.any() else None
+
+    # 自己交差したものは shapely で修正して切り取る (順番は元のポリゴンの順番を保つ)
+    cropped_polygons = []
+    for polygon, is_simple_polygon in zip(polygons, simple):
+        if is_simple_polygon:
+            p = next(clipped)
+            if p is not None:
+                cropped_polygons.append(p)
+        else:
+            cropped_polygons += _crop_polygons_shapely([polygon], w, h)
+
+    return cropped_polygons
+
 
 class ShearTransform(Transform):
     """
@@ -58,30 +250,7 @@ class ShearTransform(Transform):
         """
         polygons = [self.apply_coords(p) for p in polygons]
 
-        # 画像範囲でクリッピング
-        crop_box = geometry.box(0, 0, self.w, self.h).buffer(0)
-        
-        cropped_polygons = []
-        
-        for polygon in polygons:
-            polygon = geometry.Polygon(polygon).buffer(0)
-            assert polygon.is_valid, '不正なポリゴン {}'.format(polygon)
-            
-            cropped = polygon.intersection(crop_box)
-            
-            if cropped.is_empty:
-                continue
-            
-            # 複数のポリゴンに分割される可能性があるのでその処理が必要
-            if not isinstance(cropped, geometry.collection.BaseMultipartGeometry):  # 単一であればリストに
-                cropped = [cropped]
-            
-            for poly in cropped:
-                if not isinstance(poly, geometry.Polygon) or not poly.is_valid:  # 不正なポリンゴンを無視する
-                    continue
-                
-                coords = np.asarray(poly.exterior.coords)
-                cropped_polygons.append(coords[:-1])  # ポリゴンの終端が先端になっているので終端を削除
+        cropped_polygons = crop_polygons(polygons, self.w, self.h)
         
         if len(cropped_polygons) == 0:
             print('警告: せん断変形の結果、有効な領域が残らなかった')
@@ -99,17 +268,31 @@ class RandomShear(T.TransformGen):
         super().__init__()
         self._init(locals())
 
-    def get_transform(self, img):
+    def get_transform(self, img, rng=None):
+        """
+        rng: 乱数生成器 (np.random.Generator)。None ならグローバルの乱数から作る
+        """
+        angle_h, angle_v = self.sample_angles(1, rng)[0]
+
+        return self.make_transform(img, angle_h, angle_v)
+
+    def sample_angles(self, num, rng=None):
+        """
+        num 回分の水平・垂直の角度を配列でまとめて引く [num, 2]
+        """
+        rng = as_generator(rng)
+        angles = np.zeros((num, 2))
+
+        for i, angle_range in enumerate([self.angle_h_range, self.angle_v_range]):
+            if angle_range is not None:
+                angles[:, i] = rng.uniform(angle_range[0], angle_range[1], num)
+
+        return angles
+
+    def make_transform(self, img, angle_h, angle_v):
+        """
+        引いた角度から img に対するトランスフォームを作る
+        """
         h, w = img.shape[:2]
-        
-        if self.angle_h_range is None:
-            angle_h = 0
-        else:
-            angle_h = np.random.uniform(self.angle_h_range[0], self.angle_h_range[1])
-            
-        if self.angle_v_range is None:
-            angle_v = 0
-        else:
-            angle_v = np.random.uniform(self.angle_v_range[0], self.angle_v_range[1])
-       
-        return ShearTransform(h, w, angle_h, angle_v)
\ No newline at end of file
+
+        return ShearTransform(h, w, float(angle_h), float(angle_v))
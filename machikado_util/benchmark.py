@@ -0,0 +1,826 @@
+"""
+性能計測用のベンチマーク
+
+    python -m machikado_util.benchmark iou
+    python -m machikado_util.benchmark workers
+    python -m machikado_util.benchmark mapper_copy
+    python -m machikado_util.benchmark photometric
+    python -m machikado_util.benchmark clip
+    python -m machikado_util.benchmark batch_mapper
+    python -m machikado_util.benchmark mapper --min-samples-per-sec 20
+    python -m machikado_util.benchmark predictor --config-file ./output/config.yaml --weights ./output/model_final.pth
+    python -m machikado_util.benchmark pre_rec
+    python -m machikado_util.benchmark stream
+    python -m machikado_util.benchmark incremental
+    python -m machikado_util.benchmark eval_shards --num-shards 4
+"""
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2
+
+from .calc_iou import calc_iou_matrix, calc_iou_matrices
+from .RLEMask import RLEMask
+
+
+def make_synthetic_masks(num, h, w, rng):
+    """
+    ランダムな楕円のマスクを生成する [num, h, w]
+    """
+    masks = np.zeros((num, h, w), dtype=np.uint8)
+    short_len = min(h, w)
+
+    for i in range(num):
+        center = (int(rng.uniform(0, w)), int(rng.uniform(0, h)))
+        axes = (int(short_len * rng.uniform(0.05, 0.3)), int(short_len * rng.uniform(0.05, 0.3)))
+        cv2.ellipse(masks[i], center, axes, rng.uniform(0, 180), 0, 360, 1, thickness=-1)
+
+    return masks.astype(bool)
+
+
+def make_synthetic_eval_dict(file_name, num, h, w, num_classes, rng, pred=False):
+    """
+    評価用の true_dict (pred=True なら pred_dict) をランダムに生成する (マスクは RLEMask)
+    """
+    d = {'classes': rng.randint(0, num_classes, num),
+         'masks': [RLEMask.from_dense(m) for m in make_synthetic_masks(num, h, w, rng)],
+         'file_name': file_name}
+
+    if pred:
+        d['scores'] = np.sort(rng.uniform(0, 1, num))[::-1]
+
+    return d
+
+
+def make_synthetic_polygon(h, w, num_points, rng):
+    """
+    ランダムな楕円のポリゴン (x0, y0, x1, y1, ...) を float32 で生成する
+    """
+    short_len = min(h, w)
+    cx, cy = rng.uniform(0.2, 0.8) * w, rng.uniform(0.2, 0.8) * h
+    rx, ry = short_len * rng.uniform(0.05, 0.2), short_len * rng.uniform(0.05, 0.2)
+
+    t = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    r = 1 + 0.1 * np.sin(t * 5)  # 少し凹ませる
+
+    return np.stack([cx + rx * r * np.cos(t), cy + ry * r * np.sin(t)], axis=1).reshape(-1).astype(np.float32)
+
+
+def make_sheared_polygons(num_polygons, num_points, h, w, rng, self_intersect_every=50):
+    """
+    画像の端をまたぐように大きめにしてせん断したポリゴン [np.ndarray (N, 2), ...] を生成する
+    self_intersect_every 個ごとに、頂点を入れ替えて自己交差させたポリゴンを混ぜる
+    """
+    polygons = []
+    for i in range(num_polygons):
+        p = make_synthetic_polygon(h, w, num_points, rng).reshape(-1, 2).astype(np.float64)
+        p = (p - (w / 2, h / 2)) * rng.uniform(1, 3) + (w / 2, h / 2)
+        mat = np.array([[1, np.tan(np.deg2rad(rng.uniform(-20, 20)))], [np.tan(np.deg2rad(rng.uniform(-20, 20))), 1]])
+        p = np.dot(p, mat.T)
+
+        if i % self_intersect_every == 0:
+            p[[0, num_points // 2]] = p[[num_points // 2, 0]]
+
+        polygons.append(p)
+
+    return polygons
+
+
+def make_synthetic_dataset(dirname, num_images=16, h=480, w=640, num_instances=5, num_points=200, seed=0):
+    """
+    ランダムな画像を dirname に書き出して、Machikado_vott と同じ形式 (polygon_format='array') のレコードを返す
+    """
+    from detectron2.structures import BoxMode
+
+    rng = np.random.RandomState(seed)
+    dataset_dicts = []
+
+    for i in range(num_images):
+        file_name = os.path.join(dirname, 'synthetic_{:04d}.jpg'.format(i))
+        img = cv2.GaussianBlur(rng.randint(0, 256, (h, w, 3)).astype(np.uint8), (15, 15), 0)
+        cv2.imwrite(file_name, img)
+
+        annos = []
+        for _ in range(num_instances):
+            poly = make_synthetic_polygon(h, w, num_points, rng)
+            xs, ys = poly[0::2], poly[1::2]
+            annos.append({
+                'bbox': np.array([xs.min(), ys.min(), xs.max(), ys.max()], dtype=np.float32),
+                'bbox_mode': BoxMode.XYXY_ABS,
+                'segmentation': [poly],
+                'category_id': int(rng.randint(0, 6)),
+                'iscrowd': 0,
+            })
+
+        dataset_dicts.append({'file_name': file_name, 'height': h, 'width': w, 'annotations': annos})
+
+    return dataset_dicts
+
+
+def timeit(func, repeat):
+    """
+    func を repeat 回実行して最小の実行時間(秒)を返す
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def bench_iou(num_pred=30, num_true=20, h=720, w=1280, repeat=3, seed=0):
+    """
+    IoU 行列の計算方法ごとの実行時間を比較する
+    """
+    rng = np.random.RandomState(seed)
+    pred_masks = make_synthetic_masks(num_pred, h, w, rng)
+    true_masks = make_synthetic_masks(num_true, h, w, rng)
+
+    print('iou: pred {} x true {} ({}x{})'.format(num_pred, num_true, w, h))
+    base = None
+    for method in ['loop', 'matmul', 'bbox']:
+        t = timeit(lambda: calc_iou_matrix(pred_masks, true_masks, method=method), repeat)
+        base = t if base is None else base
+        print('  {:8s}: {:8.2f} ms (x{:.1f})'.format(method, t * 1000, base / t))
+
+    # ランレングス (エンコード済みのマスク同士)
+    pred_rles = [RLEMask.from_dense(m) for m in pred_masks]
+    true_rles = [RLEMask.from_dense(m) for m in true_masks]
+
+    t = timeit(lambda: calc_iou_matrix(pred_rles, true_rles), repeat)
+    print('  {:8s}: {:8.2f} ms (x{:.1f})'.format('rle', t * 1000, base / t))
+
+    nbytes = sum(m.nbytes for m in pred_rles + true_rles) / max(num_pred + num_true, 1)
+    print('  mask memory: dense {} bytes / rle {:.0f} bytes (per instance)'.format(h * w, nbytes))
+
+
+def bench_workers(num_images=64, num_pred=20, num_true=10, h=480, w=640, mask_format='dense', repeat=1, seed=0):
+    """
+    画像ごとの IoU 計算を並列化したときのスケーリングを計測する
+    """
+    rng = np.random.RandomState(seed)
+    mask_pairs = [(make_synthetic_masks(num_pred, h, w, rng), make_synthetic_masks(num_true, h, w, rng))
+                  for _ in range(num_images)]
+
+    if mask_format == 'rle':
+        mask_pairs = [([RLEMask.from_dense(m) for m in p], [RLEMask.from_dense(m) for m in t]) for p, t in mask_pairs]
+
+    method = 'bbox' if mask_format == 'dense' else 'matmul'  # rle は method に関わらずランで計算する
+
+    print('workers: {} images, pred {} x true {} ({}x{}, {})'.format(num_images, num_pred, num_true, w, h, mask_format))
+    base = None
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        t = timeit(lambda: calc_iou_matrices(mask_pairs, method=method, workers=workers), repeat)
+        base = t if base is None else base
+        print('  workers {:3d}: {:8.2f} ms (x{:.1f})'.format(workers, t * 1000, base / t))
+        workers *= 2
+
+
+def bench_mapper_copy(num_images=16, num_instances=20, num_points=500, num_samples=64, seed=0):
+    """
+    MachikadoDatasetMapper のレコード複製を copy.deepcopy と比較する
+    """
+    from detectron2.config import get_cfg
+    from . import MachikadoDatasetMapper as mapper_module
+    from .custom_config import append_custom_cfg
+
+    cfg = get_cfg()
+    append_custom_cfg(cfg)
+    cfg.INPUT.CROP.ENABLED = True
+    cfg.INPUT.CROP.SIZE = [0.8, 0.8]
+
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset_dicts = make_synthetic_dataset(dirname, num_images=num_images, num_instances=num_instances,
+                                               num_points=num_points, seed=seed)
+
+        print('mapper_copy: {} instances x {} points per image'.format(num_instances, num_points))
+
+        for name, copy_func in [('deepcopy', copy.deepcopy), ('copy_dataset_dict', mapper_module.copy_dataset_dict)]:
+            t = timeit(lambda: [copy_func(d) for d in dataset_dicts], 3)
+            print('  copy   {:18s}: {:8.3f} ms / sample'.format(name, t * 1000 / len(dataset_dicts)))
+
+        mapper = mapper_module.MachikadoDatasetMapper(cfg, is_train=True)
+        np.random.seed(seed)
+
+        for name, copy_func in [('deepcopy', copy.deepcopy), ('copy_dataset_dict', mapper_module.copy_dataset_dict)]:
+            mapper_module.copy_dataset_dict, org_copy_func = copy_func, mapper_module.copy_dataset_dict
+            try:
+                t = timeit(lambda: [mapper(dataset_dicts[i % num_images]) for i in range(num_samples)], 1)
+            finally:
+                mapper_module.copy_dataset_dict = org_copy_func
+
+            print('  mapper {:18s}: {:8.1f} samples/sec'.format(name, num_samples / t))
+
+
+def bench_photometric(num_images=16, h=720, w=1280, contrast_range=(0.5, 1.5), brightness_range=(0.8, 1.2),
+                      saturation_range=(0.8, 1.2), repeat=3, seed=0):
+    """
+    コントラスト・明るさ・彩度を個別にかけた場合と、RandomPhotometric でまとめた場合のスループットを比較する
+    """
+    from detectron2.data import transforms as T
+    from .PhotometricTransform import RandomPhotometric
+
+    rng = np.random.RandomState(seed)
+    images = [cv2.GaussianBlur(rng.randint(0, 256, (h, w, 3)).astype(np.uint8), (15, 15), 0) for _ in range(num_images)]
+
+    sequential_gens = [T.RandomContrast(*contrast_range), T.RandomBrightness(*brightness_range), T.RandomSaturation(*saturation_range)]
+    fused_gen = RandomPhotometric(contrast_range, brightness_range, saturation_range)
+
+    def run_sequential(img):
+        for gen in sequential_gens:
+            img = gen.get_transform(img).apply_image(img)
+        return img
+
+    def run_fused(img):
+        return fused_gen.get_transform(img).apply_image(img)
+
+    print('photometric: {} images ({}x{})'.format(num_images, w, h))
+    base = None
+    for name, func in [('sequential', run_sequential), ('fused', run_fused)]:
+        t = timeit(lambda: [func(img) for img in images], repeat)
+        base = t if base is None else base
+        print('  {:10s}: {:8.1f} images/sec (x{:.1f})'.format(name, num_images / t, base / t))
+
+
+def bench_clip(num_polygons=500, num_points=100, h=480, w=640, repeat=3, seed=0):
+    """
+    せん断変形したポリゴンの画像範囲でのクリッピングを、shapely のみの場合と比較する
+    """
+    from .ShearTransform import crop_polygons, _crop_polygons_shapely
+
+    polygons = make_sheared_polygons(num_polygons, num_points, h, w, np.random.RandomState(seed))
+
+    print('clip: {} polygons x {} points ({}x{})'.format(num_polygons, num_points, w, h))
+    base = None
+    for name, clip_func in [('shapely', _crop_polygons_shapely), ('numpy', crop_polygons)]:
+        t = timeit(lambda: clip_func(polygons, w, h), repeat)
+        base = t if base is None else base
+        print('  {:8s}: {:8.3f} ms / 100 polygons (x{:.1f})'.format(name, t * 1000 * 100 / num_polygons, base / t))
+
+
+def bench_batch_mapper(num_images=16, batch_size=4, num_instances=5, num_points=100, num_samples=64, num_workers=4, seed=0):
+    """
+    MachikadoDatasetMapper (1枚ずつ) と MachikadoBatchMapper (ミニバッチ単位) の samples/sec を比較する
+    """
+    from detectron2.config import get_cfg
+    from .MachikadoDatasetMapper import MachikadoDatasetMapper
+    from .MachikadoBatchMapper import MachikadoBatchMapper
+    from .custom_config import append_custom_cfg
+
+    cfg = get_cfg()
+    append_custom_cfg(cfg)
+    cfg.INPUT.CROP.ENABLED = True
+    cfg.INPUT.CROP.SIZE = [0.8, 0.8]
+
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset_dicts = make_synthetic_dataset(dirname, num_images=num_images, num_instances=num_instances,
+                                               num_points=num_points, seed=seed)
+        batches = [[dataset_dicts[(i + j) % num_images] for j in range(batch_size)] for i in range(0, num_samples, batch_size)]
+
+        print('batch_mapper: {} samples, batch {} ({} threads)'.format(len(batches) * batch_size, batch_size, num_workers))
+
+        base = None
+        for name, fused in [('per-image', False), ('per-image fused', True)]:
+            cfg.INPUT.FUSED.PHOTOMETRIC = fused
+            mapper = MachikadoDatasetMapper(cfg, is_train=True)
+            np.random.seed(seed)
+
+            t = timeit(lambda: [[mapper(d) for d in batch] for batch in batches], 1)
+            base = t if base is None else base
+            print('  {:16s}: {:8.1f} samples/sec (x{:.1f})'.format(name, len(batches) * batch_size / t, base / t))
+
+        mapper = MachikadoBatchMapper(cfg, is_train=True, num_workers=num_workers)
+        np.random.seed(seed)
+
+        t = timeit(lambda: [mapper(batch) for batch in batches], 1)
+        print('  {:16s}: {:8.1f} samples/sec (x{:.1f})'.format('batch', len(batches) * batch_size / t, base / t))
+
+
+# custom_config の水増しの設定 (ENABLED を持つもの)
+AUGMENTATIONS = ['CONTRAST', 'BRIGHTNESS', 'SATURATION', 'CUTOUT', 'EXTENT', 'ROTATE', 'SHEAR', 'CROP']
+
+
+def make_mapper_configs():
+    """
+    マッパーのベンチマークに使う設定 (名前, cfg を書き換える関数) のリスト
+    全て無効・1つずつ有効・デフォルト (全て有効)・まとめた変換
+    """
+    def set_enabled(names):
+        def apply(cfg):
+            for name in AUGMENTATIONS:
+                getattr(cfg.INPUT, name).ENABLED = name in names
+        return apply
+
+    def fused(cfg):
+        set_enabled(AUGMENTATIONS)(cfg)
+        cfg.INPUT.FUSED.AFFINE = True
+        cfg.INPUT.FUSED.PHOTOMETRIC = True
+
+    configs = [('none', set_enabled([]))]
+    configs += [(name.lower(), set_enabled([name])) for name in AUGMENTATIONS]
+    configs += [('all', set_enabled(AUGMENTATIONS)), ('all fused', fused)]
+
+    return configs
+
+
+def bench_mapper(num_images=16, h=480, w=640, num_instances=5, num_points=100, num_samples=64, configs=None,
+                 profile=True, min_samples_per_sec=0, seed=0):
+    """
+    custom_config の設定ごとに MachikadoDatasetMapper の samples/sec を計測する
+    profile: 処理段階ごとの時間も表示する
+    min_samples_per_sec: これを下回る設定があれば False を返す (CI での性能劣化の検出用)
+    失敗したサンプルは数えて表示する (失敗があった場合も False を返す)
+    """
+    import collections
+    from detectron2.config import get_cfg
+    from .MachikadoDatasetMapper import MachikadoDatasetMapper
+    from .custom_config import append_custom_cfg
+    from .stage_timer import format_report
+
+    ok = True
+
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset_dicts = make_synthetic_dataset(dirname, num_images=num_images, h=h, w=w, num_instances=num_instances,
+                                               num_points=num_points, seed=seed)
+
+        print('mapper: {} samples ({}x{}, {} instances x {} points)'.format(num_samples, w, h, num_instances, num_points))
+
+        for name, apply in make_mapper_configs():
+            if configs is not None and name not in configs:
+                continue
+
+            cfg = get_cfg()
+            append_custom_cfg(cfg)
+            cfg.INPUT.CROP.SIZE = [0.8, 0.8]
+            apply(cfg)
+
+            mapper = MachikadoDatasetMapper(cfg, is_train=True)
+            errors = collections.Counter()
+
+            def run(mapper):
+                # 失敗したサンプルで止めずに、エラーの種類ごとに数える
+                for i in range(num_samples):
+                    try:
+                        mapper(dataset_dicts[i % num_images])
+                    except Exception as e:
+                        errors['{}: {}'.format(type(e).__name__, e)] += 1
+
+            np.random.seed(seed)
+            try:
+                mapper(dataset_dicts[0])  # 初回だけかかる処理を除く
+            except Exception:
+                pass
+
+            t = timeit(lambda: run(mapper), 1)
+            samples_per_sec = num_samples / t
+            slow = samples_per_sec < min_samples_per_sec
+            num_failed = sum(errors.values())
+            ok = ok and not slow and num_failed == 0
+
+            print('  {:12s}: {:8.1f} samples/sec{}{}'.format(
+                name, samples_per_sec, '  ** below {} **'.format(min_samples_per_sec) if slow else '',
+                '  ** {} / {} failed **'.format(num_failed, num_samples) if num_failed else ''))
+            for message, count in errors.most_common():
+                print('    {:6d}  {}'.format(count, message))
+
+            if profile:
+                # 計測を有効にしたマッパーで、段階ごとの時間を表示する (計測のコストを含まないように別に実行する)
+                cfg.INPUT.PROFILE.ENABLED = True
+                mapper = MachikadoDatasetMapper(cfg, is_train=True)
+                np.random.seed(seed)
+                errors.clear()
+                run(mapper)
+
+                print('    ' + format_report(mapper.timer.stats()).replace('\n', '\n    '))
+
+    return ok
+
+
+def _make_df_dict_loop(records, num_true_cls_count):
+    """
+    ベクトル化する前の pre, rec の計算 (1行ずつ df.iloc で累積する)。bench_pre_rec の比較用
+    同じスコアの順番だけは calc_pre_rec に合わせて元の順番にする (元のコードの quicksort では決まっていなかった)
+    records: {クラス: {列名: np.ndarray}}
+    """
+    import pandas as pd
+    from .calc_ap import INFO_COLUMNS
+
+    df_dict = {_cls: pd.DataFrame(dict(records[_cls], pre=None, rec=None), columns=INFO_COLUMNS) for _cls in records}
+
+    for u_cls, df in df_dict.items():
+        df.sort_values('score', ascending=False, inplace=True, kind='mergesort')
+
+        TP_count = 0
+        pres = []
+        recs = []
+
+        for i in range(len(df)):
+            se = df.iloc[i, :]
+
+            if se['correct']:
+                TP_count += 1
+
+            pres.append(TP_count / (i + 1))
+            recs.append(TP_count / num_true_cls_count[u_cls])
+
+        df['pre'] = pres
+        df['rec'] = recs
+
+    return df_dict
+
+
+def _calc_ap_loop(df_dict):
+    """
+    ベクトル化する前の AP の計算 (台形を1つずつ足す)。bench_pre_rec の比較用
+    """
+    aps = []
+    for df in df_dict.values():
+        rec, pre = df['rec'].values, df['pre'].values
+
+        S = 0
+        for i in range(len(rec) - 1):
+            S += (pre[i] + pre[i + 1]) * (rec[i + 1] - rec[i]) / 2
+
+        aps.append(S)
+
+    return np.array(aps, dtype=np.float64)
+
+
+def make_tied_scores(kind, n, rng):
+    """
+    n 個のスコア。kind によって同じスコアの多さを変える
+    0: 連続値 (ほぼ同点なし) / 1: 0.05 刻みに丸めた値 / 2: 3 種類の値だけ / それ以降: 全て同じ値
+    """
+    scores = rng.uniform(0, 1, n)
+
+    if kind == 1:
+        return np.round(scores * 20) / 20
+    if kind == 2:
+        return rng.choice([0.3, 0.6, 0.9], n)
+    if kind >= 3:
+        return np.full(n, 0.5)
+
+    return scores
+
+
+def bench_pre_rec(num_records=20000, num_classes=5, num_images=200, seed=0):
+    """
+    make_df_dict・calc_AP (ベクトル化版) と、ベクトル化する前のループでの計算の時間を比較する
+    """
+    from .calc_ap import make_df_dict, calc_AP
+
+    rng = np.random.RandomState(seed)
+    classes = list(range(num_classes))
+    cat_names = ['class{}'.format(c) for c in classes]
+
+    records, num_true_cls_count = {}, {}
+    for c in classes:
+        n = num_records // num_classes
+        records[c] = {'file_i': np.sort(rng.randint(0, num_images, n)), 'pred_i': rng.randint(0, 20, n),
+                      'score': make_tied_scores(c, n, rng), 'correct': rng.rand(n) < rng.uniform(0.2, 0.8), 'iou': rng.uniform(0, 1, n)}
+        num_true_cls_count[c] = int(records[c]['correct'].sum() + rng.randint(1, n // 4))  # 見逃しの分だけ多い
+
+    # 画像1枚分の記録が1つもないクラスも混ぜる
+    records[classes[-1]] = {col: values[:1] for col, values in records[classes[-1]].items()}
+
+    print('pre_rec: {} records, {} classes'.format(sum(len(r['score']) for r in records.values()), num_classes))
+
+    results = {}
+    t_loop = timeit(lambda: results.setdefault('loop', _make_df_dict_loop(records, num_true_cls_count)), 1)
+    t_vec = timeit(lambda: results.setdefault('vectorized', make_df_dict({c: {col: [v] for col, v in records[c].items()}
+                                                                           for c in classes}, num_true_cls_count)), 1)
+
+    t_ap_loop = timeit(lambda: _calc_ap_loop(results['loop']), 1)
+    t_ap_vec = timeit(lambda: calc_AP(results['vectorized'], cat_names), 1)
+
+    print('  {:20s}: {:8.1f} ms / {:8.1f} ms (x{:.1f})'.format('pre, rec (loop/vec)', t_loop * 1000, t_vec * 1000, t_loop / t_vec))
+    print('  {:20s}: {:8.1f} ms / {:8.1f} ms (x{:.1f})'.format('AP (loop/vec)', t_ap_loop * 1000, t_ap_vec * 1000, t_ap_loop / t_ap_vec))
+
+
+def make_synthetic_outputs(dataset_dicts, num_false=3, max_shift=5, seed=0):
+    """
+    dataset_dicts の教師データを少しずらした予想と、ランダムな誤検出からなる predictor の出力 ({'instances': Instances}) のリスト
+    """
+    import torch
+    from detectron2.structures import Instances
+    from .calc_ap import make_masks
+
+    rng = np.random.RandomState(seed)
+    outputs = []
+
+    for asset in dataset_dicts:
+        h, w = asset['height'], asset['width']
+        true_masks = make_masks(asset['annotations'], h, w, mask_format='dense')
+        true_classes = [anno['category_id'] for anno in asset['annotations']]
+
+        keep = rng.rand(len(true_masks)) < 0.8  # 見逃しもある
+        masks = [np.roll(m, rng.randint(-max_shift, max_shift + 1), axis=1) for m in true_masks[keep]]
+        classes = [c for c, k in zip(true_classes, keep) if k]
+
+        masks += list(make_synthetic_masks(num_false, h, w, rng))
+        classes += list(rng.randint(0, 6, num_false))
+
+        instances = Instances((h, w))
+        instances.pred_masks = torch.as_tensor(np.asarray(masks, dtype=bool).reshape(len(masks), h, w))
+        instances.pred_classes = torch.as_tensor(np.asarray(classes, dtype=np.int64))
+        instances.scores = torch.as_tensor(np.sort(rng.uniform(0, 1, len(masks)).astype(np.float32))[::-1].copy())
+        outputs.append({'instances': instances})
+
+    return outputs
+
+
+def bench_stream(num_images=16, h=480, w=640, num_instances=5, num_points=100, ths=(0.5, 0.75), seed=0):
+    """
+    マスクを全て作ってから評価する従来の方法 (append_masks, get_true_datas, predict_datas, make_info_dict) と
+    1画像ずつ評価する evaluate_stream の時間とメモリのピークを比較する
+    """
+    import tracemalloc
+    from detectron2.data import DatasetCatalog
+    from .calc_ap import append_masks, get_true_datas, predict_datas, make_info_dict, evaluate_stream
+
+    classes = list(range(6))  # make_synthetic_dataset の category_id
+    catalog_name = 'machikado_benchmark_stream_{}'.format(seed)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset_dicts = make_synthetic_dataset(dirname, num_images=num_images, h=h, w=w, num_instances=num_instances,
+                                               num_points=num_points, seed=seed)
+        outputs = make_synthetic_outputs(dataset_dicts, seed=seed)
+        DatasetCatalog.register(catalog_name, lambda: dataset_dicts)
+
+        def make_predictor():
+            # 画像の順番に推論結果を返す
+            output_iter = iter(outputs)
+            return lambda img: next(output_iter)
+
+        def run_list():
+            append_masks(dataset_dicts, mask_format='dense')
+            true_dicts = get_true_datas(catalog_name)
+            pred_dicts = predict_datas(make_predictor(), catalog_name, mask_format='dense')
+            return {th: make_info_dict(true_dicts, pred_dicts, classes, th) for th in ths}
+
+        def run_stream():
+            return {th: evaluate_stream(make_predictor(), catalog_name, classes, th) for th in ths}
+
+        print('stream: {} images ({}x{}, {} instances), thresholds {}'.format(num_images, w, h, num_instances, list(ths)))
+
+        for name, func in [('list', run_list), ('stream', run_stream)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            func()
+            t = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print('  {:8s}: {:8.1f} ms, peak {:8.1f} MB'.format(name, t * 1000, peak / (1 << 20)))
+
+            for asset in dataset_dicts:
+                asset.pop('masks', None)
+
+
+def bench_incremental(num_images=200, num_changed=5, num_pred=10, num_true=5, h=240, w=320, num_classes=5, seed=0):
+    """
+    num_changed 枚の予想を差し替えたときの、make_info_dicts_stream での再計算と IncrementalEvaluator の更新の時間を比較する
+    """
+    from .calc_ap import make_info_dicts_stream, make_AP_table, AP_THRESHOLDS
+    from .IncrementalEvaluator import IncrementalEvaluator
+
+    rng = np.random.RandomState(seed)
+    classes = list(range(num_classes))
+    cat_names = ['class{}'.format(c) for c in classes]
+
+    true_dicts = [make_synthetic_eval_dict('img{}'.format(i), num_true, h, w, num_classes, rng) for i in range(num_images)]
+    pred_dicts = [make_synthetic_eval_dict('img{}'.format(i), num_pred, h, w, num_classes, rng, pred=True) for i in range(num_images)]
+
+    evaluator = IncrementalEvaluator(classes, ths=AP_THRESHOLDS)
+    evaluator.add_images(true_dicts, pred_dicts)
+    evaluator.calc_AP_table(cat_names)
+
+    changed = rng.choice(num_images, num_changed, replace=False)
+    for i in changed:
+        pred_dicts[i] = make_synthetic_eval_dict('img{}'.format(i), num_pred, h, w, num_classes, rng, pred=True)
+
+    print('incremental: {} / {} images changed, pred {} x true {}, {} classes, {} thresholds'.format(
+        num_changed, num_images, num_pred, num_true, num_classes, len(AP_THRESHOLDS)))
+
+    t_full = timeit(lambda: make_AP_table(make_info_dicts_stream(true_dicts, pred_dicts, classes, AP_THRESHOLDS), cat_names), 1)
+
+    def update():
+        for i in changed:
+            evaluator.update_pred('img{}'.format(i), pred_dicts[i])
+        return evaluator.calc_AP_table(cat_names)
+
+    t_inc = timeit(update, 1)
+    print('  {:12s}: {:8.1f} ms'.format('full', t_full * 1000))
+    print('  {:12s}: {:8.1f} ms (x{:.1f})'.format('incremental', t_inc * 1000, t_full / t_inc))
+
+
+def _eval_shard_worker(true_dicts, pred_dicts, classes, file_indices, cat_names, filename):
+    """
+    bench_eval_shards のワーカープロセス (シャード分を照合して途中結果を書き出す)
+    """
+    from .eval_shard import make_partial_state, save_partial_state
+
+    save_partial_state(filename, make_partial_state(true_dicts, pred_dicts, classes, file_indices=file_indices, cat_names=cat_names))
+
+    return filename
+
+
+def bench_eval_shards(num_images=200, num_shards=4, num_pred=10, num_true=5, h=240, w=320, num_classes=5, seed=0):
+    """
+    シャードごとに別プロセスで照合して途中結果をまとめたものと、1プロセスでの make_info_dicts_stream の時間を比較する
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from .calc_ap import make_info_dicts_stream, AP_THRESHOLDS
+    from .eval_shard import shard_indices, load_partial_state, merge_partial_states, partial_state_to_df_dicts
+
+    rng = np.random.RandomState(seed)
+    classes = list(range(num_classes))
+    cat_names = ['class{}'.format(c) for c in classes]
+
+    true_dicts = [make_synthetic_eval_dict('img{}'.format(i), num_true, h, w, num_classes, rng) for i in range(num_images)]
+    pred_dicts = [make_synthetic_eval_dict('img{}'.format(i), num_pred, h, w, num_classes, rng, pred=True) for i in range(num_images)]
+
+    print('eval_shards: {} images / {} shards, pred {} x true {}, {} classes, {} thresholds'.format(
+        num_images, num_shards, num_pred, num_true, num_classes, len(AP_THRESHOLDS)))
+
+    with tempfile.TemporaryDirectory() as dirname, ProcessPoolExecutor(num_shards) as executor:
+        def run_shards():
+            futures = []
+            for shard_index in range(num_shards):
+                indices = shard_indices(num_images, shard_index, num_shards)
+                futures.append(executor.submit(_eval_shard_worker, [true_dicts[i] for i in indices], [pred_dicts[i] for i in indices],
+                                               classes, indices, cat_names, os.path.join(dirname, 'eval_{}.npz'.format(shard_index))))
+
+            # 終わった順に読んでもまとめた結果は同じ
+            return partial_state_to_df_dicts(merge_partial_states(load_partial_state(future.result()) for future in reversed(futures)))
+
+        t_full = timeit(lambda: make_info_dicts_stream(true_dicts, pred_dicts, classes, AP_THRESHOLDS), 1)
+        t_shards = timeit(run_shards, 1)
+
+    print('  {:12s}: {:8.1f} ms'.format('full', t_full * 1000))
+    print('  {:12s}: {:8.1f} ms (x{:.1f}, プロセス起動を含む)'.format('shards', t_shards * 1000, t_full / t_shards))
+
+
+# 縦横比の混ざった推論用の画像サイズ (h, w)
+PREDICTOR_IMAGE_SIZES = [(480, 640), (720, 1280), (640, 480), (1280, 720), (600, 600), (400, 1000)]
+
+
+def bench_predictor(config_file=None, weights=None, num_images=12, batch_size=4, num_workers=4, device='cpu', seed=0):
+    """
+    DefaultPredictor (1枚ずつ) と MachikadoPredictor (入力順のバッチ・縦横比でまとめたバッチ) の
+    images/sec とバッチあたりの時間・パディングの割合を比較する
+
+    config_file: 学習に使った設定ファイル (None なら model zoo の Mask R-CNN R50-FPN)
+    weights: 学習済みの重み (None ならランダムな重みで計測する)
+    """
+    from detectron2.config import get_cfg
+    from detectron2.engine import DefaultPredictor
+    from .MachikadoPredictor import MachikadoPredictor
+    from .custom_config import append_custom_cfg
+
+    cfg = get_cfg()
+    append_custom_cfg(cfg)
+    if config_file is None:
+        from detectron2 import model_zoo
+        config_file = model_zoo.get_config_file('COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml')
+    cfg.merge_from_file(config_file)
+    cfg.MODEL.WEIGHTS = weights or ''
+    cfg.MODEL.DEVICE = device
+
+    rng = np.random.default_rng(seed)
+    images = [rng.integers(0, 256, PREDICTOR_IMAGE_SIZES[i % len(PREDICTOR_IMAGE_SIZES)] + (3,), dtype=np.uint8)
+              for i in range(num_images)]
+
+    print('predictor: {} images, batch {} ({}, {} threads)'.format(num_images, batch_size, device, num_workers))
+
+    def padding_ratio(predictor):
+        # バッチ内で最大の画像に合わせてパディングされる画素の割合
+        resized = [predictor.get_resized_size(*image.shape[:2]) for image in images]
+        padded = 0
+        for batch in predictor.make_batches([image.shape[:2] for image in images]):
+            h, w = np.max([resized[i] for i in batch], axis=0)
+            padded += h * w * len(batch)
+        return 1 - sum(h * w for h, w in resized) / padded
+
+    predictor = DefaultPredictor(cfg)
+    predictor(images[0])  # 初回だけかかる処理を除く
+
+    t = timeit(lambda: [predictor(image) for image in images], 1)
+    base = t
+    print('  {:20s}: {:6.2f} images/sec, {:8.1f} ms / image'.format('default', num_images / t, t / num_images * 1000))
+
+    for name, bucketing in [('batch (input order)', False), ('batch (bucketed)', True)]:
+        predictor = MachikadoPredictor(cfg, batch_size=batch_size, num_workers=num_workers, bucketing=bucketing)
+
+        t = timeit(lambda: predictor(images), 1)
+        num_batches = (num_images + batch_size - 1) // batch_size
+        print('  {:20s}: {:6.2f} images/sec, {:8.1f} ms / batch, padding {:5.1%} (x{:.1f})'.format(
+            name, num_images / t, t / num_batches * 1000, padding_ratio(predictor), base / t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='machikado_util ベンチマーク')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('iou', help='IoU 行列の計算')
+    p.add_argument('--num-pred', type=int, default=30)
+    p.add_argument('--num-true', type=int, default=20)
+    p.add_argument('--height', type=int, default=720)
+    p.add_argument('--width', type=int, default=1280)
+    p.add_argument('--repeat', type=int, default=3)
+
+    p = subparsers.add_parser('workers', help='IoU 計算の並列化')
+    p.add_argument('--num-images', type=int, default=64)
+    p.add_argument('--mask-format', choices=['dense', 'rle'], default='dense')
+    p.add_argument('--repeat', type=int, default=1)
+
+    p = subparsers.add_parser('mapper_copy', help='マッパーのレコード複製 (要 detectron2)')
+    p.add_argument('--num-instances', type=int, default=20)
+    p.add_argument('--num-points', type=int, default=500)
+
+    p = subparsers.add_parser('photometric', help='コントラスト・明るさ・彩度の変更 (要 detectron2)')
+    p.add_argument('--num-images', type=int, default=16)
+    p.add_argument('--height', type=int, default=720)
+    p.add_argument('--width', type=int, default=1280)
+    p.add_argument('--repeat', type=int, default=3)
+
+    p = subparsers.add_parser('clip', help='ポリゴンのクリッピング')
+    p.add_argument('--num-polygons', type=int, default=500)
+    p.add_argument('--num-points', type=int, default=100)
+    p.add_argument('--repeat', type=int, default=3)
+
+    p = subparsers.add_parser('batch_mapper', help='ミニバッチ単位のマッパーと、1枚ずつのマッパーの処理速度 (要 detectron2)')
+    p.add_argument('--batch-size', type=int, default=4)
+    p.add_argument('--num-workers', type=int, default=4)
+
+    p = subparsers.add_parser('mapper', help='設定ごとのマッパーの処理速度と段階ごとの時間 (要 detectron2)')
+    p.add_argument('--num-samples', type=int, default=64)
+    p.add_argument('--configs', nargs='*', default=None, help='計測する設定名 (none, contrast, ..., all, "all fused")')
+    p.add_argument('--no-profile', action='store_true')
+    p.add_argument('--min-samples-per-sec', type=float, default=0, help='これを下回る設定・失敗したサンプルがあれば終了コード 1 にする')
+
+    p = subparsers.add_parser('predictor', help='DefaultPredictor と MachikadoPredictor の推論速度 (要 detectron2)')
+    p.add_argument('--config-file', default=None)
+    p.add_argument('--weights', default=None)
+    p.add_argument('--num-images', type=int, default=12)
+    p.add_argument('--batch-size', type=int, default=4)
+    p.add_argument('--num-workers', type=int, default=4)
+    p.add_argument('--device', default='cpu')
+
+    p = subparsers.add_parser('pre_rec', help='pre, rec, AP の計算 (ベクトル化前のループとの比較)')
+    p.add_argument('--num-records', type=int, default=20000)
+
+    p = subparsers.add_parser('stream', help='従来の評価と evaluate_stream の比較 (要 detectron2)')
+    p.add_argument('--num-images', type=int, default=16)
+
+    p = subparsers.add_parser('incremental', help='画像を差し替えたときの AP の再計算 (要 detectron2)')
+    p.add_argument('--num-images', type=int, default=200)
+    p.add_argument('--num-changed', type=int, default=5)
+
+    p = subparsers.add_parser('eval_shards', help='シャードごとの照合と途中結果のまとめ (要 detectron2)')
+    p.add_argument('--num-images', type=int, default=200)
+    p.add_argument('--num-shards', type=int, default=4)
+
+    args = parser.parse_args()
+
+    if args.command == 'iou':
+        bench_iou(num_pred=args.num_pred, num_true=args.num_true, h=args.height, w=args.width, repeat=args.repeat)
+    elif args.command == 'workers':
+        bench_workers(num_images=args.num_images, mask_format=args.mask_format, repeat=args.repeat)
+    elif args.command == 'mapper_copy':
+        bench_mapper_copy(num_instances=args.num_instances, num_points=args.num_points)
+    elif args.command == 'photometric':
+        bench_photometric(num_images=args.num_images, h=args.height, w=args.width, repeat=args.repeat)
+    elif args.command == 'clip':
+        bench_clip(num_polygons=args.num_polygons, num_points=args.num_points, repeat=args.repeat)
+    elif args.command == 'batch_mapper':
+        bench_batch_mapper(batch_size=args.batch_size, num_workers=args.num_workers)
+    elif args.command == 'pre_rec':
+        bench_pre_rec(num_records=args.num_records)
+    elif args.command == 'stream':
+        bench_stream(num_images=args.num_images)
+    elif args.command == 'incremental':
+        bench_incremental(num_images=args.num_images, num_changed=args.num_changed)
+    elif args.command == 'eval_shards':
+        bench_eval_shards(num_images=args.num_images, num_shards=args.num_shards)
+    elif args.command == 'predictor':
+        bench_predictor(config_file=args.config_file, weights=args.weights, num_images=args.num_images,
+                        batch_size=args.batch_size, num_workers=args.num_workers, device=args.device)
+    elif args.command == 'mapper':
+        ok = bench_mapper(num_samples=args.num_samples, configs=args.configs, profile=not args.no_profile,
+                          min_samples_per_sec=args.min_samples_per_sec)
+        if not ok:
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import itertools
+import logging
+import torch.utils.data
+
+from detectron2.data import samplers
+from detectron2.data.build import get_detection_dataset_dicts, trivial_batch_collator, worker_init_reset_seed
+from detectron2.data.common import DatasetFromList
+from detectron2.utils import comm
+from detectron2.utils.comm import get_world_size
+
+from .MachikadoBatchMapper import MachikadoBatchMapper
+from .MachikadoDatasetMapper import MachikadoDatasetMapper
+from .sample_rng import make_shuffle_rng
+
+
+class SeededTrainingSampler(torch.utils.data.sampler.Sampler):
+    """
+    TrainingSampler と同じく無限にデータセットの番号を返すが、番号の代わりに (epoch, index) を返す
+    並び順は (seed, epoch) から決まるので、ワーカー数・GPU 数を変えても同じエポックの同じサンプルには同じ番号が付く
+    """
+    def __init__(self, size, seed, shuffle=True):
+        """
+        size: データセットのサイズ
+        seed: cfg.INPUT.SEED (0 以上)
+        """
+        assert size > 0 and seed >= 0, 'size: {}, seed: {}'.format(size, seed)
+
+        self._size = size
+        self._seed = seed
+        self._shuffle = shuffle
+        self._rank = comm.get_rank()
+        self._world_size = comm.get_world_size()
+
+    def __iter__(self):
+        yield from itertools.islice(self._infinite_keys(), self._rank, None, self._world_size)
+
+    def _infinite_keys(self):
+        for epoch in itertools.count():
+            if self._shuffle:
+                indices = make_shuffle_rng(self._seed, epoch).permutation(self._size)
+            else:
+                indices = range(self._size)
+
+            for index in indices:
+                yield epoch, int(index)
+
+
+class SeededDatasetFromList(torch.utils.data.Dataset):
+    """
+    SeededTrainingSampler の (epoch, index) を受け取り、レコードに 'sample_id' を付けて返すデータセット
+    (マッパーは 'sample_id' からサンプルごとの乱数を作る)
+    """
+    def __init__(self, dataset_dicts):
+        self._dataset_dicts = dataset_dicts
+
+    def __len__(self):
+        return len(self._dataset_dicts)
+
+    def __getitem__(self, key):
+        epoch, index = key
+        return dict(self._dataset_dicts[index], sample_id=(epoch, index))  # 複製はマッパーで行う
+
+
+def _build_dataset_and_sampler(cfg):
+    """
+    訓練用のデータセットとサンプラーを作る
+    cfg.INPUT.SEED が 0 以上なら、SeededTrainingSampler でサンプルごとの乱数を決める
+    """
+    dataset_dicts = get_detection_dataset_dicts(
+        cfg.DATASETS.TRAIN,
+        filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+        min_keypoints=0,
+        proposal_files=None,
+    )
+
+    sampler_name = cfg.DATALOADER.SAMPLER_TRAIN
+    logger = logging.getLogger(__name__)
+
+    if cfg.INPUT.SEED >= 0:
+        assert sampler_name == 'TrainingSampler', 'INPUT.SEED is supported only with TrainingSampler: {}'.format(sampler_name)
+        logger.info('Using training sampler SeededTrainingSampler (seed: {})'.format(cfg.INPUT.SEED))
+        return SeededDatasetFromList(dataset_dicts), SeededTrainingSampler(len(dataset_dicts), cfg.INPUT.SEED)
+
+    dataset = DatasetFromList(dataset_dicts, copy=False)  # 複製はマッパーで行う
+
+    logger.info('Using training sampler {}'.format(sampler_name))
+    if sampler_name == 'TrainingSampler':
+        sampler = samplers.TrainingSampler(len(dataset))
+    elif sampler_name == 'RepeatFactorTrainingSampler':
+        sampler = samplers.RepeatFactorTrainingSampler(dataset_dicts, cfg.DATALOADER.REPEAT_THRESHOLD)
+    else:
+        raise ValueError('Unknown training sampler: {}'.format(sampler_name))
+
+    return dataset, sampler
+
+
+def _images_per_worker(cfg):
+    num_workers = get_world_size()
+    images_per_batch = cfg.SOLVER.IMS_PER_BATCH
+    assert images_per_batch % num_workers == 0, 'SOLVER.IMS_PER_BATCH ({}) must be divisible by the number of workers ({}).'.format(images_per_batch, num_workers)
+
+    return images_per_batch // num_workers
+
+
+class _MappedDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, mapper):
+        self._dataset = dataset
+        self._mapper = mapper
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, key):
+        return self._mapper(self._dataset[key])
+
+
+def build_batch_train_loader(cfg, mapper=None):
+    """
+    MachikadoBatchMapper をミニバッチ単位の collate_fn として使う訓練用データローダーを作る
+    build_detection_train_loader と同じく、無限に mapper の出力 (レコードのリスト) を返す
+
+    ※ cfg.DATALOADER.ASPECT_RATIO_GROUPING は使わない (マッパーを通す前にバッチが決まるため)
+    ※ cfg.INPUT.SEED が 0 以上なら、水増しの乱数が (SEED, エポック, 番号) から決まる
+
+    mapper: レコードのリストを受け取るマッパー (None なら MachikadoBatchMapper(cfg))
+    """
+    dataset, sampler = _build_dataset_and_sampler(cfg)
+
+    if mapper is None:
+        mapper = MachikadoBatchMapper(cfg, True)
+
+    if cfg.DATALOADER.ASPECT_RATIO_GROUPING:
+        logging.getLogger(__name__).info('ASPECT_RATIO_GROUPING is ignored by build_batch_train_loader.')
+
+    batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, _images_per_worker(cfg), drop_last=True)
+
+    return torch.utils.data.DataLoader(
+        dataset,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        batch_sampler=batch_sampler,
+        collate_fn=mapper,
+        worker_init_fn=worker_init_reset_seed,
+    )
+
+
+def build_seeded_train_loader(cfg, mapper=None):
+    """
+    build_detection_train_loader の代わりに使う訓練用データローダー
+    cfg.INPUT.SEED が 0 以上なら、水増しの乱数が (SEED, エポック, 番号) から決まる
+
+    ※ cfg.DATALOADER.ASPECT_RATIO_GROUPING は使わない
+
+    mapper: レコードを受け取るマッパー (None なら MachikadoDatasetMapper(cfg))
+    """
+    dataset, sampler = _build_dataset_and_sampler(cfg)
+
+    if mapper is None:
+        mapper = MachikadoDatasetMapper(cfg, True)
+
+    if cfg.DATALOADER.ASPECT_RATIO_GROUPING:
+        logging.getLogger(__name__).info('ASPECT_RATIO_GROUPING is ignored by build_seeded_train_loader.')
+
+    batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, _images_per_worker(cfg), drop_last=True)
+
+    return torch.utils.data.DataLoader(
+        _MappedDataset(dataset, mapper),
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        batch_sampler=batch_sampler,
+        collate_fn=trivial_batch_collator,
+        worker_init_fn=worker_init_reset_seed,
+    )
+
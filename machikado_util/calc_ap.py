@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 import cv2
+import itertools
+import queue
+import threading
 
 from logging import getLogger, StreamHandler, DEBUG, INFO
 logger = getLogger(__name__)
@@ -12,26 +15,59 @@ logger.propagate = False
 
 from detectron2.data import DatasetCatalog, MetadataCatalog
 
-def append_masks(dataset_dicts):
+from .calc_iou import calc_iou_matrix, calc_iou_matrices, is_rle_masks
+from .RLEMask import RLEMask
+
+def make_mask(segmentation, height, width):
     """
-    annotations の segmentation から、マスク画像を生成して、新たに masks として追加する
+    segmentation (ポリゴン) からマスク画像を生成する
     """
-    for asset in dataset_dicts:
-        
-        asset['masks'] = []
+    assert len(segmentation)
 
-        for anno in asset['annotations']:
-            assert len(anno['segmentation'])
+    p = segmentation[0]
+    pts = np.vstack([p[::2], p[1::2]]).T
+    pts = pts.astype(np.int)
+
+    t_im = np.zeros((height, width), dtype=np.uint8)
+    return cv2.fillPoly(t_im, [pts], 1).astype(np.bool)
+
+
+def make_masks(annotations, height, width, mask_format='rle'):
+    """
+    annotations の segmentation からマスクを生成する
 
-            p = anno['segmentation'][0]
-            pts = np.vstack([p[::2], p[1::2]]).T
-            pts = pts.astype(np.int)
+    mask_format (str): 'rle' ランレングス (RLEMask のリスト)
+                       'dense' マスク画像 (np.ndarray [N, H, W])
+    """
+    if mask_format == 'rle':
+        return [RLEMask.from_polygon(anno['segmentation'], height, width) for anno in annotations]
+    elif mask_format == 'dense':
+        masks = np.asarray([make_mask(anno['segmentation'], height, width) for anno in annotations])
+        return masks.reshape(len(annotations), height, width)
+    else:
+        raise ValueError('不明な mask_format: {}'.format(mask_format))
 
-            ih, iw = asset['height'], asset['width']
-            t_im = np.zeros((ih, iw), dtype=np.uint8)
-            mask = cv2.fillPoly(t_im, [pts], 1).astype(np.bool)
 
-            asset['masks'].append(mask)
+def convert_pred_masks(pred_masks, mask_format='rle'):
+    """
+    推論結果のマスク (np.ndarray [N, H, W]) を mask_format に変換する
+    """
+    if mask_format == 'rle':
+        return [RLEMask.from_dense(mask) for mask in pred_masks]
+    elif mask_format == 'dense':
+        return pred_masks
+    else:
+        raise ValueError('不明な mask_format: {}'.format(mask_format))
+
+
+def append_masks(dataset_dicts, mask_format='rle'):
+    """
+    annotations の segmentation から、マスクを生成して、新たに masks として追加する
+
+    mask_format (str): 'rle' ランレングス(1インスタンス数百バイト程度) / 'dense' マスク画像
+    """
+    for asset in dataset_dicts:
+        asset['masks'] = list(make_masks(asset['annotations'], asset['height'], asset['width'], mask_format=mask_format))
             
 
 def get_true_datas(catalog_name):
@@ -46,7 +82,8 @@ def get_true_datas(catalog_name):
         for anno in asset['annotations']:
             true_classes.append(anno['category_id'])
 
-        true_classes, true_masks = np.asarray(true_classes), np.asarray(asset['masks'])
+        true_masks = asset['masks'] if is_rle_masks(asset['masks']) else np.asarray(asset['masks'])
+        true_classes = np.asarray(true_classes)
         assert (len(true_classes) == len(true_masks)), '全ての要素数は等しいはず'
 
         true_dict = {'classes': true_classes, 'masks': true_masks, 'file_name': asset['file_name']}
@@ -55,181 +92,368 @@ def get_true_datas(catalog_name):
     return true_dicts
 
 
-def predict_datas(predictor, catalog_name, verbose=False):
+def iter_true_datas(catalog_name, mask_format='rle'):
     """
-    データセットを一括で評価する
+    データセットから評価用にマスクデータとクラスを1画像ずつ取り出す(ストリーミング版)
+    append_masks は不要で、マスクはその都度生成する
     """
-    pred_dicts = []
+    for asset in DatasetCatalog.get(catalog_name):
+        true_classes = np.asarray([anno['category_id'] for anno in asset['annotations']])
+        true_masks = make_masks(asset['annotations'], asset['height'], asset['width'], mask_format=mask_format)
+
+        yield {'classes': true_classes, 'masks': true_masks, 'file_name': asset['file_name']}
+
+
+def _convert_output(output, file_name, mask_format='rle'):
+    """
+    推論結果 (predictor の出力) を評価用の pred_dict にする
+    """
+    pred = output['instances'].get_fields()
+
+    pred_masks = pred['pred_masks'].cpu().numpy()
+    pred_classes = pred['pred_classes'].cpu().numpy()
+    scores = pred['scores'].cpu().numpy()
     
-    for i, asset in enumerate(DatasetCatalog.get(catalog_name)):
-        w, h = asset['width'], asset['height']
+    assert (len(pred_classes) == len(pred_masks) == len(scores)), '全ての要素数は等しいはず'
+    assert np.allclose(np.arange(len(scores)), scores.argsort()[::-1]), \
+        'スコアがソートされていない scores: {}'.format(scores) # ソートされている様なのですがチェック
+
+    return {'classes': pred_classes, 'masks': convert_pred_masks(pred_masks, mask_format),
+            'scores': scores, 'file_name': file_name}
+
+
+def _len_or_none(dataset_dicts):
+    """
+    データセットの件数 (vott.iter_dicts で登録した場合のように、イテレータで数えられないときは None)
+    """
+    return len(dataset_dicts) if hasattr(dataset_dicts, '__len__') else None
+
+
+def _format_progress(i, num):
+    """
+    進捗の表示 (件数が分からないときは何件目かだけ)
+    """
+    return '{:4d}/{:4d}'.format(i, num) if num is not None else '{:4d}'.format(i)
+
+
+def iter_pred_datas(predictor, catalog_name, verbose=False, mask_format='rle', cache=None, score_thresh=None):
+    """
+    データセットを1画像ずつ推論する(ストリーミング版)
+
+    cache: PredictionCache を指定すると、キャッシュにない画像だけを推論する
+    score_thresh: キャッシュから読み出すときのスコアのしきい値 (None なら cache を作った設定の SCORE_THRESH_TEST)
+    """
+    dataset_dicts = DatasetCatalog.get(catalog_name)
+    num = _len_or_none(dataset_dicts)
+
+    for i, asset in enumerate(dataset_dicts):
+        if cache is not None:
+            key = cache.image_key(asset['file_name'])
+            record = cache.get(key, score_thresh)
+            if record is not None:
+                yield cache.to_pred_dict(record, asset['file_name'], score_thresh=score_thresh, mask_format=mask_format)
+                continue
+
         img = cv2.imread(asset['file_name'])
 
         if verbose:
-            print('predict ({:4d}/{:4d}): {}'.format(i + 1, len(DatasetCatalog.get(catalog_name)), asset["file_name"]))
+            print('predict ({}): {}'.format(_format_progress(i + 1, num), asset["file_name"]))
         output = predictor(img)
 
-        pred = output['instances'].get_fields()
+        if cache is not None:
+            record = cache.put(key, output, cache.get_min_score(predictor))
+            yield cache.to_pred_dict(record, asset['file_name'], score_thresh=score_thresh, mask_format=mask_format)
+        else:
+            yield _convert_output(output, asset['file_name'], mask_format)
 
-        pred_masks = pred['pred_masks'].cpu().numpy()
-        pred_classes = pred['pred_classes'].cpu().numpy()
-        scores = pred['scores'].cpu().numpy()
-        
-        assert (len(pred_classes) == len(pred_masks) == len(scores)), '全ての要素数は等しいはず'
-        assert np.allclose(np.arange(len(scores)), scores.argsort()[::-1]), \
-            'スコアがソートされていない scores: {}'.format(scores) # ソートされている様なのですがチェック
 
-        pred_dict = {'classes': pred_classes, 'masks': pred_masks, 'scores': scores, 'file_name': asset['file_name']}
-        pred_dicts.append(pred_dict)
-    
-    return pred_dicts
+def predict_datas(predictor, catalog_name, verbose=False, mask_format='rle', cache=None, score_thresh=None):
+    """
+    データセットを一括で評価する
+    """
+    return list(iter_pred_datas(predictor, catalog_name, verbose=verbose, mask_format=mask_format,
+                                cache=cache, score_thresh=score_thresh))
 
 
-def predict_datas_batch(predictor, catalog_name, verbose=False):
+def _put(q, item, stop):
     """
-    データセットを一括で評価する(バッチ処理版)
+    キューが空くか stop がセットされるまで待って入れる (stop で中断した場合は False)
     """
-    inputs = []
-    for i, asset in enumerate(DatasetCatalog.get(catalog_name)):
-        w, h = asset['width'], asset['height']
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _iter_in_thread(iterable, maxsize, stop):
+    """
+    iterable をバックグラウンドのスレッドで回し、最大 maxsize 個まで先に進めておくジェネレータ
+    スレッドで起きた例外は受け取る側で送出する。stop がセットされたら両側とも終了する
+    """
+    q = queue.Queue(maxsize)
+
+    def run():
+        try:
+            for item in iterable:
+                if not _put(q, (True, item), stop):
+                    return
+        except BaseException as e:
+            _put(q, (False, e), stop)
+            return
+        _put(q, (False, None), stop)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    while not stop.is_set():
+        try:
+            ok, item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        if ok:
+            yield item
+        elif item is None:
+            return
+        else:
+            raise item
+
+
+def _read_assets(dataset_dicts, cache=None, score_thresh=None):
+    """
+    (asset, 画像, キャッシュのキー, キャッシュされた検出) を返す
+    キャッシュにある画像は読み込まない (画像は None)
+    """
+    for asset in dataset_dicts:
+        key = record = None
+        if cache is not None:
+            key = cache.image_key(asset['file_name'])
+            record = cache.get(key, score_thresh)
+            if record is not None:
+                yield asset, None, key, record
+                continue
+
         img = cv2.imread(asset['file_name'])
-        inputs.append(img)
+        assert img is not None, '画像を読み込めない: {}'.format(asset['file_name'])
 
-    outputs = predictor(inputs)
+        yield asset, img, key, record
 
-    pred_dicts = []
-    for output in outputs:
-        pred = output['instances'].get_fields()
 
-        pred_masks = pred['pred_masks'].numpy()
-        pred_classes = pred['pred_classes'].numpy()
-        scores = pred['scores'].numpy()
-        
-        assert (len(pred_classes) == len(pred_masks) == len(scores)), '全ての要素数は等しいはず'
-        assert np.allclose(np.arange(len(scores)), scores.argsort()[::-1]), \
-            'スコアがソートされていない scores: {}'.format(scores) # ソートされている様なのですがチェック
+def _predict_batches(predictor, items, batch_size, num, verbose=False):
+    """
+    キャッシュにない画像を batch_size ずつ predictor に渡して、(asset, キャッシュのキー, キャッシュされた検出, 推論結果) を返す
+    順番を保つため、キャッシュにある画像は前の画像の推論が終わるまで待たせる
+    num: データセットの件数 (進捗の表示用。None なら件数は表示しない)
+    """
+    done = 0
+    pending = []  # 推論待ちの画像と、その間にあるキャッシュ済みの画像
 
-        pred_dict = {'classes': pred_classes, 'masks': pred_masks, 'scores': scores, 'file_name': asset['file_name']}
-        pred_dicts.append(pred_dict)
-    
-    return pred_dicts
+    def flush():
+        misses = [item for item in pending if item[3] is None]
+        if verbose and len(misses):
+            print('predict ({}): {}'.format(_format_progress(done, num), misses[-1][0]['file_name']))
+        outputs = iter(predictor([item[1] for item in misses]) if len(misses) else [])
+
+        for asset, _, key, record in pending:
+            yield asset, key, record, next(outputs) if record is None else None
+        pending.clear()
 
+    num_misses = 0
+    for item in items:
+        pending.append(item)
+        done += 1
+        num_misses += item[3] is None
 
-def make_info_dict(true_dicts, pred_dicts, classes, th, debug=True):
+        if num_misses == batch_size:
+            yield from flush()
+            num_misses = 0
+
+    yield from flush()
+
+
+def iter_pred_datas_batch(predictor, catalog_name, batch_size=None, queue_size=None, verbose=False, mask_format='rle',
+                          cache=None, score_thresh=None):
     """
-    AP の計算に必要なデータを生成する
+    データセットをバッチで推論する(パイプライン版)
+
+    画像の読み込み・推論・結果の変換 (と、受け取った側での照合) をそれぞれ別のスレッドで並行して行う
+    キューの長さに上限があるので、メモリには数バッチ分の画像と推論結果しか載らない
+
+    predictor: 画像のリストを受け取り、推論結果のリストを返すもの (MachikadoPredictor)
+    batch_size: 1回に predictor に渡す画像数 (None なら predictor.batch_size)
+    queue_size: 読み込んでおく画像数の上限 (None なら batch_size の2倍)
+    cache: PredictionCache を指定すると、キャッシュにない画像だけを推論する
+    score_thresh: キャッシュから読み出すときのスコアのしきい値 (None なら cache を作った設定の SCORE_THRESH_TEST)
+    """
+    dataset_dicts = DatasetCatalog.get(catalog_name)
+
+    batch_size = batch_size or getattr(predictor, 'batch_size', 1)
+    queue_size = queue_size or batch_size * 2
+
+    stop = threading.Event()
+    try:
+        images = _iter_in_thread(_read_assets(dataset_dicts, cache=cache, score_thresh=score_thresh), queue_size, stop)
+        outputs = _iter_in_thread(_predict_batches(predictor, images, batch_size, _len_or_none(dataset_dicts), verbose=verbose),
+                                  batch_size * 2, stop)
+
+        for asset, key, record, output in outputs:
+            if cache is None:
+                yield _convert_output(output, asset['file_name'], mask_format)
+                continue
+
+            if record is None:
+                record = cache.put(key, output, cache.get_min_score(predictor))
+            yield cache.to_pred_dict(record, asset['file_name'], score_thresh=score_thresh, mask_format=mask_format)
+    finally:
+        stop.set()  # 途中でやめた場合もスレッドを終わらせる
+
+
+def predict_datas_batch(predictor, catalog_name, verbose=False, mask_format='rle', batch_size=None, queue_size=None,
+                        cache=None, score_thresh=None):
+    """
+    データセットを一括で評価する(バッチ処理版)
+    読み込み・推論・変換は iter_pred_datas_batch で並行して行う
+    """
+    return list(iter_pred_datas_batch(predictor, catalog_name, batch_size=batch_size, queue_size=queue_size,
+                                      verbose=verbose, mask_format=mask_format, cache=cache, score_thresh=score_thresh))
+
+
+INFO_COLUMNS = ['file_i', 'pred_i', 'score','correct', 'pre', 'rec', 'iou']
+
+# AP@[.50:.95] の IoU しきい値
+AP_THRESHOLDS = [round(th, 2) for th in np.arange(0.5, 0.96, 0.05)]
+
+
+def calc_iou_lists(true_dicts, pred_dicts, iou_method='matmul', workers=1):
+    """
+    画像ごとの IoU 行列 [予想数, 教師数] を計算する
+    make_info_dict などに iou_lists として渡せば、しきい値を変えて何度評価しても IoU は再計算しない
+
+    workers (int): 2以上なら画像ごとにプロセスを分けて並列に計算する (calc_iou.calc_iou_matrices を参照)
     """
     assert len(true_dicts) == len(pred_dicts), '要素数は等しいはず'
 
-    columns = ['file_i', 'pred_i', 'score','correct', 'pre', 'rec', 'iou']
-    tmp_dicts = {_cls: {col: [] for col in columns} for _cls in classes}
-    
-    num_true_cls_count = {_cls: 0 for _cls in classes}  # TP の数をカウント
+    mask_pairs = [(pred_dict['masks'], true_dict['masks']) for true_dict, pred_dict in zip(true_dicts, pred_dicts)]
 
-    for file_i, (true_dict, pred_dict) in enumerate(zip(true_dicts, pred_dicts)):
-        logger.debug('<<fille_i: {}>> =========================================================='.format(file_i))
-        logger.debug('true_dict: {}'. format(true_dict['classes']))
-        logger.debug('pred_dict: {}'. format(pred_dict['classes']))
-        
-        iou_list = [[] for _ in true_dict['classes']]
-        p_scores = []
+    return calc_iou_matrices(mask_pairs, method=iou_method, workers=workers)
 
-        # 予想された物に対して、それぞれ教師データとの IoU を計算する
-        for pred_i, (p_cls, p_mask, p_score) in enumerate(zip(pred_dict['classes'], pred_dict['masks'], pred_dict['scores'])):
-            p_scores.append(p_score)
 
-            for i, (t_cls, t_mask) in enumerate(zip(true_dict['classes'], true_dict['masks'])):
-                iou = (t_mask & p_mask).sum() / (p_mask | t_mask).sum()
-                iou_list[i].append(iou)
-                
-        p_scores = np.asarray(p_scores)
-        iou_list = np.asarray(iou_list).T
+def match_image(true_dict, pred_dict, th, iou_method='matmul', iou_list=None):
+    """
+    1画像分の予想と教師データを照合して、教師データに含まれるクラスごとの記録を返す
+
+    iou_list (np.ndarray): 計算済みの IoU 行列 [予想数, 教師数] (None なら計算する)
+
+    Returns:
+        dict -- {クラス: (教師データ数, {'score': ..., 'correct': ..., 'iou': ...})}
+    """
+    logger.debug('true_dict: {}'. format(true_dict['classes']))
+    logger.debug('pred_dict: {}'. format(pred_dict['classes']))
+
+    # 予想された物に対して、それぞれ教師データとの IoU を計算する [予想数, 教師数]
+    p_scores = np.asarray(pred_dict['scores'])
+    if iou_list is None:
+        iou_list = calc_iou_matrix(pred_dict['masks'], true_dict['masks'], method=iou_method)
 
-        # 教師データに含まれる各クラスについてそれぞれ correct? を計算する
-        u_classes = np.unique(true_dict['classes'])
+    # 教師データに含まれる各クラスについてそれぞれ correct? を計算する
+    u_classes = np.unique(true_dict['classes'])
+    
+    logger.debug('iou_list:')
+    logger.debug(iou_list)
+    logger.debug('u_classes: {}'.format(u_classes))
+
+    records = {}
+
+    for u_cls in u_classes:
+        logger.debug('[u_cls: {}] *********************'.format(u_cls))
+        # 該当クラス u_cls の iou を取得する
+        t_indices = np.where(true_dict['classes'] == u_cls)[0]
+        p_indices = np.where(pred_dict['classes'] == u_cls)[0]
+        u_iou_list = iou_list[:, t_indices][p_indices, :]
         
-        logger.debug('iou_list:')
-        logger.debug(iou_list)
-        logger.debug('u_classes: {}'.format(u_classes))
-
-        for u_cls in u_classes:
-            logger.debug('[u_cls: {}] *********************'.format(u_cls))
-            # 該当クラス u_cls の iou を取得する
-            t_indices = np.where(true_dict['classes'] == u_cls)[0]
-            p_indices = np.where(pred_dict['classes'] == u_cls)[0]
-            u_iou_list = iou_list[:, t_indices][p_indices, :]
-            u_scores = p_scores[p_indices]
-            
-            logger.debug('t_indices: {} (len:{})'.format(t_indices, len(t_indices)))
-            logger.debug('p_indices: {} (len:{})'.format(p_indices, len(p_indices)))
-            
-            # IoU のしきい値で正解ラベルを処理
-            correct_list = u_iou_list > th
-            
-            logger.debug('correct_list:\n{}'.format(correct_list))
+        logger.debug('t_indices: {} (len:{})'.format(t_indices, len(t_indices)))
+        logger.debug('p_indices: {} (len:{})'.format(p_indices, len(p_indices)))
+        
+        # IoU のしきい値で正解ラベルを処理
+        correct_list = u_iou_list > th
+        
+        logger.debug('correct_list:\n{}'.format(correct_list))
+        
+        
+        # ダブルカウントされた場合の処理
+        if (correct_list.sum(axis=0) > 1).sum() > 0:
+            logger.debug('p_scores: {} (len:{})'.format(p_scores, len(p_scores)))
             
+            w_count_col = np.where(correct_list.sum(axis=0) > 1)[0]
             
-            # ダブルカウントされた場合の処理
-            if (correct_list.sum(axis=0) > 1).sum() > 0:
-                logger.debug('p_scores: {} (len:{})'.format(p_scores, len(p_scores)))
+            for i in w_count_col:
+                i = w_count_col[0]
+                max_iou_row = u_iou_list[:, i].argmax()
                 
-                w_count_col = np.where(correct_list.sum(axis=0) > 1)[0]
+                # 最大の IoU 以外を False にする
+                m = np.ones((correct_list.shape[0], 1), dtype=np.bool)
+                m[max_iou_row] = False
+                correct_list[:, [i]] = m
                 
-                for i in w_count_col:
-                    i = w_count_col[0]
-                    max_iou_row = u_iou_list[:, i].argmax()
-                    
-                    # 最大の IoU 以外を False にする
-                    m = np.ones((correct_list.shape[0], 1), dtype=np.bool)
-                    m[max_iou_row] = False
-                    correct_list[:, [i]] = m
-                    
-                logger.debug('correct_list:\n{}'.format(correct_list))
-                logger.info('ダブルカウント！')
+            logger.debug('correct_list:\n{}'.format(correct_list))
+            logger.info('ダブルカウント！')
 #                 assert False
-                    
-            num_true_cls_count[u_cls] += len(t_indices)  # true ラベルをカウント
-            
-            # 値を格納
-            tmp_dict = tmp_dicts[u_cls]
-            tmp_dict['file_i'] += [file_i] * len(p_indices)
-            tmp_dict['pred_i'] += list(range(len(p_indices)))
-            tmp_dict['score'] += list(p_scores[p_indices])
-            tmp_dict['correct'] += list(correct_list.sum(axis=1) > 0)
-            tmp_dict['pre'] += [None] * len(p_indices)
-            tmp_dict['rec'] += [None] * len(p_indices)
-            tmp_dict['iou'] += list(u_iou_list.max(axis=1))
-            
-            logger.debug('num_true_cls_count: {}'.format(num_true_cls_count))
-            
-        logger.debug('\n')
-    
-    # pre, rec を計算する
-    df_dict = {_cls: pd.DataFrame(tmp_dicts[_cls], columns=columns) for _cls in tmp_dicts.keys()}
+
+        records[u_cls] = (len(t_indices), {
+            'score': p_scores[p_indices],
+            'correct': correct_list.sum(axis=1) > 0,
+            'iou': u_iou_list.max(axis=1),
+        })
+
+    return records
+
+
+def calc_pre_rec(scores, corrects, num_true):
+    """
+    スコアの降順に並べて precision, recall を累積和で求める
+    同じスコアは元の順番 ((file_i, pred_i) の順) のまま並べる (pycocotools と同じ安定ソート)
+    ※ 以前の sort_values (quicksort) は同じスコアの順番が決まっていなかったので、同点があると AP が少し変わる
+
+    Returns:
+        order -- スコアの降順に並べるインデックス
+        pre, rec -- order の順に並べた precision, recall
+    """
+    order = np.argsort(-np.asarray(scores), kind='mergesort')
+    tp = np.cumsum(np.asarray(corrects, dtype=np.int64)[order])
+
+    pre = tp / np.arange(1, len(tp) + 1)
+    rec = tp / num_true if num_true > 0 else np.zeros(len(tp))
+
+    return order, pre, rec
+
+
+def make_df_dict(tmp_dicts, num_true_cls_count):
+    """
+    クラスごとに集めた記録から pre, rec を計算して DataFrame にする
+
+    tmp_dicts: {クラス: {列名: 画像ごとの np.ndarray のリスト}}
+    """
+    df_dict = {}
     
     logger.debug('\n')
     
-    for u_cls in df_dict.keys():
+    for u_cls in tmp_dicts.keys():
         logger.debug('[u_cls: {}] *********************'.format(u_cls))
-        
-        df = df_dict[u_cls]
-        df.sort_values('score', ascending=False, inplace=True)
-        
-        TP_count = 0
-        pres = []
-        recs = []
-        
-        for i in range(len(df)):
-            se = df.iloc[i, :]
 
-            if se['correct']:
-                TP_count += 1
+        cols = {col: np.concatenate(tmp_dicts[u_cls][col]) if len(tmp_dicts[u_cls][col]) else np.zeros(0)
+                for col in ['file_i', 'pred_i', 'score', 'correct', 'iou']}
+        cols['correct'] = cols['correct'].astype(bool)
 
-            pres.append(TP_count / (i + 1))
-            recs.append(TP_count / num_true_cls_count[u_cls])
+        order, pre, rec = calc_pre_rec(cols['score'], cols['correct'], num_true_cls_count[u_cls])
 
-        df['pre'] = pres
-        df['rec'] = recs
+        # DataFrame にするのは最後だけ
+        df = pd.DataFrame({col: cols[col][order] for col in cols}, index=order, columns=INFO_COLUMNS)
+        df['pre'] = pre
+        df['rec'] = rec
+        df_dict[u_cls] = df
         
         logger.debug('num_true_cls_count[u_cls]: {}'.format(num_true_cls_count[u_cls]))
         logger.debug(df)
@@ -237,9 +461,150 @@ def make_info_dict(true_dicts, pred_dicts, classes, th, debug=True):
     return df_dict
 
 
-def calc_AP(df_dict, cat_names):
+def collect_match_records(true_iter, pred_iter, classes, ths, iou_method='matmul', iou_lists=None):
+    """
+    画像ごとに照合して、しきい値・クラスごとの記録と教師データ数を集める (make_info_dicts_stream の前半)
+    IoU は画像ごとに1回だけ計算し、全てのしきい値で使い回す
+
+    Returns:
+        tmp_dicts -- {しきい値: {クラス: {列名: 画像ごとの np.ndarray のリスト}}}
+        num_true_cls_count -- {クラス: 教師データ数}
+    """
+    tmp_dicts = {th: {_cls: {col: [] for col in INFO_COLUMNS} for _cls in classes} for th in ths}
+    
+    num_true_cls_count = {_cls: 0 for _cls in classes}  # TP の数をカウント
+
+    if iou_lists is None:
+        iou_lists = itertools.repeat(None)
+
+    for file_i, (true_dict, pred_dict, iou_list) in enumerate(zip(true_iter, pred_iter, iou_lists)):
+        logger.debug('<<fille_i: {}>> =========================================================='.format(file_i))
+
+        if iou_list is None:
+            iou_list = calc_iou_matrix(pred_dict['masks'], true_dict['masks'], method=iou_method)
+
+        for th_i, th in enumerate(ths):
+            for u_cls, (num_true, record) in match_image(true_dict, pred_dict, th, iou_list=iou_list).items():
+                if th_i == 0:
+                    num_true_cls_count[u_cls] += num_true  # true ラベルをカウント
+                num_pred = len(record['score'])
+
+                # 値を格納
+                tmp_dict = tmp_dicts[th][u_cls]
+                tmp_dict['file_i'].append(np.full(num_pred, file_i, dtype=np.int64))
+                tmp_dict['pred_i'].append(np.arange(num_pred))
+                tmp_dict['score'].append(record['score'])
+                tmp_dict['correct'].append(record['correct'])
+                tmp_dict['iou'].append(record['iou'])
+            
+        logger.debug('num_true_cls_count: {}'.format(num_true_cls_count))
+        logger.debug('\n')
+
+    return tmp_dicts, num_true_cls_count
+
+
+def make_info_dicts_stream(true_iter, pred_iter, classes, ths, iou_method='matmul', iou_lists=None):
+    """
+    複数の IoU しきい値について AP の計算に必要なデータを生成する(ストリーミング版)
+    IoU は画像ごとに1回だけ計算し、全てのしきい値で使い回す
+
+    true_iter, pred_iter は1画像ずつ true_dict, pred_dict を返すイテレータ (iter_true_datas, iter_pred_datas)
+    照合が終わった画像のマスクは保持しないので、メモリ使用量はデータセットの大きさに依存しない
+    iou_lists: calc_iou_lists で計算済みの IoU 行列のイテレータ (None なら計算する)
+
+    Returns:
+        dict -- {しきい値: df_dict}
+    """
+    tmp_dicts, num_true_cls_count = collect_match_records(true_iter, pred_iter, classes, ths,
+                                                          iou_method=iou_method, iou_lists=iou_lists)
+    
+    # pre, rec を計算する
+    return {th: make_df_dict(tmp_dicts[th], num_true_cls_count) for th in ths}
+
+
+def make_info_dict_stream(true_iter, pred_iter, classes, th, iou_method='matmul'):
+    """
+    AP の計算に必要なデータを生成する(ストリーミング版)
+
+    true_iter, pred_iter は1画像ずつ true_dict, pred_dict を返すイテレータ (iter_true_datas, iter_pred_datas)
+    照合が終わった画像のマスクは保持しないので、メモリ使用量はデータセットの大きさに依存しない
+    """
+    return make_info_dicts_stream(true_iter, pred_iter, classes, [th], iou_method=iou_method)[th]
+
+
+def make_info_dict(true_dicts, pred_dicts, classes, th, debug=True, iou_method='matmul', iou_lists=None, workers=1):
+    """
+    AP の計算に必要なデータを生成する
+
+    iou_method (str): IoU の計算方法 (calc_iou.calc_iou_matrix を参照)
+    iou_lists (list): calc_iou_lists で計算済みの IoU 行列 (None なら計算する)
+    workers (int): 2以上なら IoU の計算を画像ごとに並列化する (結果は直列と同じ)
+    """
+    assert len(true_dicts) == len(pred_dicts), '要素数は等しいはず'
+
+    if iou_lists is None and workers > 1:
+        iou_lists = calc_iou_lists(true_dicts, pred_dicts, iou_method=iou_method, workers=workers)
+
+    return make_info_dicts_stream(true_dicts, pred_dicts, classes, [th], iou_method=iou_method, iou_lists=iou_lists)[th]
+
+
+def evaluate_stream(predictor, catalog_name, classes, th, iou_method='matmul', verbose=False, mask_format='rle',
+                    batch_size=None, cache=None, score_thresh=None):
+    """
+    データセットを1画像ずつ推論・照合して AP の計算に必要なデータを生成する
+    (get_true_datas, predict_datas, make_info_dict をまとめて、少ないメモリで行う)
+
+    batch_size: 指定すると、画像のリストを受け取る predictor (MachikadoPredictor) でバッチ推論する
+                (iter_pred_datas_batch で読み込み・推論と照合を並行して行う)
+    cache: PredictionCache を指定すると、キャッシュにない画像だけを推論する (score_thresh で読み出すしきい値を変えられる)
+    """
+    if batch_size is None:
+        pred_iter = iter_pred_datas(predictor, catalog_name, verbose=verbose, mask_format=mask_format,
+                                    cache=cache, score_thresh=score_thresh)
+    else:
+        pred_iter = iter_pred_datas_batch(predictor, catalog_name, batch_size=batch_size, verbose=verbose, mask_format=mask_format,
+                                          cache=cache, score_thresh=score_thresh)
+
+    return make_info_dict_stream(iter_true_datas(catalog_name, mask_format=mask_format), pred_iter,
+                                 classes, th, iou_method=iou_method)
+
+
+def calc_ap_value(rec, pre, method='trapezoid'):
+    """
+    precision-recall 曲線から AP を求める
+
+    method (str): 'trapezoid' 曲線を台形で積分する
+                  'coco101'   COCO と同じく precision を単調減少に補正して、recall 0〜1 の 101 点で平均する
+    """
+    rec, pre = np.asarray(rec, dtype=np.float64), np.asarray(pre, dtype=np.float64)
+
+    if method == 'trapezoid':
+        # 1つしかない場合は 0
+        if len(rec) < 2:
+            return 0
+
+        # 台形として面積を求めます
+        return float(((pre[1:] + pre[:-1]) * np.diff(rec) / 2).sum())
+    elif method == 'coco101':
+        if len(rec) == 0:
+            return 0
+
+        pre = np.maximum.accumulate(pre[::-1])[::-1]  # その recall 以降の最大の precision
+        idx = np.searchsorted(rec, np.linspace(0, 1, 101), side='left')
+
+        q = np.zeros(101)
+        q[idx < len(rec)] = pre[idx[idx < len(rec)]]
+
+        return float(q.mean())
+    else:
+        raise ValueError('不明な method: {}'.format(method))
+
+
+def calc_AP(df_dict, cat_names, method='trapezoid'):
     """
     AP を計算する
+
+    method (str): AP の求め方 (calc_ap_value を参照)
     """
     columns=['AP', 'iou']
     tmp_dict = {key: [] for key in columns}
@@ -249,20 +614,44 @@ def calc_AP(df_dict, cat_names):
         rec, pre = df['rec'].values, df['pre'].values
 
         # 1つしかない場合は 0
-        if len(rec) < 2:
+        if method == 'trapezoid' and len(rec) < 2:
             tmp_dict['AP'].append(0)
             tmp_dict['iou'].append(0)
             continue
 
-        # 台形として面積を求めます
-        S = 0
-        for i in range(len(rec) - 1):
-            h = rec[i + 1] - rec[i]
-            p1, p2 = pre[i], pre[i + 1]
-
-            S += (p1 + p2) * h / 2
-
-        tmp_dict['AP'].append(S)
+        tmp_dict['AP'].append(calc_ap_value(rec, pre, method=method))
         tmp_dict['iou'].append(df['iou'].mean())
     
-    return pd.DataFrame(tmp_dict, columns=columns, index=(cat_names))
\ No newline at end of file
+    return pd.DataFrame(tmp_dict, columns=columns, index=(cat_names))
+
+
+def calc_AP_table(true_dicts, pred_dicts, classes, cat_names, ths=AP_THRESHOLDS, method='trapezoid',
+                  iou_method='matmul', iou_lists=None, workers=1):
+    """
+    複数の IoU しきい値での AP をまとめて計算する (デフォルトは AP@[.50:.95])
+    IoU の計算は画像ごとに1回だけ
+
+    Returns:
+        pd.DataFrame -- 行がクラス、列がしきい値の AP 表 (mean 列はしきい値での平均)
+    """
+    assert len(true_dicts) == len(pred_dicts), '要素数は等しいはず'
+
+    if iou_lists is None and workers > 1:
+        iou_lists = calc_iou_lists(true_dicts, pred_dicts, iou_method=iou_method, workers=workers)
+
+    df_dicts = make_info_dicts_stream(true_dicts, pred_dicts, classes, ths, iou_method=iou_method, iou_lists=iou_lists)
+
+    return make_AP_table(df_dicts, cat_names, method=method)
+
+
+def make_AP_table(df_dicts, cat_names, method='trapezoid'):
+    """
+    しきい値ごとの df_dict ({しきい値: df_dict}) から AP 表を作る (calc_AP_table を参照)
+    """
+    ths = list(df_dicts.keys())
+
+    df = pd.DataFrame({th: calc_AP(df_dicts[th], cat_names=cat_names, method=method)['AP'] for th in ths},
+                      columns=ths, index=cat_names)
+    df['mean'] = df[ths].mean(axis=1)
+
+    return df
@@ -0,0 +1,203 @@
+import numpy as np
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .RLEMask import RLEMask
+
+
+def calc_mask_bboxes(masks):
+    """
+    マスクごとのバウンディングボックス (x0, y0, x1, y1) を求める ※x1, y1 は含まない
+    空のマスクは (0, 0, 0, 0) になる
+
+    masks (np.ndarray): [N, H, W] の bool 配列
+    """
+    masks = np.asarray(masks)
+    bboxes = np.zeros((len(masks), 4), dtype=np.int64)
+
+    if len(masks) == 0:
+        return bboxes
+
+    rows = masks.any(axis=2)  # [N, H]
+    cols = masks.any(axis=1)  # [N, W]
+    valid = rows.any(axis=1)
+
+    h, w = masks.shape[1:]
+    bboxes[:, 0] = cols.argmax(axis=1)
+    bboxes[:, 1] = rows.argmax(axis=1)
+    bboxes[:, 2] = w - cols[:, ::-1].argmax(axis=1)
+    bboxes[:, 3] = h - rows[:, ::-1].argmax(axis=1)
+    bboxes[~valid] = 0
+
+    return bboxes
+
+
+def _iou_from_inter(inter, p_area, t_area):
+    union = p_area[:, None] + t_area[None, :] - inter
+
+    iou = np.zeros(inter.shape, dtype=np.float64)
+    np.divide(inter, union, out=iou, where=union > 0)  # 両方空のマスクは IoU 0 とする
+
+    return iou
+
+
+def _calc_iou_loop(pred_masks, true_masks):
+    """
+    1ペアずつ IoU を計算する(比較・検証用の素直な実装)
+    """
+    iou = np.zeros((len(pred_masks), len(true_masks)), dtype=np.float64)
+
+    for pred_i, p_mask in enumerate(pred_masks):
+        for true_i, t_mask in enumerate(true_masks):
+            union = (p_mask | t_mask).sum()
+            iou[pred_i, true_i] = (p_mask & t_mask).sum() / union if union > 0 else 0
+
+    return iou
+
+
+def _calc_iou_matmul(pred_masks, true_masks, chunk_size):
+    """
+    全マスクを包含する領域に切り出して平坦化し、交差面積を行列積でまとめて求める
+    """
+    masks = np.concatenate([pred_masks, true_masks])
+    bboxes = calc_mask_bboxes(masks)
+    bboxes = bboxes[bboxes[:, 2] > bboxes[:, 0]]  # 空のマスクは領域計算に含めない
+
+    if len(bboxes) == 0:
+        return np.zeros((len(pred_masks), len(true_masks)), dtype=np.float64)
+
+    x0, y0 = bboxes[:, :2].min(axis=0)
+    x1, y1 = bboxes[:, 2:].max(axis=0)
+
+    num_pred = len(pred_masks)
+    flat = masks[:, y0:y1, x0:x1].reshape(len(masks), -1)
+
+    p_flat, t_flat = flat[:num_pred], flat[num_pred:]
+    p_area = p_flat.sum(axis=1, dtype=np.int64)
+    t_area = t_flat.sum(axis=1, dtype=np.int64)
+
+    # float32 の積和は 2^24 までなら誤差が出ないので、画素方向に分割して float64 で積算する
+    inter = np.zeros((len(p_flat), len(t_flat)), dtype=np.float64)
+    for s in range(0, flat.shape[1], chunk_size):
+        p = p_flat[:, s:s + chunk_size].astype(np.float32)
+        t = t_flat[:, s:s + chunk_size].astype(np.float32)
+        inter += np.dot(p, t.T)
+
+    return _iou_from_inter(inter, p_area, t_area)
+
+
+def _calc_iou_bbox(pred_masks, true_masks):
+    """
+    バウンディングボックスが重なるペアのみ、重なり部分だけで交差面積を求める
+    """
+    p_bboxes, t_bboxes = calc_mask_bboxes(pred_masks), calc_mask_bboxes(true_masks)
+    p_area = pred_masks.reshape(len(pred_masks), -1).sum(axis=1, dtype=np.int64)
+    t_area = true_masks.reshape(len(true_masks), -1).sum(axis=1, dtype=np.int64)
+
+    # 重なり領域 [P, T, 4]
+    ox0 = np.maximum(p_bboxes[:, None, 0], t_bboxes[None, :, 0])
+    oy0 = np.maximum(p_bboxes[:, None, 1], t_bboxes[None, :, 1])
+    ox1 = np.minimum(p_bboxes[:, None, 2], t_bboxes[None, :, 2])
+    oy1 = np.minimum(p_bboxes[:, None, 3], t_bboxes[None, :, 3])
+
+    inter = np.zeros((len(pred_masks), len(true_masks)), dtype=np.float64)
+    for pred_i, true_i in zip(*np.where((ox1 > ox0) & (oy1 > oy0))):
+        ys = slice(oy0[pred_i, true_i], oy1[pred_i, true_i])
+        xs = slice(ox0[pred_i, true_i], ox1[pred_i, true_i])
+        inter[pred_i, true_i] = np.count_nonzero(pred_masks[pred_i, ys, xs] & true_masks[true_i, ys, xs])
+
+    return _iou_from_inter(inter, p_area, t_area)
+
+
+def _calc_iou_rle(pred_masks, true_masks):
+    """
+    ランレングスのまま IoU を求める(バウンディングボックスが重ならないペアは計算しない)
+    """
+    iou = np.zeros((len(pred_masks), len(true_masks)), dtype=np.float64)
+
+    for pred_i, p_mask in enumerate(pred_masks):
+        for true_i, t_mask in enumerate(true_masks):
+            iou[pred_i, true_i] = p_mask.iou(t_mask)
+
+    return iou
+
+
+def is_rle_masks(masks):
+    """
+    RLEMask のリストかどうか
+    """
+    return len(masks) > 0 and isinstance(masks[0], RLEMask)
+
+
+def calc_iou_matrix(pred_masks, true_masks, method='matmul', chunk_size=1 << 20):
+    """
+    予想マスクと教師マスクの全ペアの IoU 行列 [P, T] を求める
+
+    pred_masks (np.ndarray): [P, H, W] の bool 配列
+    true_masks (np.ndarray): [T, H, W] の bool 配列
+    ※どちらかが RLEMask のリストであれば method に関わらずランレングスのまま計算する
+
+    method (str): 'matmul' 行列積で一括計算 (デフォルト)
+                  'bbox'   バウンディングボックスが重なるペアのみ重なり部分で計算(インスタンスが小さい場合に速い)
+                  'loop'   1ペアずつ全画素で計算(検証用)
+    chunk_size (int): 'matmul' で一度に積和をとる画素数
+    """
+    if len(pred_masks) == 0 or len(true_masks) == 0:
+        return np.zeros((len(pred_masks), len(true_masks)), dtype=np.float64)
+
+    if is_rle_masks(pred_masks) or is_rle_masks(true_masks):
+        pred_masks = pred_masks if is_rle_masks(pred_masks) else [RLEMask.from_dense(m) for m in pred_masks]
+        true_masks = true_masks if is_rle_masks(true_masks) else [RLEMask.from_dense(m) for m in true_masks]
+        return _calc_iou_rle(pred_masks, true_masks)
+
+    pred_masks = np.asarray(pred_masks, dtype=bool)
+    true_masks = np.asarray(true_masks, dtype=bool)
+
+    assert pred_masks.shape[1:] == true_masks.shape[1:], 'マスクサイズ不整合 {} {}'.format(pred_masks.shape, true_masks.shape)
+
+    if method == 'matmul':
+        return _calc_iou_matmul(pred_masks, true_masks, chunk_size)
+    elif method == 'bbox':
+        return _calc_iou_bbox(pred_masks, true_masks)
+    elif method == 'loop':
+        return _calc_iou_loop(pred_masks, true_masks)
+    else:
+        raise ValueError('不明な method: {}'.format(method))
+
+
+# fork した子プロセスが参照するマスク (pickle せずに親プロセスのメモリを共有する)
+_shared_mask_pairs = None
+
+
+def _calc_iou_shared_job(i, method):
+    pred_masks, true_masks = _shared_mask_pairs[i]
+    return calc_iou_matrix(pred_masks, true_masks, method=method)
+
+
+def calc_iou_matrices(mask_pairs, method='matmul', workers=1):
+    """
+    画像ごとの IoU 行列をまとめて計算する
+
+    mask_pairs (list): [(pred_masks, true_masks), ...] 画像ごとのマスクの組
+    workers (int): 2以上ならプロセスプールで画像ごとに並列に計算する
+                   fork が使える環境では、マスクは子プロセスに引き継がれて pickle されない
+                   結果は常に mask_pairs の順番になる
+    """
+    if workers <= 1 or len(mask_pairs) <= 1:
+        return [calc_iou_matrix(pred_masks, true_masks, method=method) for pred_masks, true_masks in mask_pairs]
+
+    chunksize = max(1, len(mask_pairs) // (workers * 4))
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(calc_iou_matrix, *zip(*mask_pairs), itertools.repeat(method), chunksize=chunksize))
+
+    global _shared_mask_pairs
+    _shared_mask_pairs = mask_pairs
+
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            return list(executor.map(_calc_iou_shared_job, range(len(mask_pairs)), itertools.repeat(method), chunksize=chunksize))
+    finally:
+        _shared_mask_pairs = None
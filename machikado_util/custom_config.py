@@ -12,7 +12,12 @@ def append_custom_cfg(cfg):
     cfg.INPUT.ROTATE = CN()
     cfg.INPUT.SHEAR = CN()
     cfg.INPUT.CUTOUT = CN()
+    cfg.INPUT.FUSED = CN()
+    cfg.INPUT.IMAGE_CACHE = CN()
+    cfg.INPUT.PROFILE = CN()
 
+    # 水増しの乱数のシード (0 以上なら (SEED, エポック, 番号) からサンプルごとに決める。負ならグローバルの乱数を使う)
+    cfg.INPUT.SEED = -1
     # コントラストの変更
     cfg.INPUT.CONTRAST.ENABLED = True
     cfg.INPUT.CONTRAST.RANGE = (0.5, 1.5)
@@ -36,4 +41,18 @@ def append_custom_cfg(cfg):
     cfg.INPUT.CUTOUT.ENABLED = True
     cfg.INPUT.CUTOUT.NUM_HOLE_RANGE = (5, 20)
     cfg.INPUT.CUTOUT.RADIUS_RANGE = (0.05, 0.15)
-    cfg.INPUT.CUTOUT.COLOR_RANGE = ([0, 255], [0, 255], [0, 255])
\ No newline at end of file
+    cfg.INPUT.CUTOUT.COLOR_RANGE = ([0, 255], [0, 255], [0, 255])
+    cfg.INPUT.CUTOUT.MAX_OCCLUDED_RATIO = 1.0  # 穴で隠れた面積の割合がこれを超えるインスタンスは除外する
+    # 回転・せん断・位置・切り出し・リサイズを1回のワープにまとめる
+    cfg.INPUT.FUSED.AFFINE = False
+    # コントラスト・明るさ・彩度を1回の画素演算にまとめる
+    cfg.INPUT.FUSED.PHOTOMETRIC = False
+    # デコード済み画像のキャッシュ (ワーカープロセス間で共有する)
+    cfg.INPUT.IMAGE_CACHE.ENABLED = False
+    cfg.INPUT.IMAGE_CACHE.DIR = '/dev/shm/machikado_image_cache'
+    cfg.INPUT.IMAGE_CACHE.MAX_BYTES = 2 << 30
+    cfg.INPUT.IMAGE_CACHE.MAX_SIZE = 0  # 長辺をこのサイズ以下に縮小して保存する (0 なら縮小しない)
+    # 処理段階ごとの時間計測 (DIR にワーカーごとのヒストグラムを書き出す。集計は python -m machikado_util.stage_timer DIR)
+    cfg.INPUT.PROFILE.ENABLED = False
+    cfg.INPUT.PROFILE.DIR = ''
+    cfg.INPUT.PROFILE.DUMP_EVERY = 100
@@ -0,0 +1,259 @@
+"""
+評価をデータセットの分割 (シャード) ごとに別のプロセス・マシンで行い、結果をまとめる
+
+    # シャードごと (マシンごと) に推論・照合して、途中結果をファイルに書き出す
+    python -m machikado_util.eval_shard shard ./vott-json-export/Machikado-export.json ./vott-json-export/ ./eval_0.npz \
+        --config-file ./output/config.yaml --weights ./output/model_final.pth --shard-index 0 --num-shards 4
+
+    # 途中結果をまとめて AP 表を出す
+    python -m machikado_util.eval_shard reduce ./eval_*.npz
+
+途中結果は、しきい値・クラスごとの照合記録 (スコア・正解かどうか・IoU) と教師データ数だけなので、
+画像の番号 (file_i) をデータセット全体での番号にしておけば、並べ直すだけで1プロセスで評価した場合と同じになる
+"""
+import argparse
+import itertools
+import os
+import tempfile
+import numpy as np
+
+from .calc_ap import collect_match_records, make_df_dict, make_AP_table, AP_THRESHOLDS
+
+STATE_VERSION = 1
+
+# 途中結果に保存する照合記録の列 (th_i, cls_i はしきい値・クラスの番号)
+RECORD_COLUMNS = ['th_i', 'cls_i', 'file_i', 'pred_i', 'score', 'correct', 'iou']
+
+# evaluate_shard で登録するデータセット名の通し番号
+_catalog_counter = itertools.count()
+
+
+def shard_indices(num, shard_index, num_shards):
+    """
+    num 枚のデータセットのうち、シャード shard_index が担当する画像の番号 (num_shards 個おき)
+    """
+    assert 0 <= shard_index < num_shards, 'shard_index: {}, num_shards: {}'.format(shard_index, num_shards)
+
+    return np.arange(shard_index, num, num_shards)
+
+
+def make_partial_state(true_iter, pred_iter, classes, ths=AP_THRESHOLDS, file_indices=None, cat_names=None,
+                       iou_method='matmul'):
+    """
+    シャードの画像を照合して、まとめられる途中結果を作る
+
+    file_indices: シャードの各画像のデータセット全体での番号 (None なら 0, 1, 2, ...)
+    cat_names: クラス名 (まとめたときの AP 表に使う)
+
+    Returns:
+        dict -- {'classes', 'ths', 'cat_names', 'file_indices', 'num_true': [クラス数],
+                 'records': {列名: 全しきい値・クラスの記録を連結した配列 (th_i, cls_i 列で区別)}}
+    """
+    classes, ths = list(classes), list(ths)
+
+    num_files = [0]
+
+    def count(it):
+        for d in it:
+            num_files[0] += 1
+            yield d
+
+    tmp_dicts, num_true_cls_count = collect_match_records(true_iter, count(pred_iter), classes, ths, iou_method=iou_method)
+
+    file_indices = np.arange(num_files[0]) if file_indices is None else np.asarray(file_indices, dtype=np.int64)
+    assert len(file_indices) == num_files[0], '画像数の不整合 {} -> {}'.format(len(file_indices), num_files[0])
+
+    records = {col: [] for col in RECORD_COLUMNS}
+    for th_i, th in enumerate(ths):
+        for cls_i, _cls in enumerate(classes):
+            tmp_dict = tmp_dicts[th][_cls]
+            if len(tmp_dict['file_i']) == 0:
+                continue
+
+            file_i = file_indices[np.concatenate(tmp_dict['file_i'])]  # データセット全体での番号にする
+            records['th_i'].append(np.full(len(file_i), th_i, dtype=np.int64))
+            records['cls_i'].append(np.full(len(file_i), cls_i, dtype=np.int64))
+            records['file_i'].append(file_i)
+            for col in ['pred_i', 'score', 'correct', 'iou']:
+                records[col].append(np.concatenate(tmp_dict[col]))
+
+    # 記録が空のときの型 (スコア・IoU は、記録があれば推論結果の型のまま)
+    dtypes = {'th_i': np.int64, 'cls_i': np.int64, 'file_i': np.int64, 'pred_i': np.int64, 'correct': bool}
+
+    return {
+        'classes': np.asarray(classes),
+        'ths': np.asarray(ths, dtype=np.float64),
+        'cat_names': np.asarray(cat_names if cat_names is not None else [str(c) for c in classes]),
+        'file_indices': file_indices,
+        'num_true': np.asarray([num_true_cls_count[_cls] for _cls in classes], dtype=np.int64),
+        'records': {col: np.concatenate(records[col]) if len(records[col]) else np.zeros(0, dtype=dtypes.get(col, np.float64))
+                    for col in RECORD_COLUMNS},
+    }
+
+
+def save_partial_state(filename, state):
+    """
+    途中結果を .npz に書き出す (書きかけのファイルを読まないように、一時ファイルに書いてから置き換える)
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=STATE_VERSION,
+                     **{key: value for key, value in state.items() if key != 'records'},
+                     **{'records_' + col: value for col, value in state['records'].items()})
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def load_partial_state(filename):
+    with np.load(filename) as data:
+        assert int(data['version']) == STATE_VERSION, '途中結果のバージョン不整合: {}'.format(int(data['version']))
+
+        state = {key: data[key] for key in data.files if key != 'version' and not key.startswith('records_')}
+        state['records'] = {key[len('records_'):]: data[key] for key in data.files if key.startswith('records_')}
+
+    return state
+
+
+def merge_partial_states(states):
+    """
+    途中結果をまとめる (シャードの順番はどうでもよい)
+    """
+    states = list(states)
+    assert len(states), '途中結果がない'
+
+    base = states[0]
+    for state in states[1:]:
+        assert np.array_equal(state['classes'], base['classes']), 'クラスの不整合'
+        assert np.array_equal(state['ths'], base['ths']), 'しきい値の不整合'
+
+    file_indices = np.concatenate([state['file_indices'] for state in states])
+    assert len(np.unique(file_indices)) == len(file_indices), '同じ画像が複数のシャードに含まれている'
+
+    # 画像のない (記録が空の) シャードは型が決まらないので除く
+    filled = [state for state in states if len(state['records']['th_i'])] or [base]
+    records = {col: np.concatenate([state['records'][col] for state in filled]) for col in base['records']}
+
+    # 1プロセスで評価した場合と同じ並び (しきい値・クラスごとに、画像の番号・予想の番号の順)
+    order = np.lexsort((records['pred_i'], records['file_i'], records['cls_i'], records['th_i']))
+
+    return {
+        'classes': base['classes'],
+        'ths': base['ths'],
+        'cat_names': base['cat_names'],
+        'file_indices': np.sort(file_indices),
+        'num_true': np.sum([state['num_true'] for state in states], axis=0),
+        'records': {col: records[col][order] for col in records},
+    }
+
+
+def partial_state_to_df_dicts(state):
+    """
+    途中結果から、しきい値ごとの df_dict (make_info_dicts_stream と同じ形式) を作る
+
+    file_i はデータセット全体での番号なので、全てのシャードをまとめた場合は1プロセスで評価した結果と同じになる
+    """
+    classes, ths = state['classes'].tolist(), state['ths'].tolist()
+    records = state['records']
+    num_true_cls_count = {_cls: int(n) for _cls, n in zip(classes, state['num_true'])}
+
+    # (th_i, cls_i) ごとの範囲 (merge_partial_states で並べてある前提)
+    keys = records['th_i'] * len(classes) + records['cls_i']
+    assert np.all(np.diff(keys) >= 0), '途中結果が並んでいない (merge_partial_states を通す)'
+    bounds = np.searchsorted(keys, np.arange(len(ths) * len(classes) + 1))
+
+    df_dicts = {}
+    for th_i, th in enumerate(ths):
+        tmp_dicts = {}
+        for cls_i, _cls in enumerate(classes):
+            s, e = bounds[th_i * len(classes) + cls_i], bounds[th_i * len(classes) + cls_i + 1]
+            tmp_dicts[_cls] = {col: [records[col][s:e]] if e > s else [] for col in RECORD_COLUMNS[2:]}
+
+        df_dicts[th] = make_df_dict(tmp_dicts, num_true_cls_count)
+
+    return df_dicts
+
+
+def evaluate_shard(cfg, dataset_dicts, shard_index, num_shards, cat_names, ths=AP_THRESHOLDS, batch_size=4,
+                   cache_dir=None, mask_format='rle', verbose=False):
+    """
+    データセットのうちシャードの担当分を推論・照合して、途中結果を返す
+    cache_dir: PredictionCache のディレクトリ (None ならキャッシュしない)
+    """
+    from detectron2.data import DatasetCatalog
+    from .MachikadoPredictor import MachikadoPredictor
+    from .PredictionCache import PredictionCache
+    from .calc_ap import iter_true_datas, iter_pred_datas_batch
+
+    indices = shard_indices(len(dataset_dicts), shard_index, num_shards)
+
+    catalog_name = 'machikado_eval_shard_{}_{}_{}'.format(shard_index, num_shards, next(_catalog_counter))
+    DatasetCatalog.register(catalog_name, lambda: [dataset_dicts[i] for i in indices])
+
+    cache = PredictionCache(cache_dir, cfg) if cache_dir else None
+    predictor = MachikadoPredictor(cache.inference_cfg() if cache is not None else cfg, batch_size=batch_size)
+
+    return make_partial_state(iter_true_datas(catalog_name, mask_format=mask_format),
+                              iter_pred_datas_batch(predictor, catalog_name, verbose=verbose, mask_format=mask_format, cache=cache),
+                              classes=list(range(len(cat_names))), ths=ths, file_indices=indices, cat_names=cat_names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='シャードごとの評価と、途中結果のまとめ')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('shard', help='シャードの担当分を推論・照合して途中結果を書き出す (要 detectron2)')
+    p.add_argument('export_filename', help='VoTT のエクスポートファイル')
+    p.add_argument('image_dirname', help='画像が格納されているディレクトリ')
+    p.add_argument('output', help='途中結果の出力先 (.npz)')
+    p.add_argument('--config-file', required=True, help='学習に使った設定ファイル')
+    p.add_argument('--weights', required=True, help='学習済みの重み')
+    p.add_argument('--shard-index', type=int, default=0)
+    p.add_argument('--num-shards', type=int, default=1)
+    p.add_argument('--batch-size', type=int, default=4)
+    p.add_argument('--cache-dir', default=None, help='推論結果のキャッシュ (PredictionCache) のディレクトリ')
+    p.add_argument('--verbose', action='store_true')
+
+    p = subparsers.add_parser('reduce', help='途中結果をまとめて AP 表を出す')
+    p.add_argument('inputs', nargs='+', help='シャードの途中結果 (.npz)')
+    p.add_argument('--method', default='trapezoid', choices=['trapezoid', 'coco101'])
+    p.add_argument('--output', default=None, help='まとめた途中結果の出力先 (.npz)')
+
+    args = parser.parse_args()
+
+    if args.command == 'shard':
+        from detectron2.config import get_cfg
+        from .custom_config import append_custom_cfg
+        from .Machikado_vott import get_cat_names, get_machikado_dicts
+
+        cfg = get_cfg()
+        append_custom_cfg(cfg)
+        cfg.merge_from_file(args.config_file)
+        cfg.MODEL.WEIGHTS = args.weights
+
+        cat_name2id, cat_id2name = get_cat_names(args.export_filename)
+        dataset_dicts = get_machikado_dicts(args.export_filename, args.image_dirname, cat_name2id)
+        cat_names = [cat_id2name[i] for i in range(len(cat_id2name))]
+
+        state = evaluate_shard(cfg, dataset_dicts, args.shard_index, args.num_shards, cat_names,
+                               batch_size=args.batch_size, cache_dir=args.cache_dir, verbose=args.verbose)
+        save_partial_state(args.output, state)
+
+        print('shard {}/{}: {} images -> {}'.format(args.shard_index, args.num_shards, len(state['file_indices']), args.output))
+    elif args.command == 'reduce':
+        state = merge_partial_states(load_partial_state(filename) for filename in args.inputs)
+        if args.output is not None:
+            save_partial_state(args.output, state)
+
+        print('{} shards, {} images'.format(len(args.inputs), len(state['file_indices'])))
+        print(make_AP_table(partial_state_to_df_dicts(state), state['cat_names'].tolist(), method=args.method))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+VoTT のエクスポートを、縮小済みの画像とアノテーションをまとめた1つのシャードファイルに書き出す
+(レコードの file_name, height, width とアノテーションは元の画像のまま。縮小するのは保存する画像だけ)
+
+    python -m machikado_util.machikado_shard ./vott-json-export/Machikado-export.json ./vott-json-export/ ./machikado.shard --max-size 640
+
+シャードファイルの構成 (画像・ポリゴンは 64 バイト境界に置き、メモリマップでコピーせずに読む)
+
+    MAGIC (8 バイト) | ヘッダ長 (uint64) | ヘッダ (JSON) | 画像・ポリゴンのデータ
+"""
+import argparse
+import json
+import os
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+from detectron2.data import detection_utils as utils
+from detectron2.structures import BoxMode
+
+from .Machikado_vott import load_machikado_export
+
+MAGIC = b'MKSHARD1'
+SHARD_VERSION = 2
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _resized_size(h, w, max_size):
+    if max_size <= 0 or max(h, w) <= max_size:
+        return h, w
+
+    scale = max_size / max(h, w)
+    return max(1, int(round(h * scale))), max(1, int(round(w * scale)))
+
+
+def _make_layout(dataset_dicts, max_size, channels):
+    """
+    書き出す前に、画像・ポリゴンの配置とヘッダのレコードを決める
+    オフセットはデータ領域の先頭からの位置
+    """
+    offset = 0
+    records = []
+
+    for d in dataset_dicts:
+        h, w = d['height'], d['width']
+        new_h, new_w = _resized_size(h, w, max_size)
+
+        record = {
+            'file_name': d['file_name'],
+            'height': h,
+            'width': w,
+            'image': [offset, new_h, new_w, channels],
+            'annotations': [],
+        }
+        offset = _align(offset + new_h * new_w * channels)
+
+        polygons = []
+        for obj in d['annotations']:
+            x0, y0, x1, y1 = BoxMode.convert(obj['bbox'], obj['bbox_mode'], BoxMode.XYXY_ABS)
+
+            anno = {
+                'bbox': [float(x0), float(y0), float(x1), float(y1)],
+                'category_id': obj['category_id'],
+                'iscrowd': obj.get('iscrowd', 0),
+                'segmentation': [],
+            }
+            for poly in obj['segmentation']:
+                poly = np.asarray(poly, dtype=np.float32).reshape(-1, 2)
+                anno['segmentation'].append([offset, len(poly)])
+                polygons.append((offset, poly))
+                offset = _align(offset + poly.nbytes)
+
+            record['annotations'].append(anno)
+
+        records.append((record, polygons))
+
+    return records, offset
+
+
+def _load_resized(file_name, format, h, w):
+    image = utils.read_image(file_name, format=format)
+
+    if image.shape[:2] != (h, w):
+        image = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+
+    return np.ascontiguousarray(image, dtype=np.uint8)
+
+
+def write_shard(export_filename, image_dirname, shard_filename, max_size=640, format='BGR', num_workers=8,
+                cache_filename=None, cat_name2id=None):
+    """
+    VoTT のエクスポートをシャードファイルに書き出す
+
+    max_size: 保存する画像の長辺をこのサイズ以下に縮小する (0 なら縮小しない)
+              アノテーションは元の画像の座標のまま保存し、MachikadoDatasetMapper が読むときに画像に合わせて縮小する
+    format: 保存する画像の形式 (cfg.INPUT.FORMAT と合わせる)
+    num_workers: 画像のデコード・縮小を並行して行うスレッド数
+    cat_name2id: カテゴリ ID の対応 (None ならエクスポートファイルのタグ順)。ヘッダに記録し、読むときに照合する
+    """
+    data = load_machikado_export(export_filename, image_dirname, cache_filename=cache_filename,
+                                 num_workers=num_workers, cat_name2id=cat_name2id, polygon_format='array')
+    channels = 1 if format == 'L' else 3
+
+    records, data_size = _make_layout(data['dataset_dicts'], max_size, channels)
+
+    header = json.dumps({
+        'version': SHARD_VERSION,
+        'format': format,
+        'max_size': max_size,
+        'cat_name2id': dict(data['cat_name2id']),
+        'records': [record for record, _ in records],
+    }).encode('utf-8')
+    data_offset = _align(len(MAGIC) + 8 + len(header))
+
+    dirname = os.path.dirname(os.path.abspath(shard_filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.truncate(data_offset + data_size)
+
+            def write_at(offset, array):
+                f.seek(data_offset + offset)
+                f.write(array.tobytes())
+
+            # 画像はスレッドでデコードしながら、少しずつ順番に書き込む
+            chunk_size = max(1, num_workers) * 4
+            with ThreadPoolExecutor(max(1, num_workers)) as executor:
+                for s in range(0, len(records), chunk_size):
+                    chunk = records[s:s + chunk_size]
+                    images = executor.map(lambda r: _load_resized(r[0]['file_name'], format, r[0]['height'], r[0]['width']), chunk)
+
+                    for (record, polygons), image in zip(chunk, images):
+                        write_at(record['image'][0], image)
+                        for offset, poly in polygons:
+                            write_at(offset, poly)
+
+        os.replace(tmp_filename, shard_filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    return len(records)
+
+
+# プロセスごとに開いたシャード {ファイル名: (ヘッダ, メモリマップ, (更新時刻, サイズ))}
+_opened_shards = {}
+
+
+def _open_shard(shard_filename):
+    """
+    シャードファイルを開いて (ヘッダ, データ領域のメモリマップ, (更新時刻, サイズ)) を返す
+    同じ名前で書き直された (更新時刻・サイズが変わった) 場合は開き直す
+    """
+    shard_filename = os.path.abspath(shard_filename)
+    st = os.stat(shard_filename)
+
+    opened = _opened_shards.get(shard_filename)
+    if opened is None or opened[2] != (st.st_mtime_ns, st.st_size):
+        with open(shard_filename, 'rb') as f:
+            st = os.fstat(f.fileno())  # 開いている途中で置き換えられても、ヘッダとメモリマップは同じファイルから読む
+            assert f.read(len(MAGIC)) == MAGIC, 'シャードファイルではない: {}'.format(shard_filename)
+            header_len, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_len).decode('utf-8'))
+
+            assert header['version'] == SHARD_VERSION, 'シャードファイルのバージョン不整合: {}'.format(header['version'])
+
+            data_offset = _align(len(MAGIC) + 8 + header_len)
+            data = np.memmap(f, dtype=np.uint8, mode='r', offset=data_offset)
+
+        opened = _opened_shards[shard_filename] = (header, data, (st.st_mtime_ns, st.st_size))
+
+    return opened
+
+
+def get_shard_cat_names(shard_filename):
+    """
+    シャードファイルからカテゴリ名を調べる (get_cat_names と同じ形式。シャードを作ったときのカテゴリ ID)
+    """
+    header, _, _ = _open_shard(shard_filename)
+
+    cat_name2id = {name: header['cat_name2id'][name] for name in sorted(header['cat_name2id'], key=header['cat_name2id'].get)}
+    cat_id2name = {i: name for name, i in cat_name2id.items()}
+
+    return cat_name2id, cat_id2name
+
+
+def get_shard_dicts(shard_filename):
+    """
+    シャードファイルから detectron2 のレコードを作る
+    file_name, height, width とアノテーションは元の画像のものなので、評価 (calc_ap) にもそのまま使える
+    ポリゴンはシャードのメモリマップを参照する float32 配列 (読み込み専用)、バウンディングボックスは XYXY_ABS
+    縮小済みの画像は MachikadoDatasetMapper が 'shard_image' (オフセット, 高さ, 幅, チャンネル数) からコピーせずに読む
+    """
+    shard_filename = os.path.abspath(shard_filename)
+    header, data, stamp = _open_shard(shard_filename)
+
+    dataset_dicts = []
+    for record in header['records']:
+        annos = []
+        for anno in record['annotations']:
+            annos.append({
+                'bbox': np.array(anno['bbox'], dtype=np.float32),
+                'bbox_mode': BoxMode.XYXY_ABS,
+                'segmentation': [np.asarray(data[offset:offset + n * 8].view(np.float32)) for offset, n in anno['segmentation']],
+                'category_id': anno['category_id'],
+                'iscrowd': anno['iscrowd'],
+            })
+
+        dataset_dicts.append({
+            'file_name': record['file_name'],
+            'height': record['height'],
+            'width': record['width'],
+            'shard_filename': shard_filename,
+            'shard_image': tuple(record['image']),
+            'shard_stamp': stamp,
+            'annotations': annos,
+        })
+
+    return dataset_dicts
+
+
+def read_shard_image(dataset_dict, format=None):
+    """
+    get_shard_dicts のレコードの画像を、シャードのメモリマップからコピーせずに読む [H, W, C] (読み込み専用)
+    """
+    header, data, stamp = _open_shard(dataset_dict['shard_filename'])
+    assert dataset_dict['shard_stamp'] == stamp, \
+        'レコードを作った後にシャードファイルが書き直された (get_shard_dicts からやり直す): {}'.format(dataset_dict['shard_filename'])
+    assert format is None or format == header['format'], '画像形式の不整合 {} -> {}'.format(header['format'], format)
+
+    offset, h, w, c = dataset_dict['shard_image']
+
+    return np.asarray(data[offset:offset + h * w * c]).reshape(h, w, c)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VoTT のエクスポートをシャードファイルに書き出す')
+    parser.add_argument('export_filename', help='VoTT のエクスポートファイル')
+    parser.add_argument('image_dirname', help='画像が格納されているディレクトリ')
+    parser.add_argument('shard_filename', help='出力するシャードファイル')
+    parser.add_argument('--max-size', type=int, default=640, help='長辺の最大サイズ (0 なら縮小しない)')
+    parser.add_argument('--format', default='BGR', help='画像の形式 (cfg.INPUT.FORMAT)')
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--cache-filename', default=None, help='load_machikado_export のキャッシュファイル')
+    args = parser.parse_args()
+
+    num = write_shard(args.export_filename, args.image_dirname, args.shard_filename, max_size=args.max_size,
+                      format=args.format, num_workers=args.num_workers, cache_filename=args.cache_filename)
+
+    print('{} images -> {} ({:.1f} MB)'.format(num, args.shard_filename, os.path.getsize(args.shard_filename) / (1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+サンプルごとの乱数生成器
+
+水増しの乱数は (シード, エポック, データセット内の番号) から作る np.random.Generator で引く。
+ワーカープロセスの数や順番によらず同じサンプルには同じ水増しがかかるので、遅い・失敗するサンプルをその場で再現できる
+
+    rng = make_sample_rng(cfg.INPUT.SEED, epoch, index)
+    mapper(dict(dataset_dict, sample_id=(epoch, index)))  # 学習時と同じ水増しで再実行する
+"""
+import numpy as np
+
+# 同じ (シード, エポック, 番号) から、用途ごとに別の系列の乱数を作る
+_SHUFFLE_SPAWN_KEY = (1,)
+_GLOBAL_SPAWN_KEY = (2,)
+_GEOMETRIC_SPAWN_KEY = (3,)
+
+
+def _get_sample_id(dataset_dict, seed):
+    """
+    レコードの 'sample_id' (epoch, index)。seed が負・'sample_id' がないときは None
+    """
+    sample_id = dataset_dict.get('sample_id')
+
+    return None if seed < 0 or sample_id is None else tuple(sample_id)
+
+
+def make_sample_rng(seed, epoch, index):
+    """
+    (seed, epoch, index) から決まる乱数生成器
+    """
+    return np.random.default_rng(np.random.SeedSequence([seed, epoch, index]))
+
+
+def make_shuffle_rng(seed, epoch):
+    """
+    エポックごとのデータセットの並び替えに使う乱数生成器
+    """
+    return np.random.default_rng(np.random.SeedSequence([seed, epoch], spawn_key=_SHUFFLE_SPAWN_KEY))
+
+
+def as_generator(rng=None):
+    """
+    ジェネレータの rng 引数を np.random.Generator にそろえる (None ならグローバルの乱数から作る)
+    """
+    if rng is None:
+        return np.random.default_rng(np.random.randint(1 << 31))
+
+    return rng
+
+
+def get_sample_rng(dataset_dict, seed):
+    """
+    レコードの 'sample_id' (epoch, index) からサンプルの乱数生成器を作る
+
+    seed が負・'sample_id' がないときは、グローバルの乱数から作る (これまでと同じく worker_init_fn の初期化に従う)
+    """
+    sample_id = _get_sample_id(dataset_dict, seed)
+
+    if sample_id is None:
+        return as_generator(None)
+
+    return make_sample_rng(seed, *sample_id)
+
+
+def _seed_global_rng(dataset_dict, seed, spawn_key):
+    sample_id = _get_sample_id(dataset_dict, seed)
+
+    if sample_id is not None:
+        np.random.seed(np.random.SeedSequence([seed, *sample_id], spawn_key=spawn_key).generate_state(1)[0])
+
+
+def seed_global_rng(dataset_dict, seed):
+    """
+    np.random (グローバルの乱数) を (seed, epoch, index) から初期化する
+    detectron2 のジェネレータ (RandomContrast など) はグローバルの乱数を使うため、それらを使う前に呼ぶ
+    (get_sample_rng とは別の系列なので、呼ぶ順番によらない)
+    """
+    _seed_global_rng(dataset_dict, seed, _GLOBAL_SPAWN_KEY)
+
+
+def seed_geometric_rng(dataset_dict, seed):
+    """
+    アフィン変換 (RandomRotation, RandomFlip など) の前に、np.random を seed_global_rng とは別の系列で初期化し直す
+    その前に明るさなどでグローバルの乱数をいくつ引いたかによらず、同じサンプルには同じアフィン変換がかかる
+    """
+    _seed_global_rng(dataset_dict, seed, _GEOMETRIC_SPAWN_KEY)
@@ -0,0 +1,161 @@
+"""
+データマッパーの処理段階ごとの時間計測
+
+    python -m machikado_util.stage_timer ./output/stage_timer
+
+プロセス (DataLoader のワーカー) ごとにヒストグラムをファイルに書き出し、集計時にまとめる
+"""
+import argparse
+import contextlib
+import glob
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+# ヒストグラムのビン: 1us から 10s まで、1桁を 8 分割した対数間隔 (最後のビンはそれ以上)
+BIN_EDGES = np.logspace(-6, 1, 7 * 8 + 1)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+
+class StageTimer:
+    """
+    処理段階ごとの時間をヒストグラムで記録する
+
+        timer = StageTimer(enabled=True, dump_dir='./output/stage_timer')
+        with timer('read'):
+            ...
+        timer.step()  # 1サンプル終わるごとに呼ぶ (dump_every サンプルごとに書き出す)
+
+    無効のときは、何もしない同じコンテキストを返すだけなので計測のコストはほとんどかからない
+    """
+    def __init__(self, enabled=False, dump_dir=None, dump_every=100):
+        """
+        dump_dir: ヒストグラムを書き出すディレクトリ (None なら書き出さない)
+        dump_every: 何サンプルごとに書き出すか
+        """
+        self.enabled = enabled
+        self.dump_dir = dump_dir
+        self.dump_every = dump_every
+
+        self.counts = {}  # 段階名 -> ビンごとの回数
+        self.totals = {}  # 段階名 -> 合計時間 (秒)
+        self.num_samples = 0
+        self._lock = threading.Lock()  # MachikadoBatchMapper はスレッドからも計測する
+
+    def __call__(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self.counts:
+                self.counts[name] = np.zeros(len(BIN_EDGES), dtype=np.int64)
+                self.totals[name] = 0.0
+
+            self.counts[name][min(np.searchsorted(BIN_EDGES, seconds), len(BIN_EDGES) - 1)] += 1
+            self.totals[name] += seconds
+
+    def step(self):
+        if not self.enabled:
+            return
+
+        self.num_samples += 1
+        if self.dump_dir is not None and self.num_samples % self.dump_every == 0:
+            self.dump()
+
+    def dump(self):
+        """
+        このプロセスのヒストグラムを dump_dir/stage_timer_<pid>.npz に書き出す (前回の分は上書き)
+        """
+        os.makedirs(self.dump_dir, exist_ok=True)
+
+        with self._lock:
+            names = list(self.counts.keys())
+            counts = np.array([self.counts[name] for name in names], dtype=np.int64).reshape(-1, len(BIN_EDGES))
+            totals = np.array([self.totals[name] for name in names], dtype=np.float64)
+
+        fd, tmp_filename = tempfile.mkstemp(dir=self.dump_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, names=np.array(names, dtype=str), counts=counts, totals=totals, num_samples=self.num_samples)
+        os.replace(tmp_filename, os.path.join(self.dump_dir, 'stage_timer_{}.npz'.format(os.getpid())))
+
+    def stats(self):
+        return {'counts': dict(self.counts), 'totals': dict(self.totals), 'num_samples': self.num_samples}
+
+
+def merge_dumps(dump_dir):
+    """
+    dump_dir のヒストグラムを全プロセス分まとめる
+    """
+    merged = {'counts': {}, 'totals': {}, 'num_samples': 0}
+
+    for filename in sorted(glob.glob(os.path.join(dump_dir, 'stage_timer_*.npz'))):
+        with np.load(filename) as data:
+            for name, counts, total in zip(data['names'], data['counts'], data['totals']):
+                name = str(name)
+                merged['counts'][name] = merged['counts'].get(name, 0) + counts
+                merged['totals'][name] = merged['totals'].get(name, 0.0) + float(total)
+            merged['num_samples'] += int(data['num_samples'])
+
+    return merged
+
+
+def _percentile(counts, q):
+    """
+    ヒストグラムからパーセンタイルを求める (ビンの上端の値)
+    """
+    cum = np.cumsum(counts)
+    return BIN_EDGES[min(np.searchsorted(cum, cum[-1] * q / 100), len(BIN_EDGES) - 1)]
+
+
+def format_report(stats):
+    """
+    段階ごとの回数・平均・パーセンタイル・サンプルあたりの時間を表にする
+    """
+    num_samples = max(stats['num_samples'], 1)
+    total_all = sum(stats['totals'].values())
+
+    lines = ['{:24s} {:>8s} {:>10s} {:>10s} {:>10s} {:>12s} {:>7s}'.format(
+        'stage', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'ms / sample', 'share')]
+
+    for name in sorted(stats['totals'], key=lambda n: -stats['totals'][n]):
+        counts, total = stats['counts'][name], stats['totals'][name]
+        count = int(counts.sum())
+        lines.append('{:24s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:12.3f} {:6.1%}'.format(
+            name, count, total / max(count, 1) * 1000, _percentile(counts, 50) * 1000, _percentile(counts, 99) * 1000,
+            total / num_samples * 1000, total / total_all if total_all > 0 else 0))
+
+    lines.append('samples: {}'.format(stats['num_samples']))
+
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='処理段階ごとの時間を集計する')
+    parser.add_argument('dump_dir', help='StageTimer の書き出し先 (cfg.INPUT.PROFILE.DIR)')
+    args = parser.parse_args()
+
+    print(format_report(merge_dumps(args.dump_dir)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('detectron2')
+
+from detectron2.data import DatasetCatalog
+
+from machikado_util.benchmark import make_synthetic_dataset, make_synthetic_outputs, make_tied_scores, _make_df_dict_loop, _calc_ap_loop
+from machikado_util.calc_ap import append_masks, get_true_datas, predict_datas, make_info_dict, evaluate_stream, calc_AP, \
+    calc_pre_rec, make_df_dict
+
+_catalog_ids = itertools.count()
+
+
+def register_dataset(name, dataset_dicts):
+    """
+    テストごとに別の名前でデータセットを登録する
+    """
+    catalog_name = 'machikado_test_{}_{}'.format(name, next(_catalog_ids))
+    DatasetCatalog.register(catalog_name, lambda: dataset_dicts)
+
+    return catalog_name
+
+
+def make_predictor(outputs):
+    """
+    画像の順番に outputs を返す predictor
+    """
+    output_iter = iter(outputs)
+    return lambda img: next(output_iter)
+
+
+@pytest.mark.parametrize('th', [0.5, 0.75])
+def test_evaluate_stream_matches_list(tmp_path, th):
+    """
+    1画像ずつ評価する evaluate_stream が、マスクを全て作ってから評価する方法と同じ結果になる
+    """
+    classes = list(range(6))  # make_synthetic_dataset の category_id
+    cat_names = ['class{}'.format(c) for c in classes]
+
+    dataset_dicts = make_synthetic_dataset(str(tmp_path), num_images=6, h=120, w=160, num_instances=5, num_points=50, seed=0)
+    outputs = make_synthetic_outputs(dataset_dicts, seed=0)
+    catalog_name = register_dataset('stream', dataset_dicts)
+
+    stream = evaluate_stream(make_predictor(outputs), catalog_name, classes, th)
+
+    append_masks(dataset_dicts, mask_format='dense')
+    true_dicts = get_true_datas(catalog_name)
+    pred_dicts = predict_datas(make_predictor(outputs), catalog_name, mask_format='dense')
+    expected = make_info_dict(true_dicts, pred_dicts, classes, th)
+
+    for c in classes:
+        pd.testing.assert_frame_equal(stream[c], expected[c])
+    pd.testing.assert_frame_equal(calc_AP(stream, cat_names), calc_AP(expected, cat_names))
+
+
+def make_pre_rec_records(kinds, n=500, num_images=40, seed=0):
+    """
+    クラスごとの照合記録 ({クラス: {列名: np.ndarray}}) と教師データの数
+    kinds: クラスごとのスコアの同点の多さ (make_tied_scores)
+    """
+    rng = np.random.RandomState(seed)
+    records, num_true_cls_count = {}, {}
+
+    for c, kind in enumerate(kinds):
+        records[c] = {'file_i': np.sort(rng.randint(0, num_images, n)), 'pred_i': rng.randint(0, 20, n),
+                      'score': make_tied_scores(kind, n, rng), 'correct': rng.rand(n) < rng.uniform(0.2, 0.8),
+                      'iou': rng.uniform(0, 1, n)}
+        num_true_cls_count[c] = int(records[c]['correct'].sum() + rng.randint(1, n // 4))  # 見逃しの分だけ多い
+
+    return records, num_true_cls_count
+
+
+@pytest.mark.parametrize('kind', [0, 1, 2, 3])
+def test_make_df_dict_matches_loop(kind):
+    """
+    ベクトル化した pre, rec, 並び順, AP が、1行ずつ累積するループでの計算と一致する
+    (kind: 0 連続値 / 1 0.05 刻み / 2 3種類の値 / 3 全て同じ値。同点は元の順番で並べる)
+    """
+    records, num_true_cls_count = make_pre_rec_records([kind, kind])
+    records[1] = {col: values[:1] for col, values in records[1].items()}  # 記録が1つだけのクラス
+
+    expected = _make_df_dict_loop(records, num_true_cls_count)
+    actual = make_df_dict({c: {col: [v] for col, v in r.items()} for c, r in records.items()}, num_true_cls_count)
+
+    for c in records:
+        np.testing.assert_array_equal(actual[c].index.values, expected[c].index.values)
+        for col in ['score', 'pre', 'rec']:
+            np.testing.assert_allclose(actual[c][col].values, expected[c][col].values.astype(np.float64))
+
+    np.testing.assert_allclose(calc_AP(actual, ['class0', 'class1'])['AP'].values, _calc_ap_loop(expected))
+
+
+def test_calc_pre_rec_keeps_tie_order():
+    """
+    同じスコアは元の順番 ((file_i, pred_i) の順) のまま並ぶ
+    """
+    scores = np.array([0.5, 0.9, 0.5, 0.5, 0.9])
+    corrects = np.array([True, False, False, True, True])
+
+    order, pre, rec = calc_pre_rec(scores, corrects, num_true=4)
+
+    np.testing.assert_array_equal(order, [1, 4, 0, 2, 3])
+    np.testing.assert_allclose(pre, [0 / 1, 1 / 2, 2 / 3, 2 / 4, 3 / 5])
+    np.testing.assert_allclose(rec, [0, 1 / 4, 2 / 4, 2 / 4, 3 / 4])
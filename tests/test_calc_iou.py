@@ -0,0 +1,105 @@
+import numpy as np
+import cv2
+import pytest
+
+from machikado_util.benchmark import make_synthetic_masks, make_synthetic_polygon
+from machikado_util.calc_iou import calc_iou_matrix, calc_iou_matrices
+from machikado_util.RLEMask import RLEMask
+
+
+@pytest.fixture
+def masks():
+    rng = np.random.RandomState(0)
+    return make_synthetic_masks(12, 120, 160, rng), make_synthetic_masks(8, 120, 160, rng)
+
+
+@pytest.mark.parametrize('method', ['matmul', 'bbox'])
+def test_iou_matrix_matches_loop(masks, method):
+    """
+    行列でまとめて計算した IoU がループでの計算と一致する
+    """
+    pred_masks, true_masks = masks
+    expected = calc_iou_matrix(pred_masks, true_masks, method='loop')
+
+    np.testing.assert_allclose(calc_iou_matrix(pred_masks, true_masks, method=method), expected)
+
+
+@pytest.mark.parametrize('method', ['loop', 'matmul', 'bbox'])
+def test_iou_matrix_empty(masks, method):
+    """
+    予想・教師データが0個でも (0, n), (n, 0) の行列になる
+    """
+    pred_masks, true_masks = masks
+    empty = np.zeros((0,) + pred_masks.shape[1:], dtype=bool)
+
+    assert calc_iou_matrix(empty, true_masks, method=method).shape == (0, len(true_masks))
+    assert calc_iou_matrix(pred_masks, empty, method=method).shape == (len(pred_masks), 0)
+
+
+def test_rle_iou_matrix_matches_dense(masks):
+    """
+    ランレングスのままで計算した IoU が、bool 配列での計算と一致する
+    """
+    pred_masks, true_masks = masks
+    expected = calc_iou_matrix(pred_masks, true_masks, method='loop')
+
+    pred_rles = [RLEMask.from_dense(m) for m in pred_masks]
+    true_rles = [RLEMask.from_dense(m) for m in true_masks]
+
+    np.testing.assert_allclose(calc_iou_matrix(pred_rles, true_rles), expected)
+    np.testing.assert_allclose(calc_iou_matrix(pred_rles, true_masks), expected)  # 片方だけランレングスでもよい
+
+
+def test_rle_roundtrip(masks):
+    """
+    from_dense -> decode で元のマスクに戻る (空・全面・縦に全域を覆うマスクも含む)
+    """
+    pred_masks, _ = masks
+    h, w = pred_masks.shape[1:]
+
+    edge_masks = np.zeros((3, h, w), dtype=bool)
+    edge_masks[1] = True
+    edge_masks[2, :, 10:20] = True  # 列をまたいで連続するラン
+
+    for mask in list(pred_masks) + list(edge_masks):
+        rle = RLEMask.from_dense(mask)
+        np.testing.assert_array_equal(rle.decode(), mask)
+        assert rle.area == mask.sum()
+
+
+def test_rle_from_polygon_matches_fill_poly():
+    """
+    ポリゴンから作ったランが、画像全体を fillPoly で塗りつぶしたものと一致する (画像からはみ出すポリゴンも含む)
+    """
+    rng = np.random.RandomState(0)
+    h, w = 120, 160
+
+    for i in range(20):
+        poly = make_synthetic_polygon(h, w, 50, rng)
+        if i % 4 == 0:
+            poly = poly * 1.8 - 40  # 画像からはみ出す
+
+        expected = np.zeros((h, w), dtype=np.uint8)
+        cv2.fillPoly(expected, [poly.reshape(-1, 2).astype(np.int32)], 1)
+
+        np.testing.assert_array_equal(RLEMask.from_polygon([poly], h, w).decode(), expected.astype(bool))
+
+
+@pytest.mark.parametrize('mask_format', ['dense', 'rle'])
+def test_iou_matrices_workers_match_serial(mask_format):
+    """
+    プロセスプールで並列に計算しても、結果と順番が1プロセスでの計算と同じになる
+    """
+    rng = np.random.RandomState(0)
+    mask_pairs = [(make_synthetic_masks(rng.randint(0, 6), 60, 80, rng), make_synthetic_masks(rng.randint(0, 4), 60, 80, rng))
+                  for _ in range(9)]
+
+    if mask_format == 'rle':
+        mask_pairs = [([RLEMask.from_dense(m) for m in p], [RLEMask.from_dense(m) for m in t]) for p, t in mask_pairs]
+
+    expected = calc_iou_matrices(mask_pairs, method='bbox', workers=1)
+    actual = calc_iou_matrices(mask_pairs, method='bbox', workers=2)
+
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        np.testing.assert_array_equal(a, e)
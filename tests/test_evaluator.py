@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('detectron2')
+
+from machikado_util.benchmark import make_synthetic_eval_dict
+from machikado_util.calc_ap import make_info_dicts_stream, make_AP_table, AP_THRESHOLDS
+from machikado_util.IncrementalEvaluator import IncrementalEvaluator
+from machikado_util.eval_shard import shard_indices, make_partial_state, save_partial_state, load_partial_state, \
+    merge_partial_states, partial_state_to_df_dicts
+
+NUM_CLASSES = 4
+CLASSES = list(range(NUM_CLASSES))
+CAT_NAMES = ['class{}'.format(c) for c in CLASSES]
+H, W = 60, 80
+
+
+def make_eval_dicts(num_images, rng, start=0):
+    true_dicts = [make_synthetic_eval_dict('img{}'.format(i), 4, H, W, NUM_CLASSES, rng) for i in range(start, start + num_images)]
+    pred_dicts = [make_synthetic_eval_dict('img{}'.format(i), 6, H, W, NUM_CLASSES, rng, pred=True)
+                  for i in range(start, start + num_images)]
+
+    return true_dicts, pred_dicts
+
+
+def assert_df_dicts_equal(actual, expected):
+    for th in AP_THRESHOLDS:
+        for c in CLASSES:
+            pd.testing.assert_frame_equal(actual[th][c], expected[th][c])
+    pd.testing.assert_frame_equal(make_AP_table(actual, CAT_NAMES), make_AP_table(expected, CAT_NAMES))
+
+
+def test_incremental_matches_full():
+    """
+    画像の予想・教師データの更新、追加、削除のあとも、最初から評価し直した結果と同じになる
+    """
+    rng = np.random.RandomState(0)
+    true_dicts, pred_dicts = make_eval_dicts(30, rng)
+
+    evaluator = IncrementalEvaluator(CLASSES, ths=AP_THRESHOLDS)
+    evaluator.add_images(true_dicts, pred_dicts)
+    assert_df_dicts_equal(evaluator.get_df_dicts(), make_info_dicts_stream(true_dicts, pred_dicts, CLASSES, AP_THRESHOLDS))
+
+    # 予想と教師データを差し替える
+    for i in [3, 17, 29]:
+        pred_dicts[i] = make_synthetic_eval_dict('img{}'.format(i), 6, H, W, NUM_CLASSES, rng, pred=True)
+        evaluator.update_pred('img{}'.format(i), pred_dicts[i])
+    true_dicts[5] = make_synthetic_eval_dict('img5', 2, H, W, NUM_CLASSES, rng)
+    evaluator.update_true('img5', true_dicts[5])
+    assert_df_dicts_equal(evaluator.get_df_dicts(), make_info_dicts_stream(true_dicts, pred_dicts, CLASSES, AP_THRESHOLDS))
+
+    # 画像を追加する
+    new_true, new_pred = make_eval_dicts(2, rng, start=30)
+    for true_dict, pred_dict in zip(new_true, new_pred):
+        evaluator.update_image(true_dict['file_name'], true_dict=true_dict, pred_dict=pred_dict)
+    true_dicts += new_true
+    pred_dicts += new_pred
+    assert_df_dicts_equal(evaluator.get_df_dicts(), make_info_dicts_stream(true_dicts, pred_dicts, CLASSES, AP_THRESHOLDS))
+
+    # 画像を取り除く
+    for i in [10, 0]:
+        evaluator.remove_image(true_dicts[i]['file_name'])
+        del true_dicts[i], pred_dicts[i]
+    assert_df_dicts_equal(evaluator.get_df_dicts(), make_info_dicts_stream(true_dicts, pred_dicts, CLASSES, AP_THRESHOLDS))
+
+
+@pytest.mark.parametrize('num_shards', [1, 3, 4, 12])
+def test_eval_shards_match_full(tmp_path, num_shards):
+    """
+    シャードごとの途中結果をファイル経由でまとめると、1プロセスで評価した結果と同じになる
+    (シャードの順番は逆にしてまとめる。画像より多いシャードは空になる)
+    """
+    true_dicts, pred_dicts = make_eval_dicts(10, np.random.RandomState(0))
+
+    filenames = []
+    for shard_index in range(num_shards):
+        indices = shard_indices(len(true_dicts), shard_index, num_shards)
+        state = make_partial_state([true_dicts[i] for i in indices], [pred_dicts[i] for i in indices], CLASSES,
+                                   file_indices=indices, cat_names=CAT_NAMES)
+        filenames.append(str(tmp_path / 'eval_{}.npz'.format(shard_index)))
+        save_partial_state(filenames[-1], state)
+
+    state = merge_partial_states(load_partial_state(filename) for filename in reversed(filenames))
+
+    assert state['cat_names'].tolist() == CAT_NAMES
+    assert_df_dicts_equal(partial_state_to_df_dicts(state), make_info_dicts_stream(true_dicts, pred_dicts, CLASSES, AP_THRESHOLDS))
+
+
+def test_merge_partial_states_rejects_duplicates():
+    """
+    同じ画像を含むシャードはまとめられない
+    """
+    true_dicts, pred_dicts = make_eval_dicts(4, np.random.RandomState(0))
+    state = make_partial_state(true_dicts, pred_dicts, CLASSES)
+
+    with pytest.raises(AssertionError):
+        merge_partial_states([state, state])
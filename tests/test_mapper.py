@@ -0,0 +1,134 @@
+import copy
+import numpy as np
+import pytest
+
+pytest.importorskip('detectron2')
+
+from detectron2.config import get_cfg
+from detectron2.structures import BoxMode
+
+from machikado_util import MachikadoDatasetMapper as mapper_module
+from machikado_util.MachikadoBatchMapper import MachikadoBatchMapper
+from machikado_util.benchmark import make_synthetic_dataset, make_mapper_configs
+from machikado_util.custom_config import append_custom_cfg
+
+MAPPER_CONFIGS = dict(make_mapper_configs())
+
+
+def records_equal(a, b):
+    """
+    np.ndarray を含むレコード同士が等しいか
+    """
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(records_equal(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)):
+        return isinstance(b, (list, tuple)) and len(a) == len(b) and all(records_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, np.ndarray):
+        return isinstance(b, np.ndarray) and a.dtype == b.dtype and np.array_equal(a, b)
+
+    return a == b
+
+
+def make_cfg(config_name):
+    cfg = get_cfg()
+    append_custom_cfg(cfg)
+    cfg.INPUT.CROP.SIZE = [0.8, 0.8]
+    MAPPER_CONFIGS[config_name](cfg)
+
+    return cfg
+
+
+@pytest.fixture(scope='module')
+def dataset_dicts(tmp_path_factory):
+    dirname = str(tmp_path_factory.mktemp('mapper'))
+    dataset_dicts = make_synthetic_dataset(dirname, num_images=4, h=120, w=160, num_instances=4, num_points=50, seed=0)
+
+    # リストのポリゴン (polygon_format='list') のレコードも混ぜる
+    for d in dataset_dicts[::2]:
+        for obj in d['annotations']:
+            obj['segmentation'] = [p.tolist() for p in obj['segmentation']]
+
+    return dataset_dicts
+
+
+@pytest.mark.parametrize('config_name', ['none', 'crop', 'rotate', 'shear', 'extent', 'all', 'all fused'])
+def test_mapper_keeps_source(dataset_dicts, config_name):
+    """
+    マッパーを通しても元のデータセットのレコードが書き換えられない
+    """
+    snapshot = copy.deepcopy(dataset_dicts)
+    mapper = mapper_module.MachikadoDatasetMapper(make_cfg(config_name), is_train=True)
+    np.random.seed(0)
+
+    for _ in range(3):
+        for d in dataset_dicts:
+            mapper(d)
+
+    assert records_equal(dataset_dicts, snapshot)
+
+
+def test_copy_dataset_dict_matches_deepcopy(dataset_dicts, monkeypatch):
+    """
+    copy_dataset_dict で複製しても、copy.deepcopy と同じ水増しの結果になる
+    """
+    cfg = make_cfg('all')
+    cfg.INPUT.SEED = 0
+    records = [dict(d, sample_id=(0, i)) for i, d in enumerate(dataset_dicts)]
+
+    def run():
+        mapper = mapper_module.MachikadoDatasetMapper(cfg, is_train=True)
+        return [mapper(d) for d in records]
+
+    actual = run()
+    monkeypatch.setattr(mapper_module, 'copy_dataset_dict', copy.deepcopy)
+    expected = run()
+
+    for a, e in zip(actual, expected):
+        np.testing.assert_array_equal(a['image'].numpy(), e['image'].numpy())
+        np.testing.assert_array_equal(a['instances'].gt_boxes.tensor.numpy(), e['instances'].gt_boxes.tensor.numpy())
+        np.testing.assert_array_equal(np.asarray(a['instances'].gt_classes), np.asarray(e['instances'].gt_classes))
+
+
+@pytest.mark.parametrize('fused_photometric', [False, True])
+def test_batch_mapper_matches_single(dataset_dicts, fused_photometric):
+    """
+    INPUT.SEED を指定すれば、ミニバッチ単位のマッパーと1枚ずつのマッパーのアフィン変換 (インスタンスの位置) が同じになる
+    FUSED.PHOTOMETRIC が有効なら画像も同じになる
+    """
+    cfg = make_cfg('all')
+    cfg.INPUT.SEED = 0
+    cfg.INPUT.FUSED.PHOTOMETRIC = fused_photometric
+    records = [dict(d, sample_id=(0, i)) for i, d in enumerate(dataset_dicts)]
+
+    single_mapper = mapper_module.MachikadoDatasetMapper(cfg, is_train=True)
+    single = [single_mapper(d) for d in records]
+    batch = MachikadoBatchMapper(cfg, is_train=True, num_workers=2)(records)
+
+    for a, b in zip(single, batch):
+        assert a['image'].shape == b['image'].shape
+        np.testing.assert_array_equal(a['instances'].gt_boxes.tensor.numpy(), b['instances'].gt_boxes.tensor.numpy())
+        if fused_photometric:
+            np.testing.assert_array_equal(a['image'].numpy(), b['image'].numpy())
+
+
+def test_fused_affine_crop_never_fails():
+    """
+    CROP と FUSED.AFFINE を有効にしても、回転・せん断・移動でインスタンスが枠の外に出たときに切り出しが失敗しない
+    (インスタンスは画像の端の近くにも置く)
+    """
+    h, w, num_instances = 480, 640, 3
+    cfg = make_cfg('all fused')
+    mapper = mapper_module.MachikadoDatasetMapper(cfg, is_train=True)
+
+    rng = np.random.default_rng(0)
+    np.random.seed(0)
+    image = np.empty((h, w, 0), dtype=np.uint8)  # _get_fused_affine はサイズしか見ない
+
+    for _ in range(2000):
+        centers = rng.uniform(0, 1, (num_instances, 2)) * [w, h]
+        sizes = rng.uniform(0.02, 0.1, (num_instances, 2)) * [w, h]
+        annos = [{'bbox': np.r_[c - s / 2, c + s / 2].astype(np.float32), 'bbox_mode': BoxMode.XYXY_ABS}
+                 for c, s in zip(centers, sizes)]
+
+        tfm = mapper._get_fused_affine(image, {'annotations': annos}, rng)
+        assert tfm.out_h > 0 and tfm.out_w > 0
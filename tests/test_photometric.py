@@ -0,0 +1,83 @@
+import numpy as np
+import cv2
+import pytest
+
+pytest.importorskip('detectron2')
+
+from fvcore.transforms.transform import BlendTransform
+
+from machikado_util.PhotometricTransform import RandomPhotometric
+
+RANGES = ((0.5, 1.5), (0.8, 1.2), (0.8, 1.2))
+
+
+def apply_sequential_photometric(img, w_cont, w_bright, w_sat):
+    """
+    RandomContrast -> RandomBrightness -> RandomSaturation を、引いた重みで順番にかける
+    (各ジェネレータの get_transform と同じ BlendTransform。重みを RandomPhotometric と共有して比べるため)
+    """
+    img = BlendTransform(src_image=img.mean(), src_weight=1 - w_cont, dst_weight=w_cont).apply_image(img)
+    img = BlendTransform(src_image=0, src_weight=1 - w_bright, dst_weight=w_bright).apply_image(img)
+    grayscale = img.dot([0.299, 0.587, 0.114])[:, :, np.newaxis]
+
+    return BlendTransform(src_image=grayscale, src_weight=1 - w_sat, dst_weight=w_sat).apply_image(img)
+
+
+@pytest.fixture(scope='module')
+def images():
+    rng = np.random.RandomState(0)
+    return [cv2.GaussianBlur(rng.randint(0, 256, (60, 80, 3)).astype(np.uint8), (15, 15), 0) for _ in range(8)]
+
+
+def test_photometric_matches_sequential(images):
+    """
+    同じ重みなら、まとめた変換と個別の変換の差は uint8 への丸めの分 (3 以下) に収まる
+    (個別の変換は3段それぞれで切り捨て、まとめた方は1回丸める)
+    """
+    gen = RandomPhotometric(*RANGES)
+    weights = gen.sample_weights(len(images), np.random.default_rng(0))
+
+    for img, wts in zip(images, weights):
+        expected = apply_sequential_photometric(img, *wts)
+        actual = gen.make_transform(img, *wts).apply_image(img)
+
+        assert actual.dtype == np.uint8
+        assert np.abs(actual.astype(np.int16) - expected).max() <= 3
+
+
+def test_photometric_matches_sequential_float(images):
+    """
+    float の画像は丸めがないので、個別の変換と同じ値になる
+    """
+    gen = RandomPhotometric(*RANGES)
+    weights = gen.sample_weights(len(images), np.random.default_rng(0))
+
+    for img, wts in zip(images, weights):
+        img = img.astype(np.float32)
+        expected = apply_sequential_photometric(img, *wts)
+        actual = gen.make_transform(img, *wts).apply_image(img)
+
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_sample_weights_order():
+    """
+    重みは個別のジェネレータと同じ順番 (コントラスト, 明るさ, 彩度) で引かれ、範囲が None のものは 1
+    """
+    weights = RandomPhotometric(RANGES[0], None, RANGES[2]).sample_weights(5, np.random.default_rng(0))
+
+    rng = np.random.default_rng(0)
+    np.testing.assert_array_equal(weights[:, 0], rng.uniform(*RANGES[0], 5))
+    np.testing.assert_array_equal(weights[:, 1], np.ones(5))
+    np.testing.assert_array_equal(weights[:, 2], rng.uniform(*RANGES[2], 5))
+
+
+def test_get_transform_replays_with_same_rng(images):
+    """
+    同じシードの rng を渡せば同じ変換になる
+    """
+    gen = RandomPhotometric(*RANGES)
+    a = gen.get_transform(images[0], np.random.default_rng(1)).apply_image(images[0])
+    b = gen.get_transform(images[0], np.random.default_rng(1)).apply_image(images[0])
+
+    np.testing.assert_array_equal(a, b)
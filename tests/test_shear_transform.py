@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('detectron2')
+pytest.importorskip('shapely')
+
+from machikado_util.benchmark import make_sheared_polygons
+from machikado_util.ShearTransform import ShearTransform, crop_polygons, _crop_polygons_shapely, _polygon_area, \
+    _is_simple_polygons
+
+H, W = 120, 160
+
+
+def clipped_areas(clip_func, polygons, w=W, h=H):
+    """
+    ポリゴンごとのクリッピング後の面積 (分割された場合は合計)
+    """
+    return np.array([sum(_polygon_area(c) for c in clip_func([p], w, h)) for p in polygons])
+
+
+@pytest.mark.parametrize('self_intersect_every', [1000, 1, 3])
+def test_crop_polygons_matches_shapely(self_intersect_every):
+    """
+    NumPy のクリッピングの面積が、shapely でクリッピングした面積と一致する (自己交差したポリゴンを含む)
+    """
+    polygons = make_sheared_polygons(200, 60, H, W, np.random.RandomState(0), self_intersect_every=self_intersect_every)
+
+    expected = clipped_areas(_crop_polygons_shapely, polygons)
+    actual = clipped_areas(crop_polygons, polygons)
+
+    np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_is_simple_polygons():
+    """
+    頂点を入れ替えたポリゴンだけが自己交差と判定される (それ以外は NumPy の経路で切り取る)
+    """
+    polygons = make_sheared_polygons(20, 60, H, W, np.random.RandomState(0), self_intersect_every=5)
+
+    np.testing.assert_array_equal(_is_simple_polygons(polygons), np.arange(20) % 5 != 0)
+
+
+def test_crop_polygons_edge_cases():
+    """
+    範囲内のポリゴンはそのまま、範囲外と点が 3 未満のものは除かれる
+    """
+    inside = np.array([[10, 10], [50, 10], [50, 40], [10, 40]], dtype=np.float64)
+    outside = inside + (W, 0)
+    degenerate = np.array([[0, 0], [10, 10]], dtype=np.float64)
+
+    result = crop_polygons([inside, outside, degenerate], W, H)
+
+    assert len(result) == 1
+    assert _polygon_area(result[0]) == pytest.approx(_polygon_area(inside))
+    assert crop_polygons([], W, H) == []
+
+
+def test_shear_transform_apply_polygons_matches_shapely():
+    """
+    ShearTransform.apply_polygons の結果が、せん断した座標を shapely でクリッピングした結果と同じ面積になる
+    """
+    rng = np.random.RandomState(0)
+    polygons = make_sheared_polygons(50, 60, H, W, rng, self_intersect_every=10)
+
+    tfm = ShearTransform(H, W, 15, -10)
+    sheared = [tfm.apply_coords(p) for p in polygons]
+
+    expected = sum(_polygon_area(c) for c in _crop_polygons_shapely(sheared, W, H))
+    actual = sum(_polygon_area(c) for c in tfm.apply_polygons(polygons))
+
+    assert actual == pytest.approx(expected, rel=1e-6)